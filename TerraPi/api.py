@@ -0,0 +1,157 @@
+# HTTP query API of aggregated measurements
+
+import json
+from datetime import datetime, timedelta, timezone
+
+import flask
+
+from .db import Sensor, SensorType
+from .query import AGGREGATES, aggregate_query
+
+
+# Milliseconds per unit of bucket sizes
+_UNITS = {'s': 1000, 'm': 60 * 1000, 'h': 60 * 60 * 1000,
+        'd': 24 * 60 * 60 * 1000}
+_EPOCH = datetime(1970, 1, 1)
+
+
+def parse_bucket(text):
+    """
+    Parses a bucket size given in seconds (e.g. 300) or with a unit (30s, 5m,
+    1h or 1d).
+
+    :return: The bucket size in milliseconds
+    """
+    if text[-1:] in _UNITS:
+        ms = int(text[:-1]) * _UNITS[text[-1]]
+    else:
+        ms = int(text) * 1000
+    if ms <= 0:
+        raise ValueError("Bucket size must be positive: {}".format(text))
+    return ms
+
+
+def _parse_time(text):
+    """Parses an ISO 8601 time to a naive UTC datetime."""
+    dt = datetime.fromisoformat(text)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _encode_cursor(sensor_id, timestamp):
+    return '{}:{}'.format(sensor_id, timestamp)
+
+
+def _decode_cursor(cursor):
+    sensor_id, timestamp = cursor.split(':')
+    return int(sensor_id), _EPOCH + timedelta(milliseconds=int(timestamp))
+
+
+def _stream(session, query, header, bucket, limit, chunk_size=1000):
+    """
+    Yields the JSON response of a series query in pieces, as rows are read
+    from the database, and closes the session at the end.
+    """
+    try:
+        result = session.execute(query.execution_options(stream_results=True))
+        yield header[:-1] + ',"rows":['
+        count = 0
+        last = None
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield (',' if count else '') + ','.join(json.dumps(
+                [r.sensor_id, int(r.bucket), r.min, r.max, float(r.avg),
+                    r.last]) for r in rows)
+            count += len(rows)
+            last = rows[-1]
+        result.close()
+        cursor = None
+        if count == limit:
+            cursor = _encode_cursor(last.sensor_id,
+                    int(last.bucket) + bucket)
+        yield '],"next":{}}}'.format(json.dumps(cursor))
+    finally:
+        session.close()
+
+
+def create_blueprint(data, config=None):
+    """
+    Creates the query API, a Flask blueprint served by the dashboard under
+    /api. It is read-only, and uses the sessionmaker and storage of the
+    dashboard.
+
+    GET /api/sensors lists the sensors. GET /api/series returns the minimum,
+    maximum, average and last value of time buckets, aggregated by the
+    database, so raw measurements are not sent over the wire. Its parameters
+    are sensor and type (names, repeatable, all sensors by default), start
+    and end (UTC, ISO 8601, the last day by default), bucket (seconds, or
+    e.g. 5m, 1h, 1d, 1h by default), limit (buckets per page), and cursor
+    (the next value of the previous page). Responses are streamed, and buckets
+    are ordered by sensor and time. Archived measurements are not included.
+
+    :param data: The DashboardData object of the dashboard
+    :param config: The dashboard section of the configuration
+    :config api_page_size: Default number of buckets per page
+    :config api_max_page_size: Maximum number of buckets per page
+    """
+    config = config or {}
+    page_size = config.get('api_page_size', 1000)
+    max_page_size = config.get('api_max_page_size', 10000)
+    api = flask.Blueprint('api', __name__, url_prefix='/api')
+
+    @api.route('/sensors')
+    def sensors():
+        session = data.sessionmaker()
+        try:
+            return flask.jsonify([{'id': s.id, 'name': s.name,
+                'type': s.type.name, 'description': s.description}
+                for s in session.query(Sensor).order_by(Sensor.id)])
+        finally:
+            session.close()
+
+    @api.route('/series')
+    def series():
+        args = flask.request.args
+        try:
+            bucket = parse_bucket(args.get('bucket', '1h'))
+            end = _parse_time(args['end']) if 'end' in args \
+                    else datetime.utcnow()
+            start = _parse_time(args['start']) if 'start' in args \
+                    else end - timedelta(days=1)
+            limit = min(int(args.get('limit', page_size)), max_page_size)
+            if limit <= 0:
+                raise ValueError("Limit must be positive.")
+            after = _decode_cursor(args['cursor']) if 'cursor' in args \
+                    else None
+            types = [SensorType[t] for t in args.getlist('type')]
+        except (KeyError, ValueError) as e:
+            return flask.jsonify({'error': str(e)}), 400
+
+        session = data.sessionmaker()
+        query = session.query(Sensor).order_by(Sensor.id)
+        if args.getlist('sensor'):
+            query = query.filter(Sensor.name.in_(args.getlist('sensor')))
+        if types:
+            query = query.filter(Sensor.type.in_(types))
+        selected = {s.id: {'name': s.name, 'type': s.type.name}
+                for s in query}
+        header = json.dumps({
+            'bucket': bucket,
+            'columns': ['sensor', 'bucket'] + list(AGGREGATES),
+            'sensors': selected,
+        }, separators=(',', ':'))
+        if not selected:
+            session.close()
+            return flask.Response(header[:-1] + ',"rows":[],"next":null}',
+                    content_type='application/json')
+
+        raw = data.storage.select(session, start, end)
+        query = aggregate_query(raw, list(selected), start, end, bucket,
+                session.get_bind().dialect.name, after, limit)
+        return flask.Response(_stream(session, query, header, bucket, limit),
+                content_type='application/json')
+
+    return api
@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# cold storage of old measurements in compressed columnar segment files
+
+import logging
+import mmap
+import os
+import re
+import shutil
+import struct
+import sys
+import zlib
+from datetime import datetime, timedelta
+from logging.config import dictConfig
+
+import numpy as np
+from sqlalchemy import and_, func, select
+
+from .config import get_connection_string, load_config
+from .db import Sensor, create_sessionmaker
+
+
+# Segment file layout (all integers little-endian):
+#
+#   header  magic (4s), version (H), reserved (H), block count (I)
+#   index   one entry per block: first timestamp (q), last timestamp (q),
+#           offset (Q), compressed length (I), number of points (I)
+#   blocks  zlib compressed, byte-shuffled arrays: timestamp deltas (int64
+#           epoch milliseconds, the first delta is the first timestamp) and
+#           values XOR-ed with the previous value (float64 bit patterns)
+#
+# The index is small and read up front, blocks are only decompressed if they
+# overlap the requested time range.
+_MAGIC = b'TPSG'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHHI')
+_INDEX_ENTRY = struct.Struct('<qqQII')
+
+
+def _shuffle(a):
+    return a.view(np.uint8).reshape(-1, a.itemsize).T.tobytes()
+
+
+def _unshuffle(data, dtype):
+    itemsize = np.dtype(dtype).itemsize
+    a = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T
+    return np.ascontiguousarray(a).view(dtype).reshape(-1)
+
+
+def _encode_block(timestamps, values):
+    deltas = np.diff(timestamps, prepend=0).astype('<i8')
+    bits = values.astype('<f8').view('<u8')
+    xored = np.bitwise_xor(bits, np.r_[np.uint64(0), bits[:-1]])
+    return zlib.compress(_shuffle(deltas) + _shuffle(xored))
+
+
+def _decode_block(data, count):
+    raw = zlib.decompress(data)
+    timestamps = np.cumsum(_unshuffle(raw[:count*8], '<i8'))
+    bits = np.bitwise_xor.accumulate(_unshuffle(raw[count*8:], '<u8'))
+    return timestamps, bits.view('<f8')
+
+
+def write_segment(path, timestamps, values, block_size=4096):
+    """
+    Writes a segment file atomically.
+
+    :param path: The path of the segment file
+    :param timestamps: Sorted array of UTC epoch milliseconds
+    :param values: Array of values
+    :param block_size: Number of points per compressed block
+    """
+    with SegmentWriter(path, block_size) as writer:
+        writer.write(timestamps, values)
+
+
+class SegmentWriter():
+    """
+    Writes a segment file incrementally, so series of any length are written
+    with constant memory. Blocks are written to a temporary file, because the
+    index in front of them is only known when the last one is written. The
+    segment file is created atomically when the writer is closed.
+    """
+    def __init__(self, path, block_size=4096):
+        """
+        Constructs a new 'SegmentWriter' object.
+
+        :param path: The path of the segment file
+        :param block_size: Number of points per compressed block
+        """
+        self._path = path
+        self._block_size = block_size
+        self._blocks = open(path + '.blocks', 'w+b')
+        self._index = []
+        self._timestamps = []
+        self._values = []
+        self._buffered = 0
+
+    def write(self, timestamps, values):
+        """
+        Appends points to the segment.
+
+        :param timestamps: Sorted array of UTC epoch milliseconds, all later
+            than the points written before
+        :param values: Array of values
+        """
+        self._timestamps.append(np.asarray(timestamps, dtype=np.int64))
+        self._values.append(np.asarray(values, dtype=np.float64))
+        self._buffered += len(timestamps)
+        if self._buffered >= self._block_size:
+            self._write_blocks(False)
+
+    def close(self):
+        """Writes the remaining points, and creates the segment file."""
+        self._write_blocks(True)
+        offset = _HEADER.size + _INDEX_ENTRY.size * len(self._index)
+        tmp = self._path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, 0, len(self._index)))
+            for first, last, length, count in self._index:
+                f.write(_INDEX_ENTRY.pack(first, last, offset, length, count))
+                offset += length
+            self._blocks.seek(0)
+            shutil.copyfileobj(self._blocks, f)
+        self._blocks.close()
+        os.remove(self._blocks.name)
+        os.replace(tmp, self._path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_blocks(self, last):
+        if not self._timestamps:
+            return
+        timestamps = np.concatenate(self._timestamps)
+        values = np.concatenate(self._values)
+        end = len(timestamps) if last else \
+                len(timestamps) // self._block_size * self._block_size
+        for i in range(0, end, self._block_size):
+            t = timestamps[i:min(i+self._block_size, end)]
+            data = _encode_block(t, values[i:i+len(t)])
+            self._blocks.write(data)
+            self._index.append((int(t[0]), int(t[-1]), len(data), len(t)))
+        self._timestamps = [timestamps[end:]]
+        self._values = [values[end:]]
+        self._buffered = len(timestamps) - end
+
+
+class Segment():
+    """
+    Memory-mapped reader of a segment file.
+    """
+    def __init__(self, path):
+        """
+        Opens a segment file and reads its block index.
+
+        :param path: The path of the segment file
+        """
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, nblocks = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("{} is not a segment file!".format(path))
+        self._index = [_INDEX_ENTRY.unpack_from(self._mmap,
+            _HEADER.size + i * _INDEX_ENTRY.size) for i in range(nblocks)]
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def blocks(self):
+        """Yields the (timestamps, values) arrays of every block in order."""
+        for first, last, offset, length, count in self._index:
+            yield _decode_block(self._mmap[offset:offset+length], count)
+
+    def read(self, start=None, end=None):
+        """
+        Returns the points with start <= timestamp < end. Only the blocks that
+        overlap the range are decompressed.
+
+        :param start: Start of the range in UTC epoch milliseconds
+        :param end: End of the range in UTC epoch milliseconds
+        :return: A (timestamps, values) tuple of arrays
+        """
+        parts_t, parts_v = [], []
+        for first, last, offset, length, count in self._index:
+            if (start is not None and last < start) or \
+                    (end is not None and first >= end):
+                continue
+            t, v = _decode_block(self._mmap[offset:offset+length], count)
+            lo = 0 if start is None else np.searchsorted(t, start)
+            hi = len(t) if end is None else np.searchsorted(t, end)
+            parts_t.append(t[lo:hi])
+            parts_v.append(v[lo:hi])
+        if not parts_t:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(parts_t), np.concatenate(parts_v)
+
+
+class SegmentArchive():
+    """
+    A directory of segment files, one per sensor and month:
+    <directory>/<sensor id>/<year>-<month>.seg
+    """
+    _name_re = re.compile(r'^(\d{4})-(\d{2})\.seg$')
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, sensor_id, year, month):
+        return os.path.join(self.directory, str(sensor_id),
+                '{:04d}-{:02d}.seg'.format(year, month))
+
+    def _months(self, sensor_id):
+        try:
+            names = os.listdir(os.path.join(self.directory, str(sensor_id)))
+        except FileNotFoundError:
+            return []
+        months = []
+        for name in names:
+            m = self._name_re.match(name)
+            if m:
+                months.append((int(m.group(1)), int(m.group(2))))
+        return sorted(months)
+
+    def read(self, sensor_id, start=None, end=None):
+        """
+        Returns the archived points of a sensor with start <= timestamp < end.
+
+        :param sensor_id: The id of the sensor
+        :param start: Start of the range in UTC epoch milliseconds
+        :param end: End of the range in UTC epoch milliseconds
+        :return: A (timestamps, values) tuple of arrays
+        """
+        parts_t, parts_v = [], []
+        for t, v in self.read_months(sensor_id, start, end):
+            parts_t.append(t)
+            parts_v.append(v)
+        if not parts_t:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(parts_t), np.concatenate(parts_v)
+
+    def read_months(self, sensor_id, start=None, end=None):
+        """
+        Like read, but yields the points of every month separately, so only
+        one month is in memory at a time.
+        """
+        for year, month in self._months(sensor_id):
+            m_start, m_end = _month_bounds_ms(year, month)
+            if (start is not None and m_end <= start) or \
+                    (end is not None and m_start >= end):
+                continue
+            with Segment(self._path(sensor_id, year, month)) as segment:
+                yield segment.read(start, end)
+
+    def append(self, sensor_id, year, month, timestamps, values):
+        """
+        Adds points to the segment of a sensor and month, merging them with
+        the points already archived there.
+
+        :param sensor_id: The id of the sensor
+        :param year: Year of the segment
+        :param month: Month of the segment
+        :param timestamps: Array of UTC epoch milliseconds
+        :param values: Array of values
+        """
+        path = self._path(sensor_id, year, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            with Segment(path) as segment:
+                old_t, old_v = segment.read()
+            timestamps = np.concatenate((old_t, timestamps))
+            values = np.concatenate((old_v, values))
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, values = timestamps[order], values[order]
+        # On duplicate timestamps the most recently archived point wins.
+        keep = np.r_[timestamps[1:] != timestamps[:-1], True]
+        write_segment(path, timestamps[keep], values[keep])
+
+
+def _month_bounds(year, month):
+    return datetime(year, month, 1), \
+            datetime(year + month // 12, month % 12 + 1, 1)
+
+
+def _month_bounds_ms(year, month):
+    start, end = _month_bounds(year, month)
+    return tuple(np.array([start, end], dtype='datetime64[ms]').astype(
+        np.int64).tolist())
+
+
+def archive(sessionmaker, storage, archive, older_than):
+    """
+    Moves measurements older than older_than days from the database into the
+    archive, one sensor and month at a time. Rows are only deleted from the
+    database after their segment file has been written.
+
+    :param sessionmaker: The session factory
+    :param storage: The storage object raw measurements are read from
+    :param archive: The SegmentArchive to move measurements to
+    :param older_than: Age in days
+    :return: The number of measurements archived
+    """
+    cutoff = datetime.utcnow() - timedelta(days=older_than)
+    session = sessionmaker()
+    raw = storage.select(session, None, cutoff)
+    oldest = session.execute(select(func.min(raw.c.timestamp))).scalar()
+    sensor_ids = [s.id for s in session.query(Sensor.id)]
+    archived = 0
+
+    year, month = (oldest.year, oldest.month) if oldest else (None, None)
+    while oldest is not None and datetime(year, month, 1) < cutoff:
+        m_start, m_end = _month_bounds(year, month)
+        m_end = min(m_end, cutoff)
+        tables = storage.tables(session, m_start, m_end)
+        for sensor_id in sensor_ids:
+            for table in tables:
+                where = and_(table.c.sensor_id==sensor_id,
+                        table.c.timestamp >= m_start,
+                        table.c.timestamp < m_end)
+                rows = session.execute(select(table.c.timestamp,
+                    table.c.value).where(where).order_by(
+                    table.c.timestamp)).fetchall()
+                if not rows:
+                    continue
+                t, v = zip(*rows)
+                archive.append(sensor_id, year, month,
+                        np.array(t, dtype='datetime64[ms]').astype(np.int64),
+                        np.array(v, dtype=np.float64))
+                session.execute(table.delete().where(where))
+                session.commit()
+                archived += len(rows)
+        logging.info("Archived measurements of {:04d}-{:02d}.".format(
+            year, month))
+        year, month = year + month // 12, month % 12 + 1
+
+    session.close()
+    return archived
+
+
+def create_archive(config=None):
+    """
+    Creates the archive described by the storage section of the
+    configuration.
+
+    :param config: The storage section of the configuration
+    :return: A SegmentArchive, or None if archiving is not configured
+    """
+    archive_config = (config or {}).get('archive')
+    if not archive_config:
+        return None
+    return SegmentArchive(os.path.expanduser(archive_config['directory']))
+
+
+def main():
+    # The storage module depends on this one, so it is imported here.
+    from .storage import create_storage
+
+    config = load_config()
+    if config.get('logging'):
+        dictConfig(config['logging'])
+
+    storage_config = config.get('storage', {})
+    if not storage_config.get('archive'):
+        logging.error("Archive configuration not found! Exiting...")
+        sys.exit(1)
+
+    sessionmaker = create_sessionmaker(get_connection_string(config),
+            config.get('sqlite'), pool_config=config.get('pool'))
+    storage = create_storage(sessionmaker, storage_config)
+    archived = archive(sessionmaker, storage, storage.archive,
+            storage_config['archive'].get('older_than', 365))
+    logging.info("{} measurements archived.".format(archived))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# server-side caches for measurement queries
+
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import func, select
+
+from .db import DataChange
+from .query import fetch_columns, to_epoch_ms
+from .rollup import RESOLUTIONS
+
+
+# Rows this close to the high water mark are re-read on every refresh. Besides
+# open rollup buckets, this covers timestamps stored with second resolution,
+# which compare as strings on SQLite.
+_OVERLAP_MS = 1000
+
+
+def _to_datetime(ms):
+    return datetime.utcfromtimestamp(ms / 1000)
+
+
+class SeriesCache():
+    """
+    Per-sensor cache of measurement series for a sliding time window. Cached
+    series are extended with rows newer than their last timestamp (the high
+    water mark), and rows that fell out of the window are dropped, so a
+    refresh only reads what is new since the previous one. The last cached
+    point is always re-read, because rollup buckets keep changing until they
+    are complete. Measurements stored behind the high water mark (by imports,
+    replication or rollup rebuilds) are found in the data_changes log, and the
+    series of their sensors are cut back to where they changed, so that part
+    is read again.
+
+    The cache is shared by all dashboard sessions. Refreshes are serialized,
+    so concurrent sessions never merge the same rows twice.
+    """
+    def __init__(self, storage=None, max_bytes=64*1024*1024):
+        """
+        Constructs a new 'SeriesCache' object.
+
+        :param storage: The storage object raw measurements are read from
+        :param max_bytes: Memory cap for the cached arrays. Least recently
+            used series are evicted when it is exceeded.
+        """
+        self._storage = storage
+        self._max_bytes = max_bytes
+        self._series = OrderedDict()
+        self._last_change = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'rows_fetched': 0,
+        }
+
+    def get(self, session, sensor_ids, start, end, resolution):
+        """
+        Returns the series of the sensors between start and end, fetching only
+        the rows that are not cached yet.
+
+        :param session: A database session
+        :param sensor_ids: The sensors to query
+        :param start: Start of the window (UTC)
+        :param end: End of the window (UTC)
+        :param resolution: 'raw' or one of the keys of rollup.RESOLUTIONS
+        :return: A dict that maps sensor ids to (timestamps, values) arrays
+        """
+        start_ms = to_epoch_ms(start)
+        with self._lock:
+            self._apply_changes(session)
+            since = {}
+            for sensor_id in sensor_ids:
+                cached = self._series.get((sensor_id, resolution))
+                if cached is not None and cached[0] <= start_ms:
+                    timestamps = cached[1]
+                    hwm = timestamps[-1] if len(timestamps) else start_ms
+                    since[sensor_id] = _to_datetime(hwm - _OVERLAP_MS)
+                    self._counters['hits'] += 1
+                else:
+                    self._counters['misses'] += 1
+
+            fetched = fetch_columns(session, sensor_ids, start, end,
+                    resolution, since, self._storage)
+
+            result = {}
+            for sensor_id, (timestamps, values) in fetched.items():
+                key = (sensor_id, resolution)
+                self._counters['rows_fetched'] += len(timestamps)
+                if sensor_id in since:
+                    _, old_t, old_v = self._series[key]
+                    keep = np.searchsorted(old_t,
+                            to_epoch_ms(since[sensor_id]))
+                    timestamps = np.concatenate((old_t[:keep], timestamps))
+                    values = np.concatenate((old_v[:keep], values))
+                first = np.searchsorted(timestamps, start_ms)
+                timestamps, values = timestamps[first:], values[first:]
+                self._series[key] = (start_ms, timestamps, values)
+                self._series.move_to_end(key)
+                result[sensor_id] = (timestamps, values)
+
+            self._evict()
+            return result
+
+    def stats(self):
+        """
+        Returns a snapshot of the cache counters.
+
+        :return: A dict with hits, misses, evictions, rows fetched, and the
+            number of series and bytes cached
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['series'] = len(self._series)
+            stats['bytes'] = self._bytes()
+        return stats
+
+    def clear(self):
+        """Drops every cached series."""
+        with self._lock:
+            self._series.clear()
+
+    def _apply_changes(self, session):
+        """Cuts the cached series back to the changes logged since the
+        previous refresh."""
+        if self._last_change is None:
+            # Nothing is cached yet, so earlier changes do not matter.
+            self._last_change = session.execute(select(
+                func.max(DataChange.id))).scalar() or 0
+            return
+        first = session.execute(select(func.min(DataChange.id))).scalar()
+        if first is not None and first > self._last_change + 1:
+            # Entries not seen yet were pruned, so any series may be stale.
+            self._series.clear()
+        for change_id, sensor_id, changed in session.execute(
+                select(DataChange.id, DataChange.sensor_id, DataChange.start).
+                where(DataChange.id > self._last_change).order_by(
+                    DataChange.id)):
+            self._last_change = change_id
+            for key in [k for k in self._series if k[0] == sensor_id]:
+                window_start, timestamps, values = self._series[key]
+                # Rollup buckets that contain the change are read again too.
+                cut = to_epoch_ms(changed)
+                if key[1] != 'raw':
+                    cut -= int(RESOLUTIONS[key[1]][1].total_seconds() * 1000)
+                keep = np.searchsorted(timestamps, cut)
+                self._series[key] = (window_start, timestamps[:keep],
+                        values[:keep])
+
+    def _bytes(self):
+        return sum(t.nbytes + v.nbytes for _, t, v in self._series.values())
+
+    def _evict(self):
+        size = self._bytes()
+        while size > self._max_bytes and self._series:
+            _, (_, t, v) = self._series.popitem(last=False)
+            size -= t.nbytes + v.nbytes
+            self._counters['evictions'] += 1
+
+
+class FileCache():
+    """
+    Cache of encoded query results in a directory, shared by the worker
+    processes of the dashboard. Entries are keyed by the query (window and
+    resolution), and are fresh for ttl seconds. When an entry expires, one
+    worker computes it while holding a lock file, and the others wait for the
+    result instead of running the same query.
+    """
+    def __init__(self, directory, ttl=60):
+        """
+        Constructs a new 'FileCache' object.
+
+        :param directory: The cache directory, created if it does not exist
+        :param ttl: Seconds an entry is fresh for
+        """
+        self._directory = directory
+        self._ttl = ttl
+        self._counters = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key, compute):
+        """
+        Returns the cached value of a key, or computes and caches it.
+
+        :param key: A tuple of the query parameters
+        :param compute: A function that returns the value as bytes
+        :return: The value as bytes
+        """
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        path = os.path.join(self._directory, name)
+        entry = self._read(path)
+        hit = entry is not None
+        if not hit:
+            with open(path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # Another worker may have computed it while we waited.
+                    entry = self._read(path)
+                    if entry is None:
+                        self._write(path, compute())
+                        entry = self._read(path, fresh_only=False)
+                    else:
+                        hit = True
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        with self._lock:
+            self._counters['hits' if hit else 'misses'] += 1
+        return entry
+
+    def stats(self):
+        """Returns the number of hits and misses of this process."""
+        with self._lock:
+            return dict(self._counters)
+
+    def _read(self, path, fresh_only=True):
+        try:
+            with open(path, 'rb') as f:
+                age = time.time() - os.fstat(f.fileno()).st_mtime
+                if fresh_only and age > self._ttl:
+                    return None
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, data):
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
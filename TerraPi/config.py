@@ -0,0 +1,65 @@
+# configuration loading
+
+import logging
+import pkg_resources
+import sys
+import yaml
+from os.path import expanduser, isfile
+
+
+def find_config(argv=None):
+    """
+    Returns the path of the first configuration file found. The locations
+    searched are the first command line argument, ~/.terrapi.yaml,
+    ~/.config/terrapi/config.yaml and the sample config in the package.
+
+    :param argv: Command line arguments (sys.argv by default)
+    :return: The path of the configuration file, or None
+    """
+    argv = sys.argv if argv is None else argv
+    config_paths = []
+    if len(argv) > 1:
+        config_paths.append(argv[1])
+    config_paths.append(expanduser('~') + '/.terrapi.yaml')
+    config_paths.append(expanduser('~') + '/.config/terrapi/config.yaml')
+    config_paths.append(pkg_resources.resource_filename('TerraPi',
+        'conf/config-sample.yaml'))
+    for path in config_paths:
+        if isfile(path):
+            return path
+    return None
+
+
+def load_config(argv=None):
+    """
+    Finds and parses the configuration file. Exits if there is none, or if it
+    is empty.
+
+    :param argv: Command line arguments (sys.argv by default)
+    :return: The configuration as a dict
+    """
+    configfile = find_config(argv)
+    if not configfile:
+        logging.error("No config file found! Exiting..")
+        sys.exit(1)
+    with open(configfile, 'r') as stream:
+        config = yaml.safe_load(stream)
+    if not config:
+        logging.error("Empty configuration! Exiting...")
+        sys.exit(1)
+    return config
+
+
+def get_connection_string(config):
+    """
+    Returns the database connection string from the configuration, or the
+    default SQLite database under the package directory.
+
+    :param config: The configuration as a dict
+    """
+    connection_string = config.get('connection_string')
+    if not connection_string:
+        logging.info("Database configuration not found, using SQLite.")
+        database = pkg_resources.resource_filename('TerraPi','data/terrapi.db')
+        connection_string = 'sqlite:///{}'.format(database)
+    return connection_string
@@ -1,23 +1,30 @@
 #!/usr/bin/env python3
 
 import json
-import logging
+import os
+import time
 import pkg_resources
-import pytz
-import sys
 import tzlocal
-import yaml
 from datetime import datetime, timedelta
-from os.path import expanduser, isfile
 
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
+import flask
 import plotly
 import plotly.graph_objs as go
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output
 
-from .db import create_sessionmaker, Measurement, Sensor, SensorType
+from .api import create_blueprint
+from .config import get_connection_string, load_config
+from .db import create_sessionmaker, Sensor
+from .cache import FileCache, SeriesCache
+from .downsample import budgets, downsample
+from .metrics import CONTENT_TYPE, REGISTRY, Histogram
+from .query import decode_columns, encode_columns, fetch_columns, \
+        first_timestamp, local_to_utc, to_epoch_ms, utc_to_local
+from .rollup import RESOLUTIONS, choose_resolution, truncate
+from .storage import create_storage
 
 
 colors = [
@@ -34,35 +41,268 @@ colors = [
 ]
 
 
-app = dash.Dash(__name__)
-app.layout = html.Div([
-    html.H1('TerraPi dashboard'),
-    dcc.Interval(
-        id = 'interval-component',
-        interval = 5 * 60 * 1000,
-        n_intervals = 0
-    ),
-    html.Div(id='intermediate-value', style={'display': 'none'})
-])
+QUERY_DURATION = Histogram('terrapi_dashboard_query_duration_seconds',
+        'Time to fetch the measurements of a dashboard refresh',
+        ['resolution'])
 
 
-def generate_update_func(sensor_type):
-    def update_graph_live(measurements_json, relayout_data):
-        global sensors
+class DashboardData():
+    """
+    The data side of the dashboard: the sensors, the caches, and the
+    measurement query of the refresh callback. Every worker process of the
+    dashboard has its own instance.
+
+    :config window: Days of measurements shown
+    :config min_points: Minimum points per sensor when choosing a resolution
+    :config cache_size: Memory cap of the series cache in megabytes
+    :config shared_cache: Directory of the query cache shared by workers
+    :config shared_cache_ttl: Seconds a shared cache entry is fresh for
+    """
+    def __init__(self, config, sessionmaker=None):
+        """
+        Constructs a new 'DashboardData' object.
+
+        :param config: The configuration as a dict
+        :param sessionmaker: The sessionmaker to use instead of connecting to
+            the database of the configuration
+        """
+        dashboard_config = config.get('dashboard', {})
+        self.sessionmaker = sessionmaker or create_sessionmaker(
+                get_connection_string(config), config.get('sqlite'),
+                readonly=True, pool_config=config.get('pool'))
+        self.window = timedelta(days=dashboard_config.get('window', 30))
+        self.min_points = dashboard_config.get('min_points', 500)
+        self.budget = budgets(dashboard_config)
+        self.storage = create_storage(self.sessionmaker, config.get('storage'))
+        self.cache = SeriesCache(self.storage,
+                dashboard_config.get('cache_size', 64) * 1024 * 1024)
+        self.shared_cache = None
+        if dashboard_config.get('shared_cache'):
+            self.shared_cache = FileCache(
+                    os.path.expanduser(dashboard_config['shared_cache']),
+                    dashboard_config.get('shared_cache_ttl', 60))
+
+        session = self.sessionmaker()
+        self.sensors = session.query(Sensor).all()
+        session.close()
+
+    def measurements(self):
+        """
+        Returns the measurements of every sensor in the window as JSON created
+        by encode_columns, from the shared cache if there is one.
+        """
+        end = datetime.utcnow()
+        start = end - self.window
+        resolution = choose_resolution(start, end, self.min_points)
+        if self.shared_cache is None:
+            return self.query(start, end, resolution)
+        key = ('measurements', self.window.total_seconds(), resolution)
+        return self.shared_cache.get(key, lambda: self.query(start, end,
+            resolution).encode()).decode()
+
+    def query(self, start, end, resolution):
+        """
+        Queries the measurements of every sensor between start and end, and
+        returns them downsampled, in local time, as JSON created by
+        encode_columns.
+        """
+        t = time.perf_counter()
+        session = self.sessionmaker()
+        columns = self.cache.get(session, [s.id for s in self.sensors], start,
+                end, resolution)
+        session.close()
+        QUERY_DURATION.labels(resolution=resolution).observe(
+                time.perf_counter() - t)
+        return self._encode(columns, resolution)
+
+    def range_measurements(self, sensor_ids, start=None, end=None):
+        """
+        Returns the measurements of some sensors in a time range, at the
+        resolution that suits the span of the range, for zoomed figures. The
+        range is widened to whole buckets, so the shared cache can serve
+        repeated zooms to about the same range.
+
+        :param sensor_ids: The sensors to query
+        :param start: Start of the range in local time, or None for the first
+            measurement of the sensors
+        :param end: End of the range in local time, or None for now
+        :return: JSON created by encode_columns
+        """
+        local_tz = tzlocal.get_localzone()
+        end = local_to_utc(end, local_tz) if end else datetime.utcnow()
+        if start:
+            start = local_to_utc(start, local_tz)
+        else:
+            session = self.sessionmaker()
+            start = first_timestamp(session, sensor_ids) or end - self.window
+            session.close()
+        resolution = choose_resolution(start, end, self.min_points)
+        bucket = resolution if resolution != 'raw' else 'minute'
+        start = truncate(start, bucket)
+        end = truncate(end, bucket) + RESOLUTIONS[bucket][1]
+
+        def query():
+            t = time.perf_counter()
+            session = self.sessionmaker()
+            columns = fetch_columns(session, sensor_ids, start, end,
+                    resolution, storage=self.storage)
+            session.close()
+            QUERY_DURATION.labels(resolution=resolution).observe(
+                    time.perf_counter() - t)
+            return self._encode(columns, resolution)
+
+        if self.shared_cache is None:
+            return query()
+        key = ('range', tuple(sorted(sensor_ids)), start, end, resolution)
+        return self.shared_cache.get(key,
+                lambda: query().encode()).decode()
+
+    def _encode(self, columns, resolution):
+        """
+        Downsamples columns, converts them to local time, and encodes them.
+        Columns of raw measurements that are not downsampled are marked, so
+        live.js appends new measurements to those, and to the live tail
+        traces of the others.
+        """
+        local_tz = tzlocal.get_localzone()
+        types = {s.id: s.type.name for s in self.sensors}
+        raw = set()
+        for sensor_id, (timestamps, values) in columns.items():
+            budget = self.budget(types[sensor_id])
+            if resolution == 'raw' and len(timestamps) <= budget:
+                raw.add(sensor_id)
+            timestamps, values = downsample(timestamps, values, budget)
+            columns[sensor_id] = (utc_to_local(timestamps, local_tz), values)
+        return encode_columns(columns, raw=raw)
+
+    def updates(self, cursor=None):
+        """
+        Returns the raw measurements newer than a cursor, for dashboards that
+        can not receive them from the push stream of TerraPi.
+
+        :param cursor: A dict that maps sensor ids to the UTC epoch
+            milliseconds of the last measurement the client has, as returned
+            by the previous call. Without a cursor no measurements are
+            returned, only a cursor that starts now.
+        :return: A dict with the new cursor, and a dict that maps sensor ids
+            to [utc, local, values] lists, like the push stream
+        :raise TypeError: If the cursor is not a dict of numbers
+        :raise ValueError: If a sensor id of the cursor is not a number
+        """
+        now = datetime.utcnow()
+        if cursor is None:
+            return {'cursor': {str(s.id): to_epoch_ms(now)
+                for s in self.sensors}, 'columns': {}}
+        if not isinstance(cursor, dict):
+            raise TypeError("The cursor must be an object.")
+
+        epoch = datetime(1970, 1, 1)
+        known = set(s.id for s in self.sensors)
+        since = {int(sensor_id): epoch + timedelta(milliseconds=ms + 1)
+                for sensor_id, ms in cursor.items() if int(sensor_id) in known}
+        if not since:
+            return {'cursor': cursor, 'columns': {}}
+        session = self.sessionmaker()
+        columns = fetch_columns(session, list(since), min(since.values()),
+                now, 'raw', since, self.storage)
+        session.close()
+
+        local_tz = tzlocal.get_localzone()
+        cursor = dict(cursor)
+        result = {}
+        for sensor_id, (timestamps, values) in columns.items():
+            if not len(timestamps):
+                continue
+            cursor[str(sensor_id)] = int(timestamps[-1])
+            result[str(sensor_id)] = [timestamps.tolist(),
+                    utc_to_local(timestamps, local_tz).tolist(),
+                    values.round(3).tolist()]
+        return {'cursor': cursor, 'columns': result}
+
+    def collect_metrics(self):
+        stats = self.cache.stats()
+        families = [
+            ('terrapi_dashboard_cache_requests_total', 'counter',
+                'Series requested from the dashboard cache',
+                [({'result': 'hit'}, stats['hits']),
+                    ({'result': 'miss'}, stats['misses'])]),
+            ('terrapi_dashboard_rows_fetched_total', 'counter',
+                'Rows read from the database by the dashboard',
+                [({}, stats['rows_fetched'])]),
+            ('terrapi_dashboard_cache_bytes', 'gauge',
+                'Memory used by cached series', [({}, stats['bytes'])]),
+        ]
+        if self.shared_cache is not None:
+            shared = self.shared_cache.stats()
+            families.append(('terrapi_dashboard_shared_cache_requests_total',
+                'counter', 'Queries requested from the shared cache',
+                [({'result': 'hit'}, shared['hits']),
+                    ({'result': 'miss'}, shared['misses'])]))
+        return families
+
+
+def _x_range(relayout_data):
+    """
+    Returns the (start, end) local datetimes of the x axis range set by
+    zooming, panning or a range selector button, (None, None) if the axis was
+    reset to show everything, and None if the range was not changed.
+    """
+    if 'xaxis.range[0]' in relayout_data:
+        x_range = [relayout_data['xaxis.range[0]'],
+                relayout_data['xaxis.range[1]']]
+    elif 'xaxis.range' in relayout_data:
+        x_range = relayout_data['xaxis.range']
+    elif relayout_data.get('xaxis.autorange'):
+        return None, None
+    else:
+        return None
+    return tuple(datetime.fromisoformat(str(x).replace('T', ' ')[:26])
+            for x in x_range)
+
+
+def generate_update_func(sensor_type, dashboard_data):
+    sensors = dashboard_data.sensors
+    sensor_ids = [s.id for s in sensors if s.type==sensor_type]
 
-        m = json.loads(measurements_json)
-        sensor_ids = [s.id for s in sensors if s.type==sensor_type]
+    def update_graph_live(measurements_json, relayout_data):
+        relayout_data = relayout_data or {}
+        x_range = _x_range(relayout_data)
+        raw = set()
+        if x_range is None:
+            m = decode_columns(measurements_json, raw)
+        else:
+            m = decode_columns(dashboard_data.range_measurements(sensor_ids,
+                *x_range), raw)
         data = []
+        tails = []
         i = 0
         for sensor_id in sensor_ids:
+            timestamps, values = m[sensor_id]
+            name = [s.name for s in sensors if s.id==sensor_id][0]
             data.append(go.Scatter(
-                x = m[str(sensor_id)]['timestamp'],
-                y = m[str(sensor_id)]['value'],
-                name = [s.name for s in sensors if s.id==sensor_id][0],
+                x = timestamps.astype('datetime64[ms]'),
+                y = values,
+                name = name,
                 mode = 'lines',
+                # Tells live.js whether new measurements can be appended.
+                uid = '{}:{}'.format(sensor_id,
+                    'raw' if sensor_id in raw else 'summary'),
+                line = dict(color=colors[i%len(colors)])
+            ))
+            # live.js appends new measurements of summarized sensors to their
+            # tail, which starts at the last summary point.
+            last = slice(0, 0) if sensor_id in raw else slice(-1, None)
+            tails.append(go.Scatter(
+                x = timestamps[last].astype('datetime64[ms]'),
+                y = values[last],
+                name = name,
+                mode = 'lines',
+                showlegend = False,
+                uid = '{}:live'.format(sensor_id),
                 line = dict(color=colors[i%len(colors)])
             ))
             i = i + 1
+        data.extend(tails)
 
         layout = go.Layout(
             title = sensor_type.name.capitalize(),
@@ -70,10 +310,8 @@ def generate_update_func(sensor_type):
             legend = dict(x=0, y=1, xanchor='left'),
             xaxis = dict(
                 type = 'date',
-                range = [
-                    relayout_data['xaxis.range[0]'],
-                    relayout_data['xaxis.range[1]']
-                ] if 'xaxis.range[0]' in relayout_data else None,
+                range = [str(x) for x in x_range]
+                    if x_range and x_range[0] else None,
                 rangeselector = dict(
                     buttons = list([
                         dict(count=1, label='1 day', step='day', stepmode='backward'),
@@ -92,90 +330,128 @@ def generate_update_func(sensor_type):
     return update_graph_live
 
 
-@app.callback(
-    Output('intermediate-value', 'children'),
-    [Input('interval-component', 'n_intervals')])
-def update_measurements(n):
-    global sensors
-    global sessionmaker
-
-    measurements = dict()
-    session = sessionmaker()
-    one_day = timedelta(hours=30*24)
-    local_tz = tzlocal.get_localzone()
-
-    for sensor in sensors:
-        measurements[sensor.id] = dict()
-        _data = session.query(Measurement).filter(
-                Measurement.sensor==sensor).filter(
-                Measurement.timestamp>datetime.now()-one_day).order_by(
-                Measurement.timestamp).all()
-        measurements[sensor.id]['timestamp'] = [
-                m.timestamp.replace(tzinfo=pytz.utc).astimezone(local_tz) for m in _data]
-        measurements[sensor.id]['value'] = [m.value for m in _data]
-
-    session.close()
-    
-    return json.dumps(measurements, default=str)
-
-
-def get_connection_string():
-    config_paths = []
-    if len(sys.argv) > 1:
-        config_paths.append(sys.argv[1])
-    config_paths.append(expanduser('~') + '/.terrapi.yaml')
-    config_paths.append(expanduser('~') + '/.config/terrapi/config.yaml')
-    config_paths.append(pkg_resources.resource_filename('TerraPi',
-        'conf/config-sample.yaml'))
-    for path in config_paths:
-        if isfile(path):
-            configfile = path
-            break
-    if not configfile:
-        logging.error("No config file found! Exiting..")
-        sys.exit(1)
-    with open(configfile, 'r') as stream:
-        config = yaml.load(stream)
-    if not config:
-        logging.error("Empty configuration! Exiting...")
-        sys.exit(1)
-
-    connection_string = config.get('connection_string')
-    if not connection_string:
-        logging.info("Database configuration not found, using SQLite.")
-        database = pkg_resources.resource_filename('TerraPi','data/terrapi.db')
-        connection_string = 'sqlite:///{}'.format(database)
-
-    return connection_string
+def _add_etag(response):
+    """
+    Adds an ETag to successful GET responses, and turns them into 304 Not
+    Modified responses if the client already has the same content. Streamed
+    responses are left alone, since hashing them would buffer them.
+    """
+    if flask.request.method == 'GET' and response.status_code == 200 and \
+            not response.direct_passthrough and not response.is_streamed:
+        response.add_etag()
+        response.make_conditional(flask.request)
+    return response
 
 
-def main():
-    global sensors
-    global sessionmaker
-
-    connection_string = get_connection_string()
-    sessionmaker = create_sessionmaker(connection_string)
-
-    session = sessionmaker()
-    sensors = session.query(Sensor).all()
-    for s in sensors:
-        app.layout.children.append(
-                html.Div(
-                    children = dcc.Graph(id = s.type.name),
-                    style = dict(
-                        marginBottom = 80,
-                        marginTop = 80)
-                ))
-    session.close()
-
-    for st in set([s.type for s in sensors]):
+def create_app(config):
+    """
+    Creates the dashboard.
+
+    :param config: The configuration as a dict
+    :return: A Dash app. Its server attribute is the WSGI application.
+    """
+    dashboard_config = config.get('dashboard', {})
+    data = DashboardData(config)
+    sensor_types = sorted(set(s.type for s in data.sensors),
+            key=lambda t: t.value)
+
+    app = dash.Dash(__name__)
+    app.scripts.append_script({'external_url': '/live.js'})
+    app.layout = html.Div([
+        html.H1('TerraPi dashboard'),
+        dcc.Interval(
+            id = 'interval-component',
+            interval = dashboard_config.get('refresh_interval', 5) * 60 * 1000,
+            n_intervals = 0
+        ),
+        html.Div(id='intermediate-value', style={'display': 'none'})
+    ] + [
+        html.Div(
+            children = dcc.Graph(id = st.name),
+            style = dict(
+                marginBottom = 80,
+                marginTop = 80)
+        ) for st in sensor_types
+    ])
+
+    app.callback(
+        Output('intermediate-value', 'children'),
+        [Input('interval-component', 'n_intervals')]
+    )(lambda n: data.measurements())
+
+    for st in sensor_types:
         app.callback(
             Output(st.name, 'figure'),
-            [Input('intermediate-value', 'children')],
-            [State(st.name, 'relayoutData')]
-        )(generate_update_func(st))
+            [Input('intermediate-value', 'children'),
+                Input(st.name, 'relayoutData')]
+        )(generate_update_func(st, data))
+
+    server = app.server
+    server.after_request(_add_etag)
 
-    app.run_server(debug=True)
+    @server.route('/measurements')
+    def measurements():
+        return flask.Response(data.measurements(),
+                content_type='application/json')
+
+    @server.route('/updates')
+    def updates():
+        cursor = flask.request.args.get('cursor')
+        try:
+            return flask.jsonify(data.updates(json.loads(cursor) if cursor
+                else None))
+        except (ValueError, KeyError, TypeError) as e:
+            return flask.jsonify({'error': str(e)}), 400
+
+    # Where the points of every sensor go in the figures, for live.js: the
+    # figure, the index of its trace, and the index of its live tail trace.
+    traces = {}
+    for st in sensor_types:
+        sensor_ids = [s.id for s in data.sensors if s.type==st]
+        for i, sensor_id in enumerate(sensor_ids):
+            traces[str(sensor_id)] = [st.name, i, len(sensor_ids) + i]
+
+    @server.route('/live.js')
+    def live_js():
+        live_config = {
+            'url': dashboard_config.get('live_url'),
+            'poll_interval': dashboard_config.get('poll_interval', 10),
+            'debounce': dashboard_config.get('zoom_debounce', 300),
+            # The figures show local time, the cursor is in UTC.
+            'utc_offset': datetime.now(tzlocal.get_localzone()).utcoffset() //
+                timedelta(milliseconds=1),
+            'traces': traces,
+        }
+        script = pkg_resources.resource_string('TerraPi', 'static/live.js')
+        return flask.Response('var TERRAPI_LIVE = {};\n{}'.format(
+            json.dumps(live_config), script.decode()),
+            content_type='application/javascript')
+
+    @server.route('/cache-stats')
+    def cache_stats():
+        stats = data.cache.stats()
+        if data.shared_cache is not None:
+            stats['shared'] = data.shared_cache.stats()
+        return flask.jsonify(stats)
+
+    @server.route('/metrics')
+    def metrics():
+        return flask.Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    server.register_blueprint(create_blueprint(data, dashboard_config))
+
+    REGISTRY.register_collector(data.collect_metrics)
+    app.data = data
+    return app
+
+
+def main():
+    config = load_config()
+    dashboard_config = config.get('dashboard', {})
+    app = create_app(config)
+    app.run_server(debug=dashboard_config.get('debug', False),
+            host=dashboard_config.get('host', '127.0.0.1'),
+            port=dashboard_config.get('port', 8050))
 
 
 if __name__ == '__main__':
@@ -1,12 +1,16 @@
 # database module
 
+import calendar
 import enum
+from datetime import datetime, timedelta
 
-from sqlalchemy import Column, Enum, ForeignKey, Integer, Float, String, \
-        DateTime, UniqueConstraint
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import BigInteger, Column, Enum, ForeignKey, Integer, Float, \
+        String, DateTime, TypeDecorator, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import relationship, sessionmaker, scoped_session
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.sql import func
 
 
@@ -36,9 +40,215 @@ class Measurement(Base):
     sensor = relationship(Sensor)
     value = Column(Float, nullable=False)
 
-def create_sessionmaker(conn_string):
-    engine = create_engine(conn_string)
-    Base.metadata.create_all(engine)
+class EpochMillis(TypeDecorator):
+    """
+    A timestamp stored as an integer of UTC epoch milliseconds. Naive UTC
+    datetimes are converted on the way in and out, so queries written for
+    DateTime columns work unchanged. Readers that want the integers can select
+    them with type_coerce(column, BigInteger).
+    """
+    impl = BigInteger
+    cache_ok = True
+    _epoch = datetime(1970, 1, 1)
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime):
+            return calendar.timegm(value.timetuple()) * 1000 + \
+                    value.microsecond // 1000
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self._epoch + timedelta(milliseconds=value)
+
+class EpochMeasurement(Base):
+    """
+    Measurements with epoch millisecond timestamps, used instead of the
+    measurements table if the timestamps storage setting is epoch_ms.
+    """
+    __tablename__ = 'measurements_ms'
+    sensor_id = Column(Integer, ForeignKey('sensors.id'), primary_key=True)
+    timestamp = Column(EpochMillis, primary_key=True)
+    sensor = relationship(Sensor)
+    value = Column(Float, nullable=False)
+
+class ReplicationMark(Base):
+    """
+    The high-water mark of store-and-forward replication: the largest SQLite
+    rowid of a raw measurement table of a node that is stored in this
+    (central) database.
+    """
+    __tablename__ = 'replication_marks'
+    node = Column(String(64), primary_key=True)
+    source = Column(String(64), primary_key=True)
+    rowid = Column(BigInteger, nullable=False)
+
+class DataChange(Base):
+    """
+    A log of measurements stored behind the live edge (by imports,
+    replication and rollup rebuilds), so the dashboard caches can re-read the
+    series of a sensor from start on. Entries are kept for a day.
+    """
+    __tablename__ = 'data_changes'
+    id = Column(Integer, primary_key=True)
+    sensor_id = Column(Integer, nullable=False)
+    start = Column(DateTime, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+def record_changes(session, changes):
+    """
+    Logs that measurements of sensors changed, and prunes entries older than
+    a day. The caller is responsible for committing the session.
+
+    :param session: A database session
+    :param changes: A dict that maps sensor ids to the earliest changed
+        timestamp (UTC)
+    """
+    if not changes:
+        return
+    # Entries are added before pruning, so the table never becomes empty, and
+    # ids are not reused on SQLite.
+    session.execute(DataChange.__table__.insert(), [
+        {'sensor_id': sensor_id, 'start': start}
+        for sensor_id, start in changes.items()])
+    session.execute(DataChange.__table__.delete().where(
+        DataChange.created < datetime.utcnow() - timedelta(days=1)))
+
+class RollupMixin():
+    """
+    Common columns of the rollup tables. Each row aggregates the measurements of
+    one sensor in one time bucket. The average is total / count.
+    """
+    @declared_attr
+    def sensor_id(cls):
+        return Column(Integer, ForeignKey('sensors.id'), primary_key=True)
+
+    bucket = Column(DateTime, primary_key=True)
+    minimum = Column(Float, nullable=False)
+    maximum = Column(Float, nullable=False)
+    total = Column(Float, nullable=False)
+    count = Column(Integer, nullable=False)
+
+class MinuteRollup(RollupMixin, Base):
+    __tablename__ = 'measurements_minute'
+
+class HourRollup(RollupMixin, Base):
+    __tablename__ = 'measurements_hour'
+
+class DayRollup(RollupMixin, Base):
+    __tablename__ = 'measurements_day'
+
+def get_or_create_sensors(session, sensors):
+    """
+    Looks up sensors by name and type, and creates the missing ones, with one
+    query for the lookup and one bulk insert. The caller is responsible for
+    committing the session.
+
+    :param session: A database session
+    :param sensors: A list of (name, type, description) tuples
+    :return: A dict that maps (name, type) tuples to sensor ids
+    """
+    wanted = {(name, sensor_type): description
+            for name, sensor_type, description in sensors}
+    names = sorted(set(name for name, _ in wanted))
+
+    def lookup():
+        # Names are looked up in chunks to stay below the bound parameter
+        # limit of SQLite.
+        ids = {}
+        for i in range(0, len(names), 500):
+            chunk = names[i:i+500]
+            for sensor_id, name, sensor_type in session.query(Sensor.id,
+                    Sensor.name, Sensor.type).filter(Sensor.name.in_(chunk)):
+                if (name, sensor_type) in wanted:
+                    ids.setdefault((name, sensor_type), sensor_id)
+        return ids
+
+    ids = lookup() if names else {}
+    missing = [{'name': name, 'type': sensor_type, 'description': description}
+            for (name, sensor_type), description in wanted.items()
+            if (name, sensor_type) not in ids]
+    if missing:
+        session.execute(Sensor.__table__.insert(), missing)
+        ids = lookup()
+    return ids
+
+def _is_sqlite_file(url):
+    return url.get_backend_name() == 'sqlite' and \
+            url.database not in (None, '', ':memory:')
+
+def _create_sqlite_engine(url, config, readonly):
+    """
+    Creates an engine for an SQLite database file in WAL mode. Writers share a
+    single connection, so inserts are serialized in the process instead of
+    fighting over the database lock. Read-only engines get a pool of
+    connections opened with mode=ro, which WAL lets run concurrently with the
+    writer.
+    """
+    if readonly:
+        engine = create_engine(
+                'sqlite:///file:{}?mode=ro&uri=true'.format(url.database),
+                poolclass=QueuePool,
+                pool_size=config.get('readers', 4),
+                connect_args={'check_same_thread': False,
+                    'timeout': config.get('busy_timeout', 30)})
+    else:
+        engine = create_engine(url,
+                poolclass=QueuePool, pool_size=1, max_overflow=0,
+                pool_timeout=config.get('writer_timeout', 60),
+                connect_args={'check_same_thread': False,
+                    'timeout': config.get('busy_timeout', 30)})
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not readonly:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous={}'.format(
+            config.get('synchronous', 'NORMAL')))
+        cursor.execute('PRAGMA cache_size=-{}'.format(
+            config.get('cache_size', 8192)))
+        if readonly:
+            cursor.execute('PRAGMA query_only=1')
+        cursor.close()
+
+    return engine
+
+def create_sessionmaker(conn_string, sqlite_config=None, readonly=False,
+        pool_config=None):
+    """
+    Creates the engine and the scoped session factory for a database.
+
+    :param conn_string: Database connection string
+    :param sqlite_config: The sqlite section of the configuration
+    :param readonly: True for processes that only read the database (e.g. the
+        dashboard)
+    :param pool_config: The pool section of the configuration, used for
+        database servers
+    """
+    url = make_url(conn_string)
+    sqlite_config = sqlite_config or {}
+    pool_config = pool_config or {}
+    if _is_sqlite_file(url) and sqlite_config.get('wal', True):
+        engine = _create_sqlite_engine(url, sqlite_config, readonly)
+    elif url.get_backend_name() == 'sqlite' and not _is_sqlite_file(url):
+        # An in-memory database only exists on the connection that created
+        # it, so the writer thread and the other threads have to share one.
+        engine = create_engine(conn_string, poolclass=StaticPool,
+                connect_args={'check_same_thread': False})
+    else:
+        # Sessions are opened and closed for every batch and refresh, so the
+        # connections are pooled, and checked before use to survive network
+        # blips and server-side timeouts.
+        engine = create_engine(conn_string,
+                pool_size=pool_config.get('size', 5),
+                max_overflow=pool_config.get('max_overflow', 10),
+                pool_timeout=pool_config.get('timeout', 30),
+                pool_recycle=pool_config.get('recycle', 3600),
+                pool_pre_ping=pool_config.get('pre_ping', True))
+    if not readonly:
+        Base.metadata.create_all(engine)
     session_factory = sessionmaker(bind=engine)
     Session = scoped_session(session_factory)
     return Session;
@@ -1,14 +1,65 @@
 import importlib
 import logging
+import threading
+import time
 import uuid
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime
 
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm.exc import NoResultFound
 
-from ..db import Sensor, Measurement
+from ..db import get_or_create_sensors
+from ..metrics import Histogram
+
+
+MEASURE_DURATION = Histogram('terrapi_measure_duration_seconds',
+        'Time spent in the _measure method of sensor devices', ['device'])
+
+
+# Driver modules by name, or the ImportError raised while importing them.
+_modules = {}
+
+
+def _import_driver(name):
+    """
+    Imports a module of the devices package. Every module is imported once,
+    failed imports are not retried either.
+
+    :param name: The module name relative to the devices package
+    """
+    if name not in _modules:
+        try:
+            _modules[name] = importlib.import_module('TerraPi.devices.' + name)
+        except ImportError as e:
+            _modules[name] = e
+    module = _modules[name]
+    if isinstance(module, ImportError):
+        raise module
+    return module
+
+
+def setup_sensors(sessionmaker, devices):
+    """
+    Retrieves the sensors of sensor devices from database, or creates them if
+    they do not exist yet, with one bulk lookup and one bulk insert for all of
+    the devices.
+
+    :param sessionmaker: The session factory
+    :param devices: A list of SensorDevice instances
+    """
+    session = sessionmaker()
+    try:
+        ids = get_or_create_sensors(session, [(d.name, t, d.description)
+            for d in devices for t in d._sensor_types])
+        session.commit()
+    finally:
+        session.close()
+    for device in devices:
+        device._sensors = {t: ids[(device.name, t)]
+                for t in device._sensor_types}
 
 
 class Device():
@@ -40,11 +91,14 @@ class Device():
         """
         Creates an APScheduler trigger from a schedule specification.
         
-        :param schedule: Schedule specification (minutes or cron-style)
+        :param schedule: Schedule specification (minutes or cron-style).
+            Fractional minutes give sub-minute periods, e.g. 0.25 for 15
+            seconds.
         :return: An APScheduler trigger
         """
         return {
             int: lambda: IntervalTrigger(minutes=schedule),
+            float: lambda: IntervalTrigger(seconds=schedule * 60),
             str: lambda: CronTrigger.from_crontab(schedule)
         }.get(type(schedule), None)()
 
@@ -59,7 +113,7 @@ class Device():
         clazz = None
         try:
             m,c = config.get('type','').split('.')
-            clazz = getattr(importlib.import_module('TerraPi.devices.'+m), c)
+            clazz = getattr(_import_driver(m), c)
         except KeyError:
             logging.error("Missing type from {}.".format(config))
         except ValueError:
@@ -90,6 +144,8 @@ class SensorDevice(Device, ABC):
     Abstract class that represents a sensor device.
 
     :config schedule: Period in minutes or cron-style schedule for measurements.
+    :config timeout: Deadline of a measurement in seconds. Only used by the
+        asyncio polling engine.
     """
     def __init__(self, app, config, sensor_types):
         """
@@ -104,6 +160,7 @@ class SensorDevice(Device, ABC):
 
         self._callbacks = {}
         self._sensors = {}
+        self._measure_duration = MEASURE_DURATION.labels(device=self.name)
         self._setup_sensors(sensor_types)
         self._setup_schedule(config)
 
@@ -114,30 +171,28 @@ class SensorDevice(Device, ABC):
         :param config: The config that describes the device
         """
         sched = config.get('schedule', 5)
-        self._app.scheduler.add_job(self._refresh,
-                trigger=self._parse_trigger(sched))
+        trigger = self._parse_trigger(sched)
+        if self._app.engine is not None:
+            self._app.engine.add(self, trigger, config.get('timeout'))
+        else:
+            self._app.scheduler.add_job(self._refresh, trigger=trigger,
+                    name=self.name)
 
     def _setup_sensors(self, sensor_types):
         """
         Retrieves the Device's sensors from database, or create them if they
-        do not exist yet.
+        do not exist yet. While TerrapiApp is creating its devices, this is
+        deferred, and done for all devices at once by setup_sensors.
 
         :param sensor_types: A list of SensorType values that specify what kind
             of measurements it can do
         """
-        session = self._app.sessionmaker()
-        for sensor_type in sensor_types:
-            try:
-                sensor = session.query(Sensor).filter(
-                        Sensor.name==self.name).filter(
-                        Sensor.type==sensor_type).one()
-            except NoResultFound:
-                sensor = Sensor(name=self.name, type=sensor_type,
-                        description=self.description)
-                session.add(sensor)
-                session.commit()
-            self._sensors[sensor_type] = sensor.id
-        session.close()
+        self._sensor_types = list(sensor_types)
+        pending = self._app.pending_sensor_devices
+        if pending is not None:
+            pending.append(self)
+        else:
+            setup_sensors(self._app.sessionmaker, [self])
 
     def add_callback(self, callback, sensor_type):
         """
@@ -158,26 +213,30 @@ class SensorDevice(Device, ABC):
                     device has no such sensor!".format(sensor_type, self.name))
 
     def _refresh(self):
-        """Handles database insertion and calls callbacks."""
-        session = self._app.sessionmaker()
-        for sensor_type, value in self._measure():
+        """Measures, and queues the measurements for storage and callbacks."""
+        timestamp = datetime.utcnow()
+        start = time.perf_counter()
+        measurements = self._measure()
+        self._measure_duration.observe(time.perf_counter() - start)
+        self._process(measurements, timestamp)
+
+    def _process(self, measurements, timestamp):
+        """
+        Queues measurements for database insertion, and for the callbacks on
+        the app's event bus.
+
+        :param measurements: The list returned by _measure
+        :param timestamp: The time _measure was called at (UTC)
+        """
+        for sensor_type, value in measurements:
             if not value:
                 logging.warn('Null value received as measurement!')
                 continue
 
-            session.add(Measurement(
-                sensor_id=self._sensors[sensor_type],
-                value=value))
+            self._app.writer.put(self._sensors[sensor_type], value, timestamp)
             if sensor_type in self._callbacks:
-                for callback in self._callbacks[sensor_type]:
-                    callback(value)
-        try:
-            session.commit()
-        except SQLAlchemyError:
-            logging.exception('Could not store measurement in database!')
-            session.rollback()
-        finally:
-            session.close()
+                self._app.events.publish(self.name,
+                        self._callbacks[sensor_type], value)
 
     @abstractmethod
     def _measure(self):
@@ -193,7 +252,25 @@ class ControllerDevice(Device, ABC):
     """
     Abstract class that represents a controller device.
 
+    The last value set on every channel is cached, and set_state skips
+    commands that would not change it. Since the hardware may be switched by
+    other means, the cached state is only trusted for recheck_interval
+    seconds. After that it is read back with read_state, or if the device can
+    not report its state, the next command is issued unconditionally.
+
+    Commands are executed by a worker thread of the controller, one at a
+    time, so the hardware is never accessed concurrently. Callers submit
+    commands without waiting for them. Commands for a channel that are still
+    queued when a new one arrives for the same channel are replaced by it.
+    When a command fails, the controller reconnects to the hardware with
+    exponential backoff and retries it, unless a newer command for the
+    channel has arrived in the meantime.
+
     :config controller: The controller device to use
+    :config recheck_interval: Seconds after which the cached state of a
+        channel is checked against the hardware
+    :config max_retries: Number of times a failed command is retried
+    :config max_backoff: Maximum seconds to wait between retries
     """
 
     def __init__(self, app, config):
@@ -204,6 +281,32 @@ class ControllerDevice(Device, ABC):
         :param config: The config that describes the device
         """
         super().__init__(app, config)
+        self._recheck_interval = config.get('recheck_interval', 600)
+        self._states = {}
+        # Serializes access to the hardware and the state cache.
+        self._state_lock = threading.Lock()
+        # Guards the counters only, so submit and stats never wait for the
+        # hardware.
+        self._lock = threading.Lock()
+        self._counters = {
+            'issued': 0,
+            'suppressed': 0,
+            'rechecks': 0,
+            'mismatches': 0,
+            'submitted': 0,
+            'coalesced': 0,
+            'errors': 0,
+            'reconnects': 0,
+        }
+
+        self._max_retries = config.get('max_retries', 5)
+        self._max_backoff = config.get('max_backoff', 60)
+        self._commands = OrderedDict()
+        self._commands_cond = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run,
+                name='{}-worker'.format(self.name), daemon=True)
+        self._worker.start()
 
     def init_channel(self, channel):
         """
@@ -212,11 +315,167 @@ class ControllerDevice(Device, ABC):
         """
         pass
 
+    def read_state(self, channel):
+        """
+        Returns the actual value of a channel read from the hardware. Should be
+        overridden in subclasses that can report their state.
+
+        :param channel: Which channel of the controller to read
+        :return: The value of the channel, or None if it is unknown
+        """
+        return None
+
+    def set_state(self, channel, value):
+        """
+        Sets the value of a channel, unless it is known to have that value
+        already.
+
+        :param channel: Which channel of the controller to use
+        :param value: The new value
+        :return: True if control was called, False if the command was
+            suppressed
+        """
+        with self._state_lock:
+            now = time.monotonic()
+            state = self._states.get(channel)
+            if state is not None and \
+                    now - state[1] >= self._recheck_interval:
+                state = self._recheck(channel, state[0], now)
+            if state is not None and state[0] == value:
+                self._count('suppressed')
+                return False
+            # The cache is cleared first, so the state is unknown if control
+            # fails.
+            self._states.pop(channel, None)
+            self.control(channel, value)
+            self._states[channel] = (value, now)
+            self._count('issued')
+            return True
+
+    def submit(self, channel, value):
+        """
+        Queues a command for the worker of the controller, and returns
+        immediately.
+
+        :param channel: Which channel of the controller to use
+        :param value: The new value
+        :return: A Future whose result is True if control was called, False if
+            the command was suppressed by the state cache, or None if it was
+            replaced by a later command for the same channel
+        """
+        future = Future()
+        with self._commands_cond:
+            if self._closed:
+                raise RuntimeError("{} is closed.".format(self.name))
+            previous = self._commands.pop(channel, None)
+            self._commands[channel] = (value, future)
+            self._commands_cond.notify()
+        with self._lock:
+            self._counters['submitted'] += 1
+            if previous is not None:
+                self._counters['coalesced'] += 1
+        if previous is not None:
+            previous[1].set_result(None)
+        return future
+
+    def reconnect(self):
+        """
+        Should be overridden in subclasses that can reopen their connection
+        to the hardware after an error.
+        """
+        pass
+
+    def close(self, timeout=None):
+        """
+        Executes the queued commands, and stops the worker.
+
+        :param timeout: Seconds to wait for the worker
+        """
+        with self._commands_cond:
+            self._closed = True
+            self._commands_cond.notify()
+        self._worker.join(timeout)
+
+    def stats(self):
+        """
+        Returns the number of issued and suppressed commands, of state rechecks
+        and of rechecks that found a different state than cached, and of
+        submitted, coalesced and failed commands and reconnects.
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _recheck(self, channel, cached, now):
+        self._count('rechecks')
+        try:
+            actual = self.read_state(channel)
+        except Exception as e:
+            logging.warning("Could not read state of {} channel {}: {}".format(
+                self.name, channel, e))
+            actual = None
+        if actual is None:
+            del self._states[channel]
+            return None
+        if actual != cached:
+            self._count('mismatches')
+            logging.warning("{} channel {} is {}, expected {}.".format(
+                self.name, channel, actual, cached))
+        self._states[channel] = (actual, now)
+        return self._states[channel]
+
+    def _run(self):
+        while True:
+            with self._commands_cond:
+                while not self._commands and not self._closed:
+                    self._commands_cond.wait()
+                if not self._commands:
+                    return
+                channel, (value, future) = self._commands.popitem(last=False)
+            if future.set_running_or_notify_cancel():
+                self._execute(channel, value, future)
+
+    def _execute(self, channel, value, future):
+        attempt = 0
+        while True:
+            try:
+                future.set_result(self.set_state(channel, value))
+                return
+            except Exception as e:
+                self._count('errors')
+                if attempt >= self._max_retries:
+                    logging.error("{} could not set channel {} to {}: "
+                            "{}".format(self.name, channel, value, e))
+                    future.set_exception(e)
+                    return
+                backoff = min(2 ** attempt, self._max_backoff)
+                logging.warning("{} could not set channel {} to {}: {}. "
+                        "Reconnecting in {} seconds.".format(
+                            self.name, channel, value, e, backoff))
+            time.sleep(backoff)
+            attempt += 1
+            with self._commands_cond:
+                if channel in self._commands:
+                    # A newer command for the channel replaces this one.
+                    future.set_result(None)
+                    return
+            try:
+                self._count('reconnects')
+                with self._state_lock:
+                    self.reconnect()
+            except Exception as e:
+                logging.warning("{} could not reconnect: {}".format(
+                    self.name, e))
+
     @abstractmethod
     def control(self, channel, value):
         """
-        Does the actual controlling. Should be overridden in subclasses.
-        
+        Does the actual controlling. Should be overridden in subclasses. Users
+        of the controller should call submit instead.
+
         :param channel: Which channel of the controller to use. (e.g. a GPIO pin
             number, or an Energenie port number)
         :param value: The new value (e.g. 'on' or 'off', or a percentage for PWM
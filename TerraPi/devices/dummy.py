@@ -28,14 +28,20 @@ class DummySwitch(ControllerDevice):
     """
     def __init__(self, app, config):
         super().__init__(app, config)
+        self._channels = {}
+
+    def read_state(self, channel):
+        return self._channels.get(channel)
 
     def control(self, channel, value):
         if value == 'on':
             logging.info("Switching {} channel {} on.".format(
                 self.name, channel))
+            self._channels[channel] = value
         elif value == 'off':
             logging.info("Switching {} channel {} off.".format(
                 self.name, channel))
+            self._channels[channel] = value
         else:
             logging.warn("{} received invalid control value ({}).".format(
                 self.name, value))
@@ -30,6 +30,15 @@ class EnergenieUSBSwitch(ControllerDevice):
             if not d:
                 raise ValueError("Invalid device ID!")
             self._device = d[0]
+        self._device_id = sispm.getid(self._device)
+
+    def reconnect(self):
+        devices = [d for d in sispm.connect()
+                if sispm.getid(d)==self._device_id]
+        if not devices:
+            raise ConnectionError("Energenie USB device {} not found!".format(
+                self._device_id))
+        self._device = devices[0]
 
     def init_channel(self, channel):
         minport = sispm.getminport(self._device)
@@ -38,6 +47,9 @@ class EnergenieUSBSwitch(ControllerDevice):
             raise IndexError("There is no port {} on device {}".format(
                 channel, self._device))
 
+    def read_state(self, channel):
+        return 'on' if sispm.getstatus(self._device, channel) else 'off'
+
     def control(self, channel, value):
         if value == 'on':
             sispm.switchon(self._device, channel)
@@ -24,6 +24,9 @@ class GPIOSwitch(ControllerDevice):
     def init_channel(self, channel):
         GPIO.setup(channel, GPIO.OUT, initial=self._off_state)
 
+    def read_state(self, channel):
+        return 'on' if GPIO.input(channel) == self._on_state else 'off'
+
     def control(self, channel, value):
         if value == 'on':
             GPIO.output(channel, self._on_state)
@@ -0,0 +1,168 @@
+import heapq
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+from apscheduler.triggers.interval import IntervalTrigger
+
+from ..db import SensorType
+from ..importer import read_rows
+from .device import Device, SensorDevice
+
+
+# Typical value ranges of the sensor types, used for random walks.
+_RANGES = {
+    SensorType.temperature: (18, 35),
+    SensorType.humidity: (30, 90),
+    SensorType.distance: (0, 200),
+    SensorType.uvi: (0, 12),
+    SensorType.ph: (5, 9),
+    SensorType.weight: (0, 5000),
+    SensorType.pressure: (950, 1050),
+}
+
+
+class VirtualSensor(SensorDevice):
+    """
+    One virtual sensor of a VirtualSensors fleet. Values are random walks
+    within the typical range of each sensor type.
+    """
+    def __init__(self, app, config, sensor_types, interval, latency,
+            failure_rate, jitter):
+        self._interval = interval
+        self._jitter = jitter
+        self._latency = latency
+        self._failure_rate = failure_rate
+        self._values = {t: random.uniform(*_RANGES[t]) for t in sensor_types}
+        super().__init__(app, config, sensor_types)
+
+    def _setup_schedule(self, config):
+        trigger = IntervalTrigger(seconds=self._interval, jitter=self._jitter)
+        if self._app.engine is not None:
+            self._app.engine.add(self, trigger, config.get('timeout'))
+        else:
+            self._app.scheduler.add_job(self._refresh, trigger=trigger,
+                    name=self.name)
+
+    def _measure(self):
+        if self._latency:
+            time.sleep(random.uniform(0, 2 * self._latency))
+        if random.random() < self._failure_rate:
+            raise IOError("Simulated failure of {}.".format(self.name))
+        measurements = []
+        for sensor_type, value in self._values.items():
+            low, high = _RANGES[sensor_type]
+            value += random.gauss(0, (high - low) / 100)
+            self._values[sensor_type] = min(high, max(low, value))
+            measurements.append((sensor_type, self._values[sensor_type]))
+        return measurements
+
+
+class VirtualSensors(Device):
+    """
+    Load generator that creates a fleet of virtual sensors, named
+    <name>_<index>. For testing purposes only!
+
+    :config sensors: Number of virtual sensors
+    :config types: Sensor type names every virtual sensor measures
+    :config interval: Seconds between measurements of a virtual sensor. Can be
+        less than a minute.
+    :config jitter: Maximum random delay of a measurement in seconds, to spread
+        the measurements of the fleet
+    :config latency: Mean simulated duration of a measurement in seconds
+    :config failure_rate: Probability of a measurement raising an error
+    """
+    def __init__(self, app, config):
+        super().__init__(app, config)
+        sensor_types = [SensorType[t] for t in
+                config.get('types', ['temperature', 'humidity'])]
+        self.sensors = [VirtualSensor(app,
+            dict(config, name='{}_{}'.format(self.name, i)),
+            sensor_types, config.get('interval', 60),
+            config.get('latency', 0), config.get('failure_rate', 0),
+            config.get('jitter')) for i in range(config.get('sensors', 10))]
+
+
+class _ReplaySensor(SensorDevice):
+    """A sensor that only emits the measurements fed to it by Replay."""
+    def _setup_schedule(self, config):
+        pass
+
+    def _measure(self):
+        return []
+
+
+class Replay(Device):
+    """
+    Replays recorded measurements at accelerated speed. Every recorded sensor
+    is replayed by a sensor named <name>_<recorded sensor name>, and the gaps
+    between recorded measurements are divided by the speed. Measurements are
+    stored with the time they are replayed at. For testing purposes only!
+
+    The file is read like terrapi-import reads it: CSV with a header, JSON
+    lines, or a segment file, as written by terrapi-export.
+
+    :config file: Path of the recording
+    :config speed: Replay speed relative to the recording
+    :config loop: True to restart the replay at the end of the file
+    """
+    def __init__(self, app, config):
+        super().__init__(app, config)
+        self._file = config['file']
+        self._speed = config.get('speed', 60)
+        self._loop = config.get('loop', False)
+
+        sources = {}
+        for _, sensor, sensor_type, _ in self._read():
+            sources.setdefault(sensor, set()).add(sensor_type)
+        self.sensors = {sensor: _ReplaySensor(app,
+            {'name': '{}_{}'.format(self.name, sensor),
+                'description': 'Replay of {}'.format(sensor)},
+            sorted(types, key=lambda t: t.value))
+            for sensor, types in sources.items()}
+
+        # Sensor ids are assigned after all devices are created, so the replay
+        # starts with the scheduler.
+        self._app.scheduler.add_job(self._start)
+
+    def _read(self):
+        """Yields (timestamp, sensor, type, value) tuples from the file."""
+        return read_rows(self._file)
+
+    def _merged(self):
+        """
+        Yields the rows of the file ordered by timestamp. Exports are ordered
+        by sensor, then by timestamp, so the rows of every sensor are read by
+        a pass of their own, and the passes are merged. That way, memory use
+        does not depend on the size of the file.
+        """
+        def rows_of(sensor):
+            return (row for row in self._read() if row[1] == sensor)
+        return heapq.merge(*(rows_of(sensor) for sensor in self.sensors),
+                key=lambda row: row[0])
+
+    def _start(self):
+        threading.Thread(target=self._run, name=self.name,
+                daemon=True).start()
+
+    def _run(self):
+        while True:
+            replayed = 0
+            start = time.monotonic()
+            first = None
+            for timestamp, sensor, sensor_type, value in self._merged():
+                first = first or timestamp
+                delay = (timestamp - first).total_seconds() / self._speed - \
+                        (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                self.sensors[sensor]._process([(sensor_type, value)],
+                        datetime.utcnow())
+                replayed += 1
+            logging.info("{} replayed {} measurements in {:.1f} "
+                    "seconds.".format(self.name, replayed,
+                        time.monotonic() - start))
+            if not self._loop:
+                return
@@ -38,10 +38,13 @@ class Thermostat(ControlledDevice):
         current_hour = datetime.now().hour
         tmin, tmax = self._temp_ranges[current_hour]
         if temperature < tmin:
-            logging.info('Switching on thermostat {} at {:.2f}C.'.format(
-                self.name, temperature))
-            self._controller.control(self._channel, 'on')
+            self._switch('on', temperature)
         if temperature > tmax:
-            logging.info('Switching off thermostat {} at {:.2f}C.'.format(
-                self.name, temperature))
-            self._controller.control(self._channel, 'off')
+            self._switch('off', temperature)
+
+    def _switch(self, value, temperature):
+        def done(future):
+            if future.exception() is None and future.result():
+                logging.info('Switched {} thermostat {} at {:.2f}C.'.format(
+                    value, self.name, temperature))
+        self._controller.submit(self._channel, value).add_done_callback(done)
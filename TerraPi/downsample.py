@@ -0,0 +1,85 @@
+# downsampling of measurement series for plotting
+
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """
+    Selects threshold points of a series with the Largest-Triangle-Three-
+    Buckets algorithm. The first and last points are always kept, the rest
+    are split into threshold - 2 buckets, and from every bucket the point that
+    forms the largest triangle with the previously selected point and the
+    average of the next bucket is kept. Bucket averages and triangle areas are
+    computed with NumPy, only the walk over the buckets is a Python loop.
+
+    :param x: Sorted array of x values (e.g. epoch milliseconds)
+    :param y: Array of y values
+    :param threshold: The number of points to keep
+    :return: Sorted array of the indices of the selected points
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Relative x values keep full precision in float64.
+    x = np.asarray(x, dtype=np.float64) - float(x[0])
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    sum_x = np.r_[0, np.cumsum(x)]
+    sum_y = np.r_[0, np.cumsum(y)]
+    counts = np.diff(edges)
+    avg_x = (sum_x[edges[1:]] - sum_x[edges[:-1]]) / counts
+    avg_y = (sum_y[edges[1:]] - sum_y[edges[:-1]]) / counts
+    # The point after the last bucket is the last point of the series.
+    next_x = np.r_[avg_x[1:], x[-1]]
+    next_y = np.r_[avg_y[1:], y[-1]]
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i+1]
+        ax, ay = x[a], y[a]
+        area = np.abs((ax - next_x[i]) * (y[lo:hi] - ay) -
+                (ax - x[lo:hi]) * (next_y[i] - ay))
+        a = lo + int(area.argmax())
+        selected[i+1] = a
+    return selected
+
+
+def downsample(timestamps, values, budget, keep_extremes=True):
+    """
+    Reduces a series to about budget points for plotting.
+
+    :param timestamps: Sorted array of epoch milliseconds
+    :param values: Array of values
+    :param budget: The number of points to keep
+    :param keep_extremes: Also keep the minimum and maximum of the series, so
+        the value range of the plot is exact
+    :return: A (timestamps, values) tuple of arrays
+    """
+    if len(timestamps) <= budget:
+        return timestamps, values
+    indices = lttb(timestamps, values, budget)
+    if keep_extremes:
+        indices = np.union1d(indices, [values.argmin(), values.argmax()])
+    return timestamps[indices], values[indices]
+
+
+def budgets(config):
+    """
+    Returns a function that gives the point budget of a trace by sensor type
+    name, from the dashboard section of the configuration. The budget is
+    proportional to the plot width.
+
+    :config width: The plot width in pixels
+    :config points_per_pixel: A number, or a dict that maps sensor type names
+        (and 'default') to numbers
+    """
+    width = config.get('width', 1200)
+    ppp = config.get('points_per_pixel', 2)
+    if not isinstance(ppp, dict):
+        ppp = {'default': ppp}
+    default = ppp.get('default', 2)
+    return lambda type_name: max(3, int(width * ppp.get(type_name, default)))
@@ -0,0 +1,219 @@
+# asyncio polling engine for sensor devices
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+
+def _measure_at(device):
+    """
+    Runs _measure on an executor thread, and returns the time it was called
+    at with the measurements, so time spent waiting for a free thread does not
+    skew the timestamp.
+    """
+    timestamp = datetime.utcnow()
+    return timestamp, device._measure()
+
+
+class _Job():
+    """Polling state of one sensor device."""
+    def __init__(self, device, trigger, timeout):
+        self.device = device
+        self.trigger = trigger
+        self.timeout = timeout
+        self.pending = None
+        self.failures = 0
+        self.backoff_until = 0.0
+        self.latencies = deque(maxlen=100)
+        self.counters = {
+            'runs': 0,
+            'timeouts': 0,
+            'errors': 0,
+            'skipped': 0,
+            'max_latency': 0.0,
+            'total_latency': 0.0,
+        }
+
+
+class PollingEngine():
+    """
+    Polls sensor devices from an asyncio event loop instead of the scheduler's
+    thread pool. Every device has its own deadline: a `_measure` call that
+    does not return in time is abandoned, so a slow driver can not delay the
+    other devices. Drivers are blocking, so they run in a bounded thread pool,
+    and a device is never measured again while its previous call is still
+    running. Devices that fail `max_failures` times in a row are skipped for
+    an exponentially growing backoff period.
+
+    Missed runs are coalesced, i.e. a device that was skipped or slow is
+    measured at its next scheduled time only.
+
+    :config workers: Number of threads running device drivers
+    :config timeout: Default deadline of a measurement in seconds
+    :config max_failures: Consecutive failures before a device is backed off
+    :config backoff: Initial backoff period in seconds
+    :config max_backoff: Maximum backoff period in seconds
+    :config stats_interval: Seconds between logging latency statistics
+    """
+    def __init__(self, config=None):
+        """
+        Constructs a new 'PollingEngine' object.
+
+        :param config: The polling section of the configuration
+        """
+        config = config or {}
+        self._timeout = config.get('timeout', 30)
+        self._max_failures = config.get('max_failures', 3)
+        self._backoff = config.get('backoff', 60)
+        self._max_backoff = config.get('max_backoff', 3600)
+        self._stats_interval = config.get('stats_interval', 3600)
+        self._executor = ThreadPoolExecutor(
+                max_workers=config.get('workers', 4),
+                thread_name_prefix='PollingEngine')
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._loop = None
+        self._stopping = None
+
+    def add(self, device, trigger, timeout=None):
+        """
+        Registers a sensor device.
+
+        :param device: The SensorDevice instance
+        :param trigger: An APScheduler trigger that defines when to measure
+        :param timeout: Deadline of a measurement in seconds, overriding the
+            engine's default
+        """
+        self._jobs.append(_Job(device, trigger, timeout or self._timeout))
+
+    def run(self):
+        """Runs the event loop until stop() is called."""
+        asyncio.run(self._main())
+
+    def stop(self):
+        """Stops the engine. Can be called from any thread."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def stats(self):
+        """
+        Returns per-device measurement statistics.
+
+        :return: A dict that maps device names to dicts with the number of
+            runs, timeouts, errors and skipped runs, latency statistics in
+            seconds, and the remaining backoff period
+        """
+        now = time.monotonic()
+        stats = {}
+        with self._lock:
+            for job in self._jobs:
+                s = dict(job.counters)
+                completed = s['runs'] - s['timeouts'] - s['errors']
+                s['mean_latency'] = s['total_latency'] / completed \
+                        if completed else 0.0
+                latencies = sorted(job.latencies)
+                s['p95_latency'] = latencies[int(len(latencies) * 0.95)] \
+                        if latencies else 0.0
+                s['backoff'] = max(0.0, job.backoff_until - now)
+                stats[job.device.name] = s
+        return stats
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        tasks = [asyncio.create_task(self._poll(job)) for job in self._jobs]
+        tasks.append(asyncio.create_task(self._log_stats()))
+        try:
+            await self._stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Abandoned driver calls may never return, so they are not
+            # waited for.
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _poll(self, job):
+        previous = None
+        while True:
+            tz = job.trigger.timezone
+            now = datetime.now(tz)
+            if previous is not None and now <= previous:
+                now = previous + timedelta(microseconds=1)
+            # Passing no previous fire time makes the trigger return the first
+            # fire time after now, which coalesces missed runs.
+            fire_time = job.trigger.get_next_fire_time(None, now)
+            if fire_time is None:
+                return
+            await asyncio.sleep((fire_time - datetime.now(tz)).total_seconds())
+            previous = fire_time
+            await self._measure(job)
+
+    async def _measure(self, job):
+        device = job.device
+        if job.backoff_until > time.monotonic():
+            job.counters['skipped'] += 1
+            return
+        if job.pending is not None and not job.pending.done():
+            job.counters['skipped'] += 1
+            logging.warning("Skipping {}, its previous measurement is still "
+                    "running.".format(device.name))
+            return
+
+        start = time.perf_counter()
+        job.pending = self._loop.run_in_executor(self._executor,
+                _measure_at, device)
+        job.counters['runs'] += 1
+        try:
+            timestamp, measurements = await asyncio.wait_for(
+                    asyncio.shield(job.pending), job.timeout)
+        except asyncio.TimeoutError:
+            job.counters['timeouts'] += 1
+            logging.warning("Measurement of {} timed out after {} "
+                    "seconds.".format(device.name, job.timeout))
+            self._failed(job)
+            return
+        except Exception as e:
+            job.counters['errors'] += 1
+            logging.error("Measurement of {} failed: {}".format(
+                device.name, e))
+            self._failed(job)
+            return
+
+        latency = time.perf_counter() - start
+        device._measure_duration.observe(latency)
+        with self._lock:
+            job.latencies.append(latency)
+            job.counters['total_latency'] += latency
+            job.counters['max_latency'] = max(job.counters['max_latency'],
+                    latency)
+        job.failures = 0
+        # Storing and callbacks may block on the writer queue or controllers.
+        await self._loop.run_in_executor(self._executor, device._process,
+                measurements, timestamp)
+
+    def _failed(self, job):
+        job.failures += 1
+        if job.failures < self._max_failures:
+            return
+        period = min(self._backoff * 2 ** (job.failures - self._max_failures),
+                self._max_backoff)
+        job.backoff_until = time.monotonic() + period
+        logging.warning("{} failed {} times in a row, skipping it for {} "
+                "seconds.".format(job.device.name, job.failures, period))
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(self._stats_interval)
+            stats = sorted(self.stats().items(),
+                    key=lambda s: s[1]['p95_latency'], reverse=True)
+            for name, s in stats:
+                logging.info("{}: {} runs, {} timeouts, {} errors, {} skipped, "
+                        "latency mean {:.3f}s p95 {:.3f}s max {:.3f}s".format(
+                            name, s['runs'], s['timeouts'], s['errors'],
+                            s['skipped'], s['mean_latency'],
+                            s['p95_latency'], s['max_latency']))
@@ -0,0 +1,167 @@
+# event bus that runs sensor callbacks off the measurement path
+
+import logging
+import queue
+import threading
+import time
+import zlib
+
+from .metrics import Histogram
+
+
+_OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+CALLBACK_DURATION = Histogram('terrapi_callback_duration_seconds',
+        'Time spent in sensor callbacks', ['callback'])
+
+
+class EventBus():
+    """
+    Delivers measurements to the callbacks registered with sensor devices on a
+    pool of dispatcher threads, so a slow callback (e.g. a thermostat waiting
+    for a USB switch) delays neither storage nor the other devices.
+
+    Every device is assigned to one dispatcher by its name, and every
+    dispatcher has its own bounded queue, so the callbacks of a device see its
+    measurements in order. When a queue is full, the overflow policy decides
+    which event is lost:
+
+    * `drop_oldest`: the oldest queued event is dropped, so callbacks always
+      get the latest measurements
+    * `drop_newest`: the new event is dropped
+    * `block`: the publisher waits up to `put_timeout` seconds for room, then
+      drops the new event
+
+    :config workers: Number of dispatcher threads
+    :config queue_size: Maximum number of events queued per dispatcher
+    :config overflow: The overflow policy
+    :config put_timeout: Seconds to wait for room with the block policy
+    """
+    _stop = object()
+
+    def __init__(self, config=None):
+        """
+        Constructs a new 'EventBus' object, and starts its dispatchers.
+
+        :param config: The events section of the configuration
+        """
+        config = config or {}
+        self._overflow = config.get('overflow', 'drop_oldest')
+        if self._overflow not in _OVERFLOW_POLICIES:
+            raise ValueError("Invalid overflow policy {}.".format(
+                self._overflow))
+        self._put_timeout = config.get('put_timeout', 1)
+        queue_size = config.get('queue_size', 1000)
+
+        self._lock = threading.Lock()
+        self._counters = {'published': 0, 'dropped': 0}
+        self._callbacks = {}
+        self._queues = []
+        self._threads = []
+        for i in range(config.get('workers', 2)):
+            q = queue.Queue(maxsize=queue_size)
+            t = threading.Thread(target=self._run, args=(q,),
+                    name='EventBus-{}'.format(i), daemon=True)
+            self._queues.append(q)
+            self._threads.append(t)
+            t.start()
+
+    def publish(self, source, callbacks, value):
+        """
+        Queues a measurement for the callbacks of a device. Never raises if
+        the queue is full, the event is dropped according to the overflow
+        policy instead.
+
+        :param source: The name of the device that made the measurement
+        :param callbacks: The callback functions to call with the value
+        :param value: The measured value
+        """
+        q = self._queues[zlib.crc32(source.encode()) % len(self._queues)]
+        event = (source, list(callbacks), value)
+        with self._lock:
+            self._counters['published'] += 1
+        try:
+            if self._overflow == 'block':
+                q.put(event, timeout=self._put_timeout)
+            else:
+                q.put_nowait(event)
+            return
+        except queue.Full:
+            if self._overflow != 'drop_oldest':
+                self._dropped(source)
+                return
+        try:
+            q.get_nowait()
+            q.task_done()
+        except queue.Empty:
+            pass
+        self._dropped(source)
+        try:
+            q.put_nowait(event)
+        except queue.Full:
+            self._dropped(source)
+
+    def close(self, timeout=None):
+        """
+        Delivers the queued events, and stops the dispatchers.
+
+        :param timeout: Seconds to wait for each dispatcher
+        """
+        for q in self._queues:
+            q.put(self._stop)
+        for t in self._threads:
+            t.join(timeout)
+
+    def stats(self):
+        """
+        Returns a snapshot of the bus counters and per-callback timings.
+
+        :return: A dict with the number of published and dropped events, the
+            queue depths, and a dict that maps callback names to their number
+            of calls and errors, and their total and maximum duration in
+            seconds
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['callbacks'] = {name: dict(c)
+                    for name, c in self._callbacks.items()}
+        stats['queue_depths'] = [q.qsize() for q in self._queues]
+        return stats
+
+    def _dropped(self, source):
+        with self._lock:
+            self._counters['dropped'] += 1
+        logging.warning("Event queue is full, dropped an event of {}.".format(
+            source))
+
+    def _run(self, q):
+        while True:
+            event = q.get()
+            try:
+                if event is self._stop:
+                    return
+                source, callbacks, value = event
+                for callback in callbacks:
+                    self._call(source, callback, value)
+            finally:
+                q.task_done()
+
+    def _call(self, source, callback, value):
+        name = '{}:{}'.format(source, getattr(callback, '__qualname__',
+            repr(callback)))
+        error = False
+        start = time.perf_counter()
+        try:
+            callback(value)
+        except Exception as e:
+            error = True
+            logging.error("Callback {} failed: {}".format(name, e))
+        elapsed = time.perf_counter() - start
+        CALLBACK_DURATION.labels(callback=name).observe(elapsed)
+        with self._lock:
+            c = self._callbacks.setdefault(name, {'calls': 0, 'errors': 0,
+                'total_time': 0.0, 'max_time': 0.0})
+            c['calls'] += 1
+            c['errors'] += error
+            c['total_time'] += elapsed
+            c['max_time'] = max(c['max_time'], elapsed)
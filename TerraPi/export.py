@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# streaming export of raw measurements
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+from logging.config import dictConfig
+
+import numpy as np
+from sqlalchemy import and_, select
+
+from .archive import SegmentWriter
+from .config import get_connection_string, load_config
+from .db import Sensor, SensorType, create_sessionmaker
+from .query import read_chunks, to_epoch_ms
+from .storage import create_storage
+
+
+def iter_measurements(session, storage, sensor_id, start=None, end=None,
+        chunk_size=50000):
+    """
+    Yields the raw measurements of a sensor in time order, in chunks, so
+    memory use does not depend on the number of measurements. Archived
+    measurements come first, one month at a time.
+
+    :param session: A database session
+    :param storage: The storage object raw measurements are read from
+    :param sensor_id: The id of the sensor
+    :param start: Optional start of the time range (UTC)
+    :param end: Optional end of the time range (UTC)
+    :param chunk_size: Maximum number of rows read at once
+    :return: A generator of (timestamps, values) tuples of arrays, where
+        timestamps are UTC epoch milliseconds
+    """
+    if storage.archive:
+        for t, v in storage.archive.read_months(sensor_id,
+                to_epoch_ms(start) if start else None,
+                to_epoch_ms(end) if end else None):
+            if len(t):
+                yield t, v
+
+    raw = storage.select(session, start, end)
+    conditions = [raw.c.sensor_id==sensor_id]
+    if start:
+        conditions.append(raw.c.timestamp >= start)
+    if end:
+        conditions.append(raw.c.timestamp < end)
+    query = select(raw.c.timestamp.label('timestamp'),
+            raw.c.value.label('value')).where(and_(*conditions)).order_by(
+            raw.c.timestamp)
+    for t, v in read_chunks(session, query, chunk_size):
+        yield t, v
+
+
+def _iso(timestamps):
+    return np.datetime_as_string(timestamps.astype('datetime64[ms]'),
+            unit='ms').tolist()
+
+
+class CsvWriter():
+    """Writes measurements as CSV with a timestamp,sensor,type,value header."""
+    extension = '.csv'
+
+    def __init__(self, f):
+        self._writer = csv.writer(f)
+        self._writer.writerow(['timestamp', 'sensor', 'type', 'value'])
+
+    def write(self, name, type_name, timestamps, values):
+        self._writer.writerows(zip(_iso(timestamps), repeat(name),
+            repeat(type_name), values.tolist()))
+
+
+class JsonLinesWriter():
+    """Writes measurements as JSON objects with timestamp, sensor, type and
+    value keys, one per line. NaN and infinite values are left out, since JSON
+    can not represent them."""
+    extension = '.jsonl'
+
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, name, type_name, timestamps, values):
+        finite = np.isfinite(values)
+        if not finite.all():
+            timestamps, values = timestamps[finite], values[finite]
+        # The repr of a finite float is valid JSON.
+        template = '{"timestamp":"%s","sensor":' + \
+                json.dumps(name).replace('%', '%%') + ',"type":"' + \
+                type_name + '","value":%r}\n'
+        self._f.writelines(template % row
+                for row in zip(_iso(timestamps), values.tolist()))
+
+
+FORMATS = {
+    'csv': CsvWriter,
+    'jsonl': JsonLinesWriter,
+    'segment': SegmentWriter,
+}
+
+
+def export_file(config, sensor_id, name, type_name, path, fmt, start=None,
+        end=None):
+    """
+    Exports the measurements of one sensor to a file. Runs in worker
+    processes, so it connects to the database itself.
+
+    :param config: The configuration as a dict
+    :param path: The path of the file
+    :param fmt: One of the keys of FORMATS
+    :return: The number of exported measurements
+    """
+    sessionmaker = create_sessionmaker(get_connection_string(config),
+            config.get('sqlite'), readonly=True,
+            pool_config=config.get('pool'))
+    storage = create_storage(sessionmaker, config.get('storage'))
+    session = sessionmaker()
+    rows = 0
+    try:
+        if fmt == 'segment':
+            with SegmentWriter(path) as writer:
+                for t, v in iter_measurements(session, storage, sensor_id,
+                        start, end):
+                    writer.write(t, v)
+                    rows += len(t)
+        else:
+            with open(path, 'w', newline='') as f:
+                writer = FORMATS[fmt](f)
+                for t, v in iter_measurements(session, storage, sensor_id,
+                        start, end):
+                    writer.write(name, type_name, t, v)
+                    rows += len(t)
+    finally:
+        session.close()
+        sessionmaker.get_bind().dispose()
+    return rows
+
+
+def export(config, sensors, output, fmt, start=None, end=None, jobs=1):
+    """
+    Exports the measurements of sensors. CSV and JSON Lines exports with one
+    job are written to a single file (or stdout), ordered by sensor and time.
+    Otherwise output is a directory, and every sensor is exported to its own
+    file, named <sensor>_<type>.<extension>, by a pool of worker processes.
+    Segment files can be read with archive.Segment.
+
+    :param config: The configuration as a dict
+    :param sensors: A list of Sensor objects
+    :param output: Path of the output file or directory, or - for stdout
+    :param fmt: One of the keys of FORMATS
+    :param start: Optional start of the time range (UTC)
+    :param end: Optional end of the time range (UTC)
+    :param jobs: Number of worker processes
+    :return: The number of exported measurements
+    """
+    t = time.perf_counter()
+    total = 0
+    if fmt != 'segment' and jobs == 1:
+        sessionmaker = create_sessionmaker(get_connection_string(config),
+                config.get('sqlite'), readonly=True,
+                pool_config=config.get('pool'))
+        storage = create_storage(sessionmaker, config.get('storage'))
+        session = sessionmaker()
+        f = sys.stdout if output == '-' else open(output, 'w', newline='')
+        try:
+            writer = FORMATS[fmt](f)
+            for sensor in sensors:
+                for timestamps, values in iter_measurements(session, storage,
+                        sensor.id, start, end):
+                    writer.write(sensor.name, sensor.type.name, timestamps,
+                            values)
+                    total += len(timestamps)
+                logging.info("Exported {} measurements ({:.0f} rows/s).".format(
+                    total, total / (time.perf_counter() - t)))
+        finally:
+            if f is not sys.stdout:
+                f.close()
+            session.close()
+    else:
+        os.makedirs(output, exist_ok=True)
+        extension = '.seg' if fmt == 'segment' else FORMATS[fmt].extension
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [(sensor, executor.submit(export_file, config,
+                sensor.id, sensor.name, sensor.type.name,
+                os.path.join(output, '{}_{}{}'.format(sensor.name,
+                    sensor.type.name, extension)), fmt, start, end))
+                for sensor in sensors]
+            for sensor, future in futures:
+                total += future.result()
+                logging.info("Exported {} {}, {} measurements in total "
+                        "({:.0f} rows/s).".format(sensor.name,
+                            sensor.type.name, total,
+                            total / (time.perf_counter() - t)))
+    elapsed = time.perf_counter() - t
+    logging.info("Exported {} measurements in {:.1f} seconds ({:.0f} "
+            "rows/s).".format(total, elapsed, total / elapsed if elapsed
+                else 0))
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Exports raw measurements of TerraPi.')
+    parser.add_argument('--config', help='path of the configuration file')
+    parser.add_argument('--sensor', action='append',
+            help='name of a sensor to export (all by default, repeatable)')
+    parser.add_argument('--type', action='append',
+            choices=[t.name for t in SensorType],
+            help='sensor type to export (all by default, repeatable)')
+    parser.add_argument('--start', type=datetime.fromisoformat,
+            help='start of the time range (UTC, ISO 8601)')
+    parser.add_argument('--end', type=datetime.fromisoformat,
+            help='end of the time range (UTC, ISO 8601)')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--jobs', type=int, default=1,
+            help='number of sensors exported in parallel')
+    parser.add_argument('--output', default='-',
+            help='output file, - for stdout, or output directory for '
+            'segment files and parallel exports')
+    args = parser.parse_args()
+
+    config = load_config(['terrapi-export'] +
+            ([args.config] if args.config else []))
+    if config.get('logging'):
+        dictConfig(config['logging'])
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if (args.format == 'segment' or args.jobs > 1) and args.output == '-':
+        logging.error("Segment files and parallel exports need an output "
+                "directory! Exiting...")
+        sys.exit(1)
+
+    sessionmaker = create_sessionmaker(get_connection_string(config),
+            config.get('sqlite'), readonly=True,
+            pool_config=config.get('pool'))
+    session = sessionmaker()
+    query = session.query(Sensor).order_by(Sensor.name, Sensor.type)
+    if args.sensor:
+        query = query.filter(Sensor.name.in_(args.sensor))
+    if args.type:
+        query = query.filter(Sensor.type.in_([SensorType[t]
+            for t in args.type]))
+    sensors = query.all()
+    session.close()
+    sessionmaker.get_bind().dispose()
+
+    export(config, sensors, args.output, args.format, args.start, args.end,
+            args.jobs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# bulk import of measurements with conflict handling
+
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from logging.config import dictConfig
+
+from .archive import Segment
+from .config import get_connection_string, load_config
+from .db import SensorType, create_sessionmaker, get_or_create_sensors
+from .rollup import rebuild, truncate
+from .storage import create_storage
+
+
+def read_rows(path):
+    """
+    Reads measurements from a file written by terrapi-export: CSV with a
+    header, or JSON lines, with timestamp, sensor, type and value fields, or a
+    segment file named <sensor>_<type>.seg. The file is read sequentially, so
+    memory use does not depend on its size.
+
+    This is also the reader of loadgen.Replay.
+
+    :param path: The path of the file
+    :return: A generator of (timestamp, sensor name, sensor type, value)
+        tuples, with naive UTC timestamps
+    """
+    if path.endswith('.seg'):
+        name, type_name = os.path.basename(path)[:-4].rsplit('_', 1)
+        sensor_type = SensorType[type_name]
+        with Segment(path) as segment:
+            for t, v in segment.blocks():
+                for timestamp, value in zip(
+                        t.astype('datetime64[ms]').tolist(), v.tolist()):
+                    yield timestamp, name, sensor_type, value
+        return
+
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            yield (datetime.fromisoformat(row['timestamp']), row['sensor'],
+                    SensorType[row['type']], float(row['value']))
+
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {'rows': 0, 'start': None, 'end': None, 'sensors': [],
+                'rebuilt': None}
+    logging.info("Resuming after {} rows.".format(state['rows']))
+    return state
+
+
+def _save_state(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def import_file(sessionmaker, storage, path, on_conflict='skip',
+        chunk_size=10000, state_path=None):
+    """
+    Imports measurements from a file in chunks, with one executemany insert
+    and one transaction per chunk. Missing sensors are created. Measurements
+    that are already in the database are skipped or overwritten, according
+    to on_conflict.
+
+    Progress is saved to a state file after every chunk, so an interrupted
+    import continues where it stopped when it is run again. Since conflicts
+    are resolved, a chunk imported again after a crash does no harm. When the
+    whole file is imported, the rollups of the imported sensors are rebuilt,
+    one day per transaction, and the state file is removed. Measurements that
+    TerraPi stores during the rebuild of their day may be left out of the
+    rollups.
+
+    :param sessionmaker: The session factory
+    :param storage: The storage object measurements are inserted with
+    :param path: The path of the file (see read_rows)
+    :param on_conflict: 'skip' or 'overwrite'
+    :param chunk_size: Number of rows per transaction
+    :param state_path: The path of the state file (<path>.progress by
+        default)
+    :return: The number of rows read from the file in this run
+    """
+    state_path = state_path or path + '.progress'
+    state = _load_state(state_path)
+    sensor_ids = {}
+    imported = 0
+    t = time.perf_counter()
+    session = sessionmaker()
+    try:
+        rows = islice(read_rows(path), state['rows'], None)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            missing = set((name, sensor_type)
+                    for _, name, sensor_type, _ in chunk) - set(sensor_ids)
+            if missing:
+                sensor_ids.update(get_or_create_sensors(session,
+                    [(name, sensor_type, None)
+                        for name, sensor_type in missing]))
+
+            # A statement must not hit the same row twice, so duplicates
+            # within the chunk are dropped, the last one wins.
+            batch = {}
+            for timestamp, name, sensor_type, value in chunk:
+                sensor_id = sensor_ids[(name, sensor_type)]
+                batch[(sensor_id, timestamp)] = {'timestamp': timestamp,
+                        'sensor_id': sensor_id, 'value': value}
+            storage.insert(session, list(batch.values()), on_conflict)
+            session.commit()
+
+            first = min(r[0] for r in chunk).isoformat()
+            last = max(r[0] for r in chunk).isoformat()
+            state['rows'] += len(chunk)
+            state['start'] = min(first, state['start'] or first)
+            state['end'] = max(last, state['end'] or last)
+            state['sensors'] = sorted(set(state['sensors']) |
+                    set(b['sensor_id'] for b in batch.values()))
+            _save_state(state_path, state)
+            imported += len(chunk)
+            logging.info("Imported {} rows of {} ({:.0f} rows/s).".format(
+                state['rows'], path, imported / (time.perf_counter() - t)))
+
+        if state['sensors']:
+            # One day is rebuilt per transaction, so locks are held briefly,
+            # and an interrupted rebuild continues with the next day.
+            day = truncate(datetime.fromisoformat(
+                state.get('rebuilt') or state['start']), 'day')
+            if state.get('rebuilt'):
+                day += timedelta(days=1)
+            end = datetime.fromisoformat(state['end'])
+            rebuilt = 0
+            while day <= end:
+                rebuilt += rebuild(session, storage, state['sensors'], day,
+                        day)
+                session.commit()
+                state['rebuilt'] = day.isoformat()
+                _save_state(state_path, state)
+                day += timedelta(days=1)
+            logging.info("Rebuilt the rollups of {} measurements.".format(
+                rebuilt))
+    finally:
+        session.close()
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description='Imports measurements into TerraPi.')
+    parser.add_argument('files', nargs='+', help='CSV, JSON Lines or '
+            'segment files, as written by terrapi-export')
+    parser.add_argument('--config', help='path of the configuration file')
+    parser.add_argument('--on-conflict', choices=['skip', 'overwrite'],
+            default='skip', help='what to do with measurements that are '
+            'already in the database')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+            help='number of rows per transaction')
+    args = parser.parse_args()
+
+    config = load_config(['terrapi-import'] +
+            ([args.config] if args.config else []))
+    if config.get('logging'):
+        dictConfig(config['logging'])
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    sessionmaker = create_sessionmaker(get_connection_string(config),
+            config.get('sqlite'), pool_config=config.get('pool'))
+    storage = create_storage(sessionmaker, config.get('storage'))
+    t = time.perf_counter()
+    total = 0
+    for path in args.files:
+        total += import_file(sessionmaker, storage, path, args.on_conflict,
+                args.chunk_size)
+    elapsed = time.perf_counter() - t
+    logging.info("Imported {} rows in {:.1f} seconds ({:.0f} rows/s).".format(
+        total, elapsed, total / elapsed if elapsed else 0))
+
+
+if __name__ == "__main__":
+    main()
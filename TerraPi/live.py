@@ -0,0 +1,177 @@
+# push of committed measurements to dashboards over server-sent events
+
+import calendar
+import json
+import logging
+import queue
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def encode_rows(rows):
+    """
+    Groups committed rows by sensor for the dashboard. Timestamps are sent
+    both as UTC epoch milliseconds, which dashboards use as cursors, and as
+    local wall time epoch milliseconds, which the dashboard plots.
+
+    :param rows: A list of dicts with timestamp, sensor_id and value keys
+    :return: JSON with a dict that maps sensor ids to [utc, local, values]
+        lists
+    """
+    columns = {}
+    for row in sorted(rows, key=lambda r: r['timestamp']):
+        t = row['timestamp']
+        utc = calendar.timegm(t.timetuple()) * 1000 + t.microsecond // 1000
+        offset = datetime.fromtimestamp(utc / 1000,
+                timezone.utc).astimezone().utcoffset()
+        c = columns.setdefault(str(row['sensor_id']), [[], [], []])
+        c[0].append(utc)
+        c[1].append(utc + int(offset.total_seconds() * 1000))
+        c[2].append(round(row['value'], 3))
+    return json.dumps({'columns': columns}, separators=(',', ':'))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/events':
+            self.send_error(404)
+            return
+        live = self.server.live
+        q = live._subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            # The dashboard is served from another port.
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write('retry: {}\n\n'.format(
+                live._retry * 1000).encode())
+            self.wfile.flush()
+            while True:
+                try:
+                    data = q.get(timeout=live._keepalive)
+                except queue.Empty:
+                    data = None
+                if data is LiveServer._stop:
+                    return
+                if data is None:
+                    self.wfile.write(b': keepalive\n\n')
+                else:
+                    self.wfile.write(b'data: ' + data + b'\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            live._unsubscribe(q)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LiveServer():
+    """
+    Pushes every batch of measurements committed by the writer to connected
+    dashboards as server-sent events at /events. Every client has a bounded
+    queue, and the oldest batch is dropped if a client can not keep up.
+
+    :config address: The address to listen on
+    :config port: The port to listen on
+    :config queue_size: Maximum number of batches queued per client
+    :config keepalive: Seconds between keepalive comments on idle streams
+    :config retry: Seconds browsers wait before reconnecting
+    """
+    _stop = object()
+
+    def __init__(self, config=None):
+        """
+        Constructs a new 'LiveServer' object, and starts listening.
+
+        :param config: The live section of the configuration
+        """
+        config = config or {}
+        self._queue_size = config.get('queue_size', 100)
+        self._keepalive = config.get('keepalive', 15)
+        self._retry = config.get('retry', 5)
+        self._lock = threading.Lock()
+        self._clients = []
+        self._counters = {'published': 0, 'dropped': 0}
+
+        self._server = ThreadingHTTPServer((config.get('address', '127.0.0.1'),
+            config.get('port', 9106)), _Handler)
+        self._server.daemon_threads = True
+        self._server.live = self
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                name='LiveServer', daemon=True)
+        self._thread.start()
+        logging.info("Pushing measurements on http://{}:{}/events.".format(
+            *self._server.server_address[:2]))
+
+    def publish(self, rows):
+        """
+        Queues a committed batch for every connected client. Never blocks, so
+        it can be called on the writer thread.
+
+        :param rows: A list of dicts with timestamp, sensor_id and value keys
+        """
+        with self._lock:
+            clients = list(self._clients)
+            self._counters['published'] += 1
+        if not clients:
+            return
+        data = encode_rows(rows).encode()
+        for q in clients:
+            try:
+                q.put_nowait(data)
+                continue
+            except queue.Full:
+                pass
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                self._counters['dropped'] += 1
+            try:
+                q.put_nowait(data)
+            except queue.Full:
+                pass
+
+    def stats(self):
+        """
+        Returns a snapshot of the push counters.
+
+        :return: A dict with the number of connected clients, and the number
+            of published and dropped batches
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['clients'] = len(self._clients)
+        return stats
+
+    def close(self):
+        """Ends the streams of the connected clients, and stops listening."""
+        with self._lock:
+            clients = list(self._clients)
+        for q in clients:
+            try:
+                q.put_nowait(self._stop)
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(self._stop)
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _subscribe(self):
+        q = queue.Queue(maxsize=self._queue_size)
+        with self._lock:
+            self._clients.append(q)
+        return q
+
+    def _unsubscribe(self, q):
+        with self._lock:
+            self._clients.remove(q)
@@ -0,0 +1,245 @@
+# Prometheus metrics of TerraPi
+
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds of histogram buckets in seconds, from fast database commits to
+# sensor reads that retry for a minute.
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+            '"', r'\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+            for k, v in labels.items()) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry():
+    """
+    A set of metrics, and of collectors that create samples when the metrics
+    are scraped. Collectors are for values that are already counted elsewhere
+    (e.g. by the stats methods of TerraPi objects), so they cost nothing
+    between scrapes.
+    """
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def register_collector(self, collector):
+        """
+        Registers a function that returns an iterable of (name, type, help,
+        samples) tuples, where samples is a list of (labels, value) tuples.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def unregister_collector(self, collector):
+        with self._lock:
+            self._collectors.remove(collector)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        families = [m.collect() for m in metrics]
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                logging.error("Metrics collector {} failed: {}".format(
+                    collector, e))
+        lines = []
+        for name, metric_type, documentation, samples in families:
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value, *suffix in samples:
+                lines.append('{}{}{} {}'.format(name, suffix[0] if suffix
+                    else '', _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric():
+    """
+    Base class of metrics with optional labels. Children of a labelled metric
+    should be looked up once with labels() and kept, so observations do not
+    have to build label tuples.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self._labelnames:
+            self._default = self._child()
+            self._children[()] = self._default
+        registry.register(self)
+
+    def labels(self, **labels):
+        """Returns the child metric of a combination of label values."""
+        key = tuple(str(labels[n]) for n in self._labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._child()
+        return child
+
+    def collect(self):
+        with self._lock:
+            children = list(self._children.items())
+        samples = []
+        for key, child in children:
+            labels = dict(zip(self._labelnames, key))
+            samples.extend(child.samples(labels))
+        return self.name, self.type, self.documentation, samples
+
+
+class _CounterChild():
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def samples(self, labels):
+        return [(labels, self._value)]
+
+
+class Counter(_Metric):
+    """
+    A monotonically increasing value. The name must end in _total, since the
+    samples of a counter have the name of its family.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        if not name.endswith('_total'):
+            raise ValueError("Counter name {} does not end in _total.".format(
+                name))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class _HistogramChild():
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def samples(self, labels):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append((dict(labels, le=_format_value(bound)),
+                cumulative, '_bucket'))
+        samples.append((labels, cumulative, '_count'))
+        samples.append((labels, total, '_sum'))
+        return samples
+
+
+class Histogram(_Metric):
+    """Counts observations (e.g. durations in seconds) in buckets."""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY,
+            buckets=DEFAULT_BUCKETS):
+        self._buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _child(self):
+        return _HistogramChild(self._buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer():
+    """
+    Serves /metrics from a registry on a background thread.
+
+    :config address: The address to listen on
+    :config port: The port to listen on
+    """
+    def __init__(self, config=None, registry=REGISTRY):
+        """
+        Constructs a new 'MetricsServer' object, and starts listening.
+
+        :param config: The metrics section of the configuration
+        :param registry: The registry to serve
+        """
+        config = config or {}
+        self._server = ThreadingHTTPServer((config.get('address', '127.0.0.1'),
+            config.get('port', 9105)), _Handler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                name='MetricsServer', daemon=True)
+        self._thread.start()
+        logging.info("Serving metrics on http://{}:{}/metrics.".format(
+            *self._server.server_address[:2]))
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# migration of raw measurements to epoch millisecond timestamps
+
+import logging
+import sys
+from logging.config import dictConfig
+
+from sqlalchemy import not_
+
+from .config import get_connection_string, load_config
+from .db import create_sessionmaker
+from .storage import after, create_storage, scan
+
+
+def migrate_timestamps(sessionmaker, source, target, chunk_size=50000):
+    """
+    Moves raw measurements from the tables of a storage object with datetime
+    timestamps to the tables of one with epoch millisecond timestamps. Every
+    chunk is deleted from the source in the transaction that inserts it into
+    the target, so an interrupted migration can be continued by running it
+    again. Emptied partitions are dropped.
+
+    Timestamps are truncated to milliseconds. If a sensor has more than one
+    measurement in the same millisecond, the last one moved is kept, even if
+    they are in different chunks.
+
+    :param sessionmaker: The session factory
+    :param source: The storage object to move measurements from
+    :param target: The storage object to move measurements to
+    :param chunk_size: Number of rows moved per transaction
+    :return: The number of rows moved
+    """
+    moved = 0
+    session = sessionmaker()
+    try:
+        tables = source.tables(session)
+        if source.partitioned:
+            # Rows not moved to partitions yet
+            tables = [source.table] + tables
+        for table in tables:
+            pk = list(table.primary_key.columns)
+            for rows in scan(session, table, chunk_size):
+                unique = {}
+                for r in rows:
+                    key = (r.sensor_id, r.timestamp.replace(
+                        microsecond=r.timestamp.microsecond // 1000 * 1000))
+                    unique[key] = {'timestamp': key[1],
+                            'sensor_id': r.sensor_id, 'value': r.value}
+                # Rows of the same millisecond may also be in the previous
+                # chunk, so they are overwritten like the ones in this one.
+                target.insert(session, list(unique.values()), 'overwrite')
+                last = [getattr(rows[-1], c.name) for c in pk]
+                session.execute(table.delete().where(not_(after(pk, last))))
+                session.commit()
+                moved += len(rows)
+                logging.info("Moved {} measurements to {}.".format(moved,
+                    target.table.name))
+            if table is not source.table:
+                table.drop(session.connection())
+                session.commit()
+    finally:
+        session.close()
+    return moved
+
+
+def main():
+    config = load_config()
+    if config.get('logging'):
+        dictConfig(config['logging'])
+
+    storage_config = config.get('storage', {})
+    if storage_config.get('timestamps') != 'epoch_ms':
+        logging.error("Set timestamps to epoch_ms in the storage section "
+                "first! Exiting...")
+        sys.exit(1)
+
+    sessionmaker = create_sessionmaker(get_connection_string(config),
+            config.get('sqlite'), pool_config=config.get('pool'))
+    source = create_storage(sessionmaker, dict(storage_config,
+        timestamps='datetime'))
+    target = create_storage(sessionmaker, storage_config)
+    moved = migrate_timestamps(sessionmaker, source, target)
+    logging.info("{} measurements migrated to epoch millisecond "
+            "timestamps.".format(moved))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# measurement queries for the dashboard and other readers
+
+import json
+from datetime import datetime, timezone
+
+import numpy as np
+from sqlalchemy import BigInteger, String, and_, cast, extract, func, \
+        literal, literal_column, or_, select, type_coerce
+
+from .db import DayRollup, EpochMillis, Measurement
+from .rollup import RESOLUTIONS
+
+
+# Granularity at which UTC offsets are looked up in utc_to_local. It has to be
+# fine enough for time zones with 30 or 45 minute offsets.
+_OFFSET_PROBE_MS = 15 * 60 * 1000
+
+
+def series_query(sensor_ids, start, end, resolution, since=None, raw=None):
+    """
+    Builds a query that returns (sensor_id, timestamp, value) rows ordered by
+    sensor and time. For rollup resolutions the value is the bucket average.
+
+    :param sensor_ids: The sensors to query
+    :param start: Start of the time range (UTC)
+    :param end: End of the time range (UTC)
+    :param resolution: 'raw' or one of the keys of rollup.RESOLUTIONS
+    :param since: Optional dict that maps sensor ids to per-sensor start times
+        overriding start
+    :param raw: The selectable raw measurements are read from (the
+        measurements table by default)
+    """
+    if resolution == 'raw':
+        table = raw if raw is not None else Measurement.__table__
+        timestamp = table.c.timestamp
+        value = table.c.value
+    else:
+        table = RESOLUTIONS[resolution][0]
+        timestamp = table.c.bucket
+        value = (table.c.total / table.c.count).label('value')
+
+    since = since or {}
+    conditions = []
+    rest = [s for s in sensor_ids if s not in since]
+    if rest:
+        conditions.append(and_(table.c.sensor_id.in_(rest), timestamp >= start))
+    for sensor_id, t in since.items():
+        conditions.append(and_(table.c.sensor_id==sensor_id, timestamp >= t))
+    return select(table.c.sensor_id, timestamp.label('timestamp'), value).where(
+            and_(or_(*conditions), timestamp < end)).order_by(
+            table.c.sensor_id, timestamp)
+
+
+# Aggregates of aggregate_query, in the order of its columns
+AGGREGATES = ('min', 'max', 'avg', 'last')
+
+
+def epoch_ms(column, dialect):
+    """
+    Returns a SQL expression that converts a timestamp column to UTC epoch
+    milliseconds in the database. DateTime columns are converted with second
+    precision.
+
+    :param column: A timestamp column (DateTime or EpochMillis)
+    :param dialect: The name of the database dialect
+    """
+    if isinstance(column.type, EpochMillis):
+        return type_coerce(column, BigInteger)
+    if dialect == 'sqlite':
+        seconds = cast(func.strftime('%s', column), BigInteger)
+    elif dialect == 'postgresql':
+        seconds = cast(func.floor(extract('epoch', column)), BigInteger)
+    elif dialect in ('mysql', 'mariadb'):
+        # UNIX_TIMESTAMP would depend on the time zone of the session.
+        seconds = func.timestampdiff(literal_column('SECOND'),
+                literal('1970-01-01'), column)
+    else:
+        raise ValueError("Unsupported database: {}".format(dialect))
+    return seconds * 1000
+
+
+def aggregate_query(raw, sensor_ids, start, end, bucket, dialect, after=None,
+        limit=None):
+    """
+    Builds a query that aggregates raw measurements into time buckets in the
+    database, and returns (sensor_id, bucket, min, max, avg, last) rows ordered
+    by sensor and bucket. Buckets are aligned to the epoch, and are identified
+    by the UTC epoch milliseconds of their start. Last is the value of the
+    latest measurement of the bucket.
+
+    :param raw: The selectable raw measurements are read from
+    :param sensor_ids: The sensors to query
+    :param start: Start of the time range (UTC)
+    :param end: End of the time range (UTC)
+    :param bucket: Bucket size in milliseconds
+    :param dialect: The name of the database dialect
+    :param after: Optional (sensor_id, timestamp) tuple for keyset pagination:
+        only measurements of later sensors, or of the same sensor from
+        timestamp on, are aggregated
+    :param limit: Optional maximum number of buckets
+    """
+    timestamp = raw.c.timestamp
+    bucket_start = (epoch_ms(timestamp, dialect) // bucket * bucket).label(
+            'bucket')
+    conditions = [raw.c.sensor_id.in_(sensor_ids), timestamp >= start,
+            timestamp < end]
+    if after:
+        conditions.append(or_(raw.c.sensor_id > after[0],
+            and_(raw.c.sensor_id == after[0], timestamp >= after[1])))
+    buckets = select(raw.c.sensor_id, bucket_start,
+            func.min(raw.c.value).label('min'),
+            func.max(raw.c.value).label('max'),
+            func.avg(raw.c.value).label('avg'),
+            func.max(timestamp).label('last_timestamp')).where(
+            and_(*conditions)).group_by(raw.c.sensor_id, bucket_start).order_by(
+            raw.c.sensor_id, bucket_start).limit(limit).subquery()
+
+    # The value of the latest measurement is looked up by primary key.
+    return select(buckets.c.sensor_id, buckets.c.bucket, buckets.c.min,
+            buckets.c.max, buckets.c.avg, raw.c.value.label('last')).join(
+            raw, and_(raw.c.sensor_id == buckets.c.sensor_id,
+                timestamp == buckets.c.last_timestamp, timestamp >= start,
+                timestamp < end)).order_by(
+            buckets.c.sensor_id, buckets.c.bucket)
+
+
+def fetch_columns(session, sensor_ids, start, end, resolution, since=None,
+        storage=None, chunk_size=100000):
+    """
+    Fetches the measurements of multiple sensors with a single query, and
+    returns them as NumPy arrays.
+
+    :param session: A database session
+    :param sensor_ids: The sensors to query
+    :param start: Start of the time range (UTC)
+    :param end: End of the time range (UTC)
+    :param resolution: 'raw' or one of the keys of rollup.RESOLUTIONS
+    :param since: Optional dict that maps sensor ids to per-sensor start times
+        overriding start
+    :param storage: The storage object raw measurements are read from
+    :param chunk_size: Number of rows converted to arrays at once
+    :return: A dict that maps sensor ids to (timestamps, values) arrays, where
+        timestamps are UTC epoch milliseconds. Raw measurements moved to the
+        archive of the storage are included.
+    """
+    if not sensor_ids:
+        return {}
+    raw = None
+    if resolution == 'raw' and storage is not None:
+        lower = min([start] + list((since or {}).values()))
+        raw = storage.select(session, lower, end)
+    query = series_query(sensor_ids, start, end, resolution, since, raw)
+    sids, timestamps, values = [], [], []
+    for s, t, v in read_chunks(session, query, chunk_size):
+        sids.append(s)
+        timestamps.append(t)
+        values.append(v)
+
+    columns = {sensor_id: (np.empty(0, dtype=np.int64), np.empty(0))
+            for sensor_id in sensor_ids}
+    if sids:
+        sids = np.concatenate(sids)
+        timestamps = np.concatenate(timestamps)
+        values = np.concatenate(values)
+
+        bounds = np.flatnonzero(np.diff(sids)) + 1
+        for s, e in zip(np.r_[0, bounds], np.r_[bounds, len(sids)]):
+            columns[int(sids[s])] = (timestamps[s:e], values[s:e])
+
+    if resolution == 'raw' and storage is not None and storage.archive:
+        _merge_archived(columns, storage.archive, start, end, since or {})
+    return columns
+
+
+def read_chunks(session, query, chunk_size=100000):
+    """
+    Runs a query that selects a timestamp column, and yields its rows in
+    chunks, as one NumPy array per column. Timestamps are converted to UTC
+    epoch milliseconds in bulk, and a value column to floats. Rows are
+    streamed (with a server-side cursor where the database supports it), so
+    memory use does not depend on the number of rows.
+
+    :param session: A database session
+    :param query: A select with a column labeled timestamp
+    :param chunk_size: Maximum number of rows per chunk
+    """
+    columns = list(query.selected_columns)
+    names = [c.name for c in columns]
+    i = names.index('timestamp')
+    epoch = isinstance(columns[i].type, EpochMillis)
+    if epoch:
+        # Epoch milliseconds are used as they are, without creating datetime
+        # objects.
+        columns[i] = type_coerce(columns[i], BigInteger)
+    elif session.get_bind().dialect.name == 'sqlite':
+        # SQLite stores timestamps as ISO strings, which NumPy parses an order
+        # of magnitude faster than datetime objects created by SQLAlchemy.
+        columns[i] = type_coerce(columns[i], String)
+    result = session.execute(query.with_only_columns(*columns).
+            execution_options(stream_results=True))
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunk = []
+        for name, c in zip(names, zip(*rows)):
+            if name == 'timestamp' and epoch:
+                chunk.append(np.array(c, dtype=np.int64))
+            elif name == 'timestamp':
+                chunk.append(np.array(c, dtype='datetime64[ms]').astype(
+                    np.int64))
+            elif name == 'value':
+                chunk.append(np.array(c, dtype=np.float64))
+            else:
+                chunk.append(np.array(c))
+        yield chunk
+    result.close()
+
+
+def _merge_archived(columns, archive, start, end, since):
+    """
+    Prepends archived points to the columns read from the database. Archived
+    points are older than any row left in the database, so only the range
+    before the first row of a sensor is read from the archive.
+    """
+    end_ms = to_epoch_ms(end)
+    for sensor_id, (timestamps, values) in columns.items():
+        lower = to_epoch_ms(since.get(sensor_id, start))
+        upper = timestamps[0] if len(timestamps) else end_ms
+        t, v = archive.read(sensor_id, lower, upper)
+        if len(t):
+            columns[sensor_id] = (np.concatenate((t, timestamps)),
+                    np.concatenate((v, values)))
+    return columns
+
+
+def first_timestamp(session, sensor_ids):
+    """
+    Returns the start of the first day with measurements of some sensors, or
+    None if they have none. The day rollups are kept for archived measurements
+    too, so they cover the whole history.
+    """
+    return session.execute(select(func.min(DayRollup.bucket)).where(
+        DayRollup.sensor_id.in_(sensor_ids))).scalar()
+
+
+def to_epoch_ms(dt):
+    """Converts a naive UTC datetime to epoch milliseconds."""
+    return int(np.array([dt], dtype='datetime64[ms]').astype(np.int64)[0])
+
+
+def utc_to_local(timestamps, tz):
+    """
+    Converts UTC epoch milliseconds to local wall time epoch milliseconds. The
+    UTC offset is looked up once per distinct quarter hour, not once per
+    timestamp.
+
+    :param timestamps: An array of UTC epoch milliseconds
+    :param tz: A tzinfo object (pytz or zoneinfo)
+    """
+    if not len(timestamps):
+        return timestamps
+    probes, inverse = np.unique(timestamps // _OFFSET_PROBE_MS,
+            return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(
+        p * _OFFSET_PROBE_MS / 1000, tz).utcoffset().total_seconds() * 1000
+        for p in probes.tolist()], dtype=np.int64)
+    return timestamps + offsets[inverse.reshape(-1)]
+
+
+def local_to_utc(dt, tz):
+    """
+    Converts a naive local wall time datetime to a naive UTC datetime.
+
+    :param dt: A naive datetime in the time zone tz
+    :param tz: A tzinfo object (pytz or zoneinfo)
+    """
+    if hasattr(tz, 'localize'):
+        dt = tz.localize(dt)
+    else:
+        dt = dt.replace(tzinfo=tz)
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def encode_columns(columns, precision=3, raw=()):
+    """
+    Serializes columns returned by fetch_columns to compact JSON. Timestamps
+    are delta-encoded, values are rounded to precision decimals.
+
+    :param columns: A dict that maps sensor ids to (timestamps, values) arrays
+    :param precision: Number of decimals kept from values
+    :param raw: The ids of the sensors whose columns hold every raw
+        measurement of the time range, i.e. are neither rollups nor
+        downsampled
+    """
+    encoded = {}
+    for sensor_id, (timestamps, values) in columns.items():
+        encoded[str(sensor_id)] = {
+            'start': int(timestamps[0]) if len(timestamps) else 0,
+            'delta': np.diff(timestamps).tolist(),
+            'value': np.round(values, precision).tolist()
+        }
+        if sensor_id in raw:
+            encoded[str(sensor_id)]['raw'] = True
+    return json.dumps(encoded, separators=(',', ':'))
+
+
+def decode_columns(data, raw=None):
+    """
+    Deserializes the output of encode_columns.
+
+    :param data: JSON string created by encode_columns
+    :param raw: An optional set the ids of the sensors with raw columns are
+        added to
+    :return: A dict that maps sensor ids to (timestamps, values) arrays
+    """
+    columns = {}
+    for sensor_id, c in json.loads(data).items():
+        if raw is not None and c.get('raw'):
+            raw.add(int(sensor_id))
+        values = np.array(c['value'], dtype=np.float64)
+        if len(values):
+            timestamps = np.cumsum(np.r_[c['start'], c['delta']]).astype(
+                    np.int64)
+        else:
+            timestamps = np.empty(0, dtype=np.int64)
+        columns[int(sensor_id)] = (timestamps, values)
+    return columns
@@ -0,0 +1,237 @@
+# store-and-forward replication of measurements to a central database
+
+import logging
+import socket
+import threading
+import time
+
+from sqlalchemy import BigInteger, literal_column, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from .db import ReplicationMark, Sensor, create_sessionmaker, \
+        get_or_create_sensors, record_changes
+from .rollup import rebuild, update_rollups
+from .storage import create_storage
+
+
+class Replicator():
+    """
+    Ships the raw measurements of a local SQLite database to a central
+    database in the background, so a node keeps storing measurements while the
+    central database is unreachable. New rows are found by their SQLite rowid,
+    which grows with every insert. The largest rowid shipped from every table
+    (the high-water mark) is stored in the central database, in the same
+    transaction as the rows and their rollups, so every row is shipped once,
+    even if the node stops in the middle of a batch. Rows that are already in
+    the central database (e.g. after its marks were lost) are skipped, and the
+    rollups of their days are rebuilt. Sensors are created in the central
+    database by name and type.
+
+    Failed shipments are retried with exponential backoff. Measurements moved
+    to the archive before they were shipped are not replicated.
+
+    :config connection_string: The connection string of the central database
+    :config storage: The storage section of the central database
+    :config pool: The pool section of the central database
+    :config node: The name of this node (the host name by default)
+    :config prefix: Prefix of the names of this node's sensors in the central
+        database (<node>/ by default, so sensors of different nodes with the
+        same name are kept apart)
+    :config batch_size: Maximum number of rows shipped in one transaction
+    :config interval: Seconds between shipments when there is nothing left
+    :config backoff: Seconds to wait after the first failed shipment
+    :config max_backoff: Maximum seconds to wait between retries
+    """
+    def __init__(self, sessionmaker, storage, config):
+        """
+        Constructs a new 'Replicator' object. The central database is
+        connected by the background thread, so start works even if it is
+        unreachable.
+
+        :param sessionmaker: The session factory of the local SQLite
+            database (read-only is enough)
+        :param storage: The storage object of the local database
+        :param config: The replication section of the configuration
+        """
+        self._sessionmaker = sessionmaker
+        self._storage = storage
+        self._config = config
+        self._node = config.get('node', socket.gethostname())
+        self._prefix = config.get('prefix', self._node + '/')
+        self._batch_size = config.get('batch_size', 5000)
+        self._interval = config.get('interval', 10)
+        self._backoff = config.get('backoff', 5)
+        self._max_backoff = config.get('max_backoff', 600)
+        dialect = sessionmaker.get_bind().dialect.name
+        if dialect != 'sqlite':
+            raise ValueError("Replication needs a local SQLite database, not "
+                    "{}.".format(dialect))
+
+        self._central = None
+        self._central_storage = None
+        self._marks = {}
+        self._sensor_ids = {}
+
+        self._lock = threading.Lock()
+        self._counters = {
+            'rows_shipped': 0,
+            'batches': 0,
+            'failures': 0,
+            'last_success': 0.0,
+        }
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the background thread."""
+        self._thread = threading.Thread(target=self._run, name='Replicator',
+                daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stops the background thread after its current shipment."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        """
+        Returns a snapshot of the replicator's counters.
+
+        :return: A dict with rows_shipped, batches, failures and last_success
+            (a Unix time)
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def _connect(self):
+        if self._central is None:
+            central = create_sessionmaker(self._config['connection_string'],
+                    pool_config=self._config.get('pool'))
+            self._central_storage = create_storage(central,
+                    self._config.get('storage'))
+            self._central = central
+
+    def ship(self):
+        """
+        Ships at most one batch from every local table of raw measurements.
+
+        :return: The number of rows shipped
+        :raises SQLAlchemyError: If a database can not be reached
+        :raises ValueError: If the central name of a sensor is too long
+        """
+        self._connect()
+        shipped = 0
+        session = self._sessionmaker()
+        try:
+            tables = self._storage.tables(session)
+            if self._storage.partitioned:
+                tables = [self._storage.table] + tables
+            for table in tables:
+                shipped += self._ship_table(session, table)
+        finally:
+            session.close()
+        return shipped
+
+    def _ship_table(self, session, table):
+        central = self._central()
+        try:
+            mark = self._marks.get(table.name)
+            if mark is None:
+                mark = central.get(ReplicationMark, (self._node, table.name))
+                mark = mark.rowid if mark is not None else 0
+
+            rowid = literal_column('rowid', BigInteger)
+            rows = session.execute(select(rowid.label('rowid'),
+                table.c.sensor_id, table.c.timestamp, table.c.value).where(
+                rowid > mark).order_by(rowid).limit(self._batch_size)).all()
+            if not rows:
+                self._marks[table.name] = mark
+                return 0
+
+            sensor_ids = self._map_sensors(session, central,
+                    set(r.sensor_id for r in rows))
+            batch = [{'timestamp': r.timestamp,
+                'sensor_id': sensor_ids[r.sensor_id], 'value': r.value}
+                for r in rows]
+            if self._central_storage.insert(central, batch, 'skip') == \
+                    len(batch):
+                update_rollups(central, batch)
+            else:
+                # Some rows were there already (or the database does not
+                # tell), so the rollups of their days are recomputed instead
+                # of counting them twice.
+                timestamps = [r['timestamp'] for r in batch]
+                rebuild(central, self._central_storage,
+                        set(r['sensor_id'] for r in batch), min(timestamps),
+                        max(timestamps))
+            changes = {}
+            for r in batch:
+                changes[r['sensor_id']] = min(r['timestamp'],
+                        changes.get(r['sensor_id'], r['timestamp']))
+            record_changes(central, changes)
+            central.merge(ReplicationMark(node=self._node, source=table.name,
+                rowid=rows[-1].rowid))
+            central.commit()
+        finally:
+            central.close()
+
+        # Sensors created in the transaction are only remembered once it is
+        # committed.
+        self._sensor_ids = sensor_ids
+        self._marks[table.name] = rows[-1].rowid
+        with self._lock:
+            self._counters['rows_shipped'] += len(rows)
+            self._counters['batches'] += 1
+        return len(rows)
+
+    def _map_sensors(self, session, central, sensor_ids):
+        """
+        Looks up or creates the central ids of local sensors.
+
+        :return: A dict that maps local sensor ids to central ones
+        """
+        mapping = dict(self._sensor_ids)
+        missing = sensor_ids - set(mapping)
+        if missing:
+            sensors = session.query(Sensor).filter(
+                    Sensor.id.in_(missing)).all()
+            length = Sensor.name.type.length
+            for s in sensors:
+                if len(self._prefix + s.name) > length:
+                    raise ValueError("The central name of sensor {} is "
+                            "longer than {} characters, set a shorter "
+                            "prefix.".format(s.name, length))
+            ids = get_or_create_sensors(central, [(self._prefix + s.name,
+                s.type, s.description) for s in sensors])
+            for s in sensors:
+                mapping[s.id] = ids[(self._prefix + s.name, s.type)]
+        return mapping
+
+    def _run(self):
+        failures = 0
+        delay = 0
+        while not self._stop.wait(delay):
+            try:
+                shipped = self.ship()
+            except Exception as e:
+                # Any error is retried, so the thread keeps running.
+                failures += 1
+                delay = min(self._backoff * 2 ** (failures - 1),
+                        self._max_backoff)
+                with self._lock:
+                    self._counters['failures'] += 1
+                if isinstance(e, SQLAlchemyError):
+                    logging.warning("Replication failed, retrying in {} "
+                            "seconds: {}".format(delay, e))
+                else:
+                    logging.exception("Replication failed, retrying in {} "
+                            "seconds!".format(delay))
+                continue
+            if failures:
+                logging.info("Replication resumed.")
+            failures = 0
+            with self._lock:
+                self._counters['last_success'] = time.time()
+            # Batches are shipped back to back until the node has caught up.
+            delay = 0 if shipped else self._interval
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# incrementally maintained minute/hour/day rollups of measurements
+
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from logging.config import dictConfig
+
+from sqlalchemy import and_, bindparam, case, delete, select
+
+from .config import get_connection_string, load_config
+from .db import DayRollup, HourRollup, MinuteRollup, create_sessionmaker, \
+        record_changes
+from .storage import create_storage, scan
+
+
+# Ordered from the finest to the coarsest resolution.
+RESOLUTIONS = OrderedDict([
+    ('minute', (MinuteRollup.__table__, timedelta(minutes=1))),
+    ('hour', (HourRollup.__table__, timedelta(hours=1))),
+    ('day', (DayRollup.__table__, timedelta(days=1))),
+])
+
+
+def truncate(timestamp, resolution):
+    """
+    Returns the start of the bucket timestamp falls into.
+
+    :param timestamp: A datetime
+    :param resolution: One of the keys of RESOLUTIONS
+    """
+    timestamp = timestamp.replace(second=0, microsecond=0)
+    if resolution in ('hour', 'day'):
+        timestamp = timestamp.replace(minute=0)
+    if resolution == 'day':
+        timestamp = timestamp.replace(hour=0)
+    return timestamp
+
+
+def choose_resolution(start, end, min_points):
+    """
+    Picks the coarsest resolution that still yields at least min_points
+    buckets between start and end.
+
+    :param start: Start of the time range
+    :param end: End of the time range
+    :param min_points: Minimum number of points wanted per sensor
+    :return: One of the keys of RESOLUTIONS, or 'raw'
+    """
+    span = end - start
+    for resolution in reversed(RESOLUTIONS):
+        step = RESOLUTIONS[resolution][1]
+        if span // step >= min_points:
+            return resolution
+    return 'raw'
+
+
+def _aggregate(rows, resolution):
+    buckets = {}
+    for row in rows:
+        key = (row['sensor_id'], truncate(row['timestamp'], resolution))
+        value = row['value']
+        b = buckets.get(key)
+        if b is None:
+            buckets[key] = [value, value, value, 1]
+        else:
+            b[0] = min(b[0], value)
+            b[1] = max(b[1], value)
+            b[2] += value
+            b[3] += 1
+    return buckets
+
+
+def update_rollups(session, rows):
+    """
+    Merges a batch of raw measurements into the rollup tables. The caller is
+    responsible for committing the session.
+
+    :param session: The session the raw rows are inserted with
+    :param rows: A list of dicts with timestamp, sensor_id and value keys
+    """
+    if not rows:
+        return
+    for resolution, (table, _) in RESOLUTIONS.items():
+        buckets = _aggregate(rows, resolution)
+        sensor_ids = set(k[0] for k in buckets)
+        bucket_times = [k[1] for k in buckets]
+        existing = set(tuple(r) for r in session.execute(
+            select(table.c.sensor_id, table.c.bucket).where(and_(
+                table.c.sensor_id.in_(sensor_ids),
+                table.c.bucket >= min(bucket_times),
+                table.c.bucket <= max(bucket_times)))))
+
+        inserts = []
+        updates = []
+        for (sensor_id, bucket), (mn, mx, total, count) in buckets.items():
+            if (sensor_id, bucket) in existing:
+                updates.append({'b_sensor_id': sensor_id, 'b_bucket': bucket,
+                    'b_minimum': mn, 'b_maximum': mx,
+                    'b_total': total, 'b_count': count})
+            else:
+                inserts.append({'sensor_id': sensor_id, 'bucket': bucket,
+                    'minimum': mn, 'maximum': mx,
+                    'total': total, 'count': count})
+
+        if inserts:
+            session.execute(table.insert(), inserts)
+        if updates:
+            session.execute(table.update().where(and_(
+                    table.c.sensor_id==bindparam('b_sensor_id'),
+                    table.c.bucket==bindparam('b_bucket'))).values(
+                minimum=case(
+                    (table.c.minimum < bindparam('b_minimum'),
+                        table.c.minimum),
+                    else_=bindparam('b_minimum')),
+                maximum=case(
+                    (table.c.maximum > bindparam('b_maximum'),
+                        table.c.maximum),
+                    else_=bindparam('b_maximum')),
+                total=table.c.total + bindparam('b_total'),
+                count=table.c.count + bindparam('b_count')), updates)
+
+
+def backfill(sessionmaker, storage, chunk_size=50000):
+    """
+    Rebuilds the rollup tables from the raw measurements. It should be run
+    while TerraPi is stopped, otherwise measurements that are stored during the
+    backfill may be counted twice.
+
+    :param sessionmaker: The session factory
+    :param storage: The storage object raw measurements are read from
+    :param chunk_size: Number of raw rows processed per transaction
+    :return: The number of raw rows processed
+    """
+    session = sessionmaker()
+    for table, _ in RESOLUTIONS.values():
+        session.execute(delete(table))
+    session.commit()
+
+    processed = 0
+    for table in storage.tables(session):
+        for rows in scan(session, table, chunk_size):
+            update_rollups(session, [{'timestamp': r.timestamp,
+                'sensor_id': r.sensor_id, 'value': r.value} for r in rows])
+            session.commit()
+            processed += len(rows)
+            logging.info("Rolled up {} measurements.".format(processed))
+
+    session.close()
+    return processed
+
+
+def rebuild(session, storage, sensor_ids, start, end, chunk_size=50000):
+    """
+    Recomputes the rollups of some sensors in a time range from the raw
+    measurements, e.g. after measurements were imported. The range is widened
+    to whole days, so every bucket is rebuilt from all of its measurements.
+    The caller is responsible for committing the session.
+
+    :param session: A database session
+    :param storage: The storage object raw measurements are read from
+    :param sensor_ids: The sensors to rebuild the rollups of
+    :param start: Start of the time range (UTC)
+    :param end: End of the time range (UTC)
+    :param chunk_size: Number of raw rows processed at once
+    :return: The number of raw rows processed
+    """
+    sensor_ids = list(sensor_ids)
+    start = truncate(start, 'day')
+    end = truncate(end, 'day') + timedelta(days=1)
+    for table, _ in RESOLUTIONS.values():
+        session.execute(delete(table).where(and_(
+            table.c.sensor_id.in_(sensor_ids),
+            table.c.bucket >= start, table.c.bucket < end)))
+
+    record_changes(session, {sensor_id: start for sensor_id in sensor_ids})
+
+    processed = 0
+    if storage.archive:
+        # The query module depends on this one, so it is imported here.
+        from .query import to_epoch_ms
+
+        for sensor_id in sensor_ids:
+            for t, v in storage.archive.read_months(sensor_id,
+                    to_epoch_ms(start), to_epoch_ms(end)):
+                update_rollups(session, [{'timestamp': timestamp,
+                    'sensor_id': sensor_id, 'value': value}
+                    for timestamp, value in zip(
+                        t.astype('datetime64[ms]').tolist(), v.tolist())])
+                processed += len(t)
+    for table in storage.tables(session, start, end):
+        for rows in scan(session, table, chunk_size, and_(
+                table.c.sensor_id.in_(sensor_ids),
+                table.c.timestamp >= start, table.c.timestamp < end)):
+            update_rollups(session, [{'timestamp': r.timestamp,
+                'sensor_id': r.sensor_id, 'value': r.value} for r in rows])
+            processed += len(rows)
+    return processed
+
+
+def main():
+    config = load_config()
+    if config.get('logging'):
+        dictConfig(config['logging'])
+
+    sessionmaker = create_sessionmaker(get_connection_string(config),
+            config.get('sqlite'), pool_config=config.get('pool'))
+    storage = create_storage(sessionmaker, config.get('storage'))
+    processed = backfill(sessionmaker, storage)
+    logging.info("Backfill finished, {} measurements rolled up.".format(
+        processed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+// Appends new measurements to the dashboard figures. New measurements are
+// pushed by TerraPi over server-sent events if TERRAPI_LIVE.url is set and the
+// browser supports them, and polled from /updates otherwise. Traces of raw
+// measurements that are not downsampled are extended. The points of other
+// traces summarize buckets, so new measurements go to the live tail trace of
+// their sensor instead, until the refresh of the dashboard redraws them.
+// Zoomed figures that end at the newest measurement move along with them.
+//
+// Also debounces the range queries of zoomed figures: when a figure is zoomed
+// again before its query is sent, only the last zoom is queried.
+(function(config) {
+    // UTC epoch milliseconds of the last point of every sensor, seeded from
+    // the figures.
+    var cursor = {};
+
+    // Returns the figure trace of a sensor, or its live tail trace if tail is
+    // set, if it is drawn.
+    function traceOf(sensor, tail) {
+        var trace = config.traces[sensor];
+        var element = trace && document.getElementById(trace[0]);
+        return element && element.data ?
+            element.data[trace[tail ? 2 : 1]] : null;
+    }
+
+    // Converts between the local wall time the figures show, without a time
+    // zone, and local epoch milliseconds.
+    function parseLocal(x) {
+        return Date.parse(String(x).replace(' ', 'T') + 'Z');
+    }
+
+    function formatLocal(ms) {
+        return new Date(ms).toISOString().replace('Z', '');
+    }
+
+    // Returns the local epoch milliseconds of the last point of a trace, or
+    // null if it is empty.
+    function lastX(trace) {
+        var x = trace.x || [];
+        return x.length ? parseLocal(x[x.length - 1]) : null;
+    }
+
+    // Returns the local epoch milliseconds of the last point of a figure, or
+    // null if it has none.
+    function lastOfFigure(element) {
+        return (element.data || []).reduce(function(last, trace) {
+            var x = lastX(trace);
+            return x !== null && (last === null || x > last) ? x : last;
+        }, null);
+    }
+
+    // Moves the x axis range of a zoomed figure to its new measurements, if
+    // the range ended at the last measurement before them. Plotly.react does
+    // not emit a relayout event, so the figure is not queried again.
+    function follow(element, before) {
+        var layout = element.layout || {};
+        var range = layout.xaxis && !layout.xaxis.autorange &&
+            layout.xaxis.range;
+        var after = lastOfFigure(element);
+        if (!range || before === null || after === null ||
+                parseLocal(range[1]) < before || after <= parseLocal(range[1])) {
+            return;
+        }
+        var shift = after - parseLocal(range[1]);
+        var xaxis = Object.assign({}, layout.xaxis,
+            {range: [formatLocal(parseLocal(range[0]) + shift),
+                formatLocal(after)]});
+        Plotly.react(element, element.data,
+            Object.assign({}, layout, {xaxis: xaxis}));
+    }
+
+    // Starts the cursor of every drawn sensor at the last point of its trace,
+    // so measurements stored since the figure was queried are not missed.
+    function seed() {
+        Object.keys(config.traces).forEach(function(sensor) {
+            var trace = traceOf(sensor);
+            if (cursor[sensor] === undefined && trace) {
+                var last = lastX(trace);
+                cursor[sensor] = last === null ? Date.now() :
+                    last - config.utc_offset;
+            }
+        });
+    }
+
+    function extend(columns) {
+        var updates = {};
+        Object.keys(columns).forEach(function(sensor) {
+            var c = columns[sensor];
+            if (!c[0].length) {
+                return;
+            }
+            cursor[sensor] = Math.max(cursor[sensor] || 0,
+                c[0][c[0].length - 1]);
+
+            var main = traceOf(sensor);
+            var tail = main && !/:raw$/.test(main.uid || '');
+            var trace = tail ? traceOf(sensor, true) : main;
+            if (!trace) {
+                return;
+            }
+            // Skip points the figure already has, e.g. a batch pushed while
+            // the same rows were being polled.
+            var last = lastX(trace);
+            var first = 0;
+            while (last !== null && first < c[1].length && c[1][first] <= last) {
+                first++;
+            }
+            if (first === c[1].length) {
+                return;
+            }
+
+            var graph = config.traces[sensor][0];
+            var u = updates[graph] = updates[graph] ||
+                {x: [], y: [], indices: []};
+            u.x.push(c[1].slice(first).map(formatLocal));
+            u.y.push(c[2].slice(first));
+            u.indices.push(config.traces[sensor][tail ? 2 : 1]);
+        });
+        Object.keys(updates).forEach(function(graph) {
+            var u = updates[graph];
+            var element = document.getElementById(graph);
+            if (window.Plotly) {
+                var before = lastOfFigure(element);
+                Plotly.extendTraces(element, {x: u.x, y: u.y}, u.indices);
+                follow(element, before);
+            }
+        });
+    }
+
+    // Fetches the measurements newer than the cursor, and polls again after
+    // poll_interval if repeat is set.
+    function poll(repeat) {
+        seed();
+        var url = '/updates?cursor=' + encodeURIComponent(JSON.stringify(cursor));
+        fetch(url, {credentials: 'same-origin'}).then(function(response) {
+            return response.json();
+        }).then(function(data) {
+            extend(data.columns);
+        }).catch(function() {}).then(function() {
+            if (repeat) {
+                setTimeout(poll, config.poll_interval * 1000, true);
+            }
+        });
+    }
+
+    function push() {
+        var source = new EventSource(config.url);
+        var opened = false;
+        source.onopen = function() {
+            opened = true;
+            // Measurements stored before the stream was (re)opened are
+            // fetched once.
+            poll(false);
+        };
+        source.onmessage = function(event) {
+            extend(JSON.parse(event.data).columns);
+        };
+        source.onerror = function() {
+            // Browsers reconnect to streams that were open, but a stream that
+            // never opened is not coming.
+            if (!opened) {
+                source.close();
+                poll(true);
+            }
+        };
+    }
+
+    // Returns the figure a Dash callback request is for, if it was triggered
+    // by zooming.
+    function zoomedFigure(url, options) {
+        if (String(url).indexOf('_dash-update-component') === -1 ||
+                !options || typeof options.body !== 'string') {
+            return null;
+        }
+        var body = JSON.parse(options.body);
+        var zoomed = (body.inputs || []).some(function(input) {
+            return input.property === 'relayoutData' && input.value &&
+                Object.keys(input.value).some(function(key) {
+                    return key.indexOf('xaxis.') === 0;
+                });
+        });
+        return zoomed && body.output.property === 'figure' ?
+            body.output.id : null;
+    }
+
+    var pending = {};
+    var originalFetch = window.fetch;
+    window.fetch = function(url, options) {
+        var figure = config.debounce ? zoomedFigure(url, options) : null;
+        if (!figure) {
+            return originalFetch.apply(this, arguments);
+        }
+        var self = this, args = arguments;
+        var p = pending[figure];
+        if (p) {
+            clearTimeout(p.timer);
+        } else {
+            p = pending[figure] = {waiters: []};
+        }
+        return new Promise(function(resolve, reject) {
+            p.waiters.push({resolve: resolve, reject: reject});
+            // Superseded requests get the response of the last one, so the
+            // figure is only drawn from the last zoom.
+            p.timer = setTimeout(function() {
+                delete pending[figure];
+                originalFetch.apply(self, args).then(function(response) {
+                    p.waiters.forEach(function(w, i) {
+                        w.resolve(i === p.waiters.length - 1 ?
+                            response : response.clone());
+                    });
+                }, function(error) {
+                    p.waiters.forEach(function(w) {
+                        w.reject(error);
+                    });
+                });
+            }, config.debounce);
+        });
+    };
+
+    if (config.url && window.EventSource) {
+        push();
+    } else if (config.poll_interval) {
+        poll(true);
+    }
+})(TERRAPI_LIVE);
@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+# storage modes for raw measurements
+
+import io
+import logging
+import re
+import sys
+from datetime import datetime, timedelta
+from logging.config import dictConfig
+
+from sqlalchemy import Column, DateTime, Float, Integer, MetaData, Table, \
+        and_, event, inspect, or_, select, text, union_all
+from sqlalchemy.exc import DBAPIError
+
+from .archive import create_archive
+from .config import get_connection_string, load_config
+from .db import EpochMeasurement, EpochMillis, Measurement, Sensor, \
+        create_sessionmaker
+
+
+_TIMESTAMP_FORMATS = ('datetime', 'epoch_ms')
+_CONFLICT_POLICIES = (None, 'skip', 'overwrite')
+_INSERT_METHODS = ('auto', 'executemany', 'values')
+
+# Rows per multi-row INSERT statement. With three columns this stays below the
+# bound parameter limit of SQLite.
+_VALUES_CHUNK = 1000
+
+
+def after(pk, key):
+    """
+    Returns a filter expression that is true for rows that come after key in
+    primary key order.
+
+    :param pk: The primary key columns
+    :param key: The values of the primary key columns
+    """
+    return or_(*[and_(*([pk[j]==key[j] for j in range(i)] + [pk[i] > key[i]]))
+        for i in range(len(pk))])
+
+
+def insert_statement(session, table, on_conflict=None):
+    """
+    Returns an insert statement for measurements, that handles rows whose
+    primary key is already in the table according to a policy:
+
+    * `None`: the insert fails
+    * `skip`: the existing rows are kept
+    * `overwrite`: the values of the existing rows are replaced
+
+    :param session: A database session
+    :param table: The table to insert into
+    :param on_conflict: The conflict policy
+    """
+    if on_conflict not in _CONFLICT_POLICIES:
+        raise ValueError("Invalid conflict policy {}.".format(on_conflict))
+    if on_conflict is None:
+        return table.insert()
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table)
+        if on_conflict == 'skip':
+            return statement.on_conflict_do_nothing()
+        return statement.on_conflict_do_update(
+                index_elements=list(table.primary_key.columns),
+                set_={'value': statement.excluded.value})
+    elif dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table)
+        if on_conflict == 'skip':
+            return statement.prefix_with('IGNORE')
+        return statement.on_duplicate_key_update(
+                value=statement.inserted.value)
+    raise ValueError("Conflict policies are not supported on {}.".format(
+        dialect))
+
+
+def insert_rows(session, table, rows, on_conflict=None, method='auto'):
+    """
+    Inserts measurements into a table with one of the methods:
+
+    * `executemany`: one insert statement executed with every row (drivers of
+      MySQL and PostgreSQL send these in batches)
+    * `values`: multi-row INSERT ... VALUES statements
+    * `auto`: COPY ... FROM STDIN on PostgreSQL with psycopg2 or psycopg,
+      which is the fastest way to load rows there, and executemany otherwise.
+      COPY can not skip or overwrite rows, so it is not used with a conflict
+      policy.
+
+    :param session: A database session
+    :param table: The table to insert into
+    :param rows: A list of dicts with timestamp, sensor_id and value keys
+    :param on_conflict: The conflict policy (see insert_statement)
+    :param method: One of the methods above
+    :return: The number of rows inserted or updated, or -1 if the database
+        does not report it
+    """
+    if method not in _INSERT_METHODS:
+        raise ValueError("Invalid insert method {}.".format(method))
+    dialect = session.get_bind().dialect
+    if method == 'auto' and on_conflict is None and \
+            dialect.name == 'postgresql' and \
+            dialect.driver in ('psycopg2', 'psycopg'):
+        return _copy(session, table, rows)
+
+    statement = insert_statement(session, table, on_conflict)
+    if method != 'values':
+        return session.execute(statement, rows).rowcount
+    inserted = 0
+    for i in range(0, len(rows), _VALUES_CHUNK):
+        rowcount = session.execute(statement.values(
+            rows[i:i+_VALUES_CHUNK])).rowcount
+        if rowcount < 0 or inserted < 0:
+            inserted = -1
+        else:
+            inserted += rowcount
+    return inserted
+
+
+def _copy(session, table, rows):
+    """Loads rows into a PostgreSQL table with COPY ... FROM STDIN."""
+    preparer = session.get_bind().dialect.identifier_preparer
+    epoch = isinstance(table.c.timestamp.type, EpochMillis)
+    data = ''.join('{}\t{}\t{!r}\n'.format(
+        EpochMillis().process_bind_param(r['timestamp'], None) if epoch
+            else r['timestamp'].isoformat(' '),
+        r['sensor_id'], float(r['value'])) for r in rows)
+    sql = 'COPY {} ({}) FROM STDIN'.format(preparer.format_table(table),
+            ', '.join(preparer.quote(c)
+                for c in ('timestamp', 'sensor_id', 'value')))
+
+    # COPY runs on the driver's cursor, in the transaction of the session.
+    # Errors of the driver are wrapped like SQLAlchemy wraps them, e.g. a
+    # duplicate row raises IntegrityError.
+    dialect = session.get_bind().dialect
+    cursor = session.connection().connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert(sql, io.StringIO(data))
+        else:
+            with cursor.copy(sql) as copy:
+                copy.write(data)
+    except dialect.dbapi.Error as e:
+        raise DBAPIError.instance(sql, None, e, dialect.dbapi.Error,
+                dialect=dialect) from e
+    finally:
+        cursor.close()
+    return len(rows)
+
+
+def scan(session, table, chunk_size, where=None):
+    """
+    Reads a table in primary key order, in chunks of at most chunk_size rows.
+    Every chunk is a separate keyset query, so memory use does not depend on
+    the size of the table.
+
+    :param session: A database session
+    :param table: The table to read
+    :param chunk_size: Maximum number of rows per chunk
+    :param where: Optional filter expression
+    :return: A generator of lists of rows
+    """
+    pk = list(table.primary_key.columns)
+    query = select(*table.columns).order_by(*pk).limit(chunk_size)
+    if where is not None:
+        query = query.where(where)
+    last = None
+    while True:
+        q = query
+        if last is not None:
+            q = q.where(after(pk, last))
+        rows = session.execute(q).fetchall()
+        if not rows:
+            return
+        yield rows
+        last = [getattr(rows[-1], c.name) for c in pk]
+
+
+class TableStorage():
+    """
+    The default storage mode: every measurement is stored in the measurements
+    table, or in the measurements_ms table with epoch millisecond timestamps.
+
+    :config archive: Optional archive settings (directory and older_than).
+        Measurements moved to the archive by terrapi-archive are still
+        returned by queries.
+    :config timestamps: 'datetime' or 'epoch_ms'
+    :config insert_method: 'auto', 'executemany' or 'values' (see
+        insert_rows)
+    """
+    partitioned = False
+
+    def __init__(self, sessionmaker, config=None):
+        config = config or {}
+        self._sessionmaker = sessionmaker
+        self.archive = None
+        if config.get('archive'):
+            self.archive = create_archive(config)
+        timestamps = config.get('timestamps', 'datetime')
+        if timestamps not in _TIMESTAMP_FORMATS:
+            raise ValueError("Invalid timestamp format {}.".format(
+                timestamps))
+        self.epoch = timestamps == 'epoch_ms'
+        self.insert_method = config.get('insert_method', 'auto')
+        if self.insert_method not in _INSERT_METHODS:
+            raise ValueError("Invalid insert method {}.".format(
+                self.insert_method))
+        if self.epoch:
+            self.table = EpochMeasurement.__table__
+        else:
+            self.table = Measurement.__table__
+
+    def insert(self, session, rows, on_conflict=None):
+        """
+        Inserts a batch of measurements. The caller is responsible for
+        committing the session.
+
+        :param session: A database session
+        :param rows: A list of dicts with timestamp, sensor_id and value keys
+        :param on_conflict: How rows already in the database are handled (see
+            insert_statement)
+        :return: The number of rows inserted or updated, or -1 if the
+            database does not report it
+        """
+        return insert_rows(session, self.table, rows, on_conflict,
+                self.insert_method)
+
+    def tables(self, session, start=None, end=None):
+        """
+        Returns the tables that may hold measurements between start and end.
+
+        :param session: A database session
+        :param start: Optional start of the time range (UTC)
+        :param end: Optional end of the time range (UTC)
+        """
+        return [self.table]
+
+    def select(self, session, start=None, end=None):
+        """
+        Returns a selectable with timestamp, sensor_id and value columns that
+        covers every measurement between start and end.
+
+        :param session: A database session
+        :param start: Optional start of the time range (UTC)
+        :param end: Optional end of the time range (UTC)
+        """
+        return self.table
+
+    def apply_retention(self, now=None):
+        """Retention policies are only supported with partitioned storage."""
+        return []
+
+
+class PartitionedStorage(TableStorage):
+    """
+    Stores measurements in one table per sensor type and month, e.g.
+    measurements_temperature_2018_04. On PostgreSQL these are native range
+    partitions of one table per sensor type (measurements_temperature). The
+    primary key of every partition is (sensor_id, timestamp), so per-sensor
+    range queries are served by an index. With epoch millisecond timestamps
+    the tables are named measurements_ms_<type>[_<year>_<month>].
+
+    Expired data is removed by dropping whole partitions.
+
+    :config retention: A dict that maps sensor type names to the number of
+        days their measurements are kept
+    """
+    partitioned = True
+
+    def __init__(self, sessionmaker, config=None):
+        super().__init__(sessionmaker, config)
+        config = config or {}
+        self._prefix = self.table.name
+        self._name_re = re.compile(r'^{}_([a-z]+)_(\d{{4}})_(\d{{2}})$'.format(
+            self._prefix))
+        self._retention = config.get('retention', {})
+        self._metadata = MetaData()
+        self._sensor_types = {}
+        # Partitions known to exist, because they were created in a committed
+        # transaction.
+        self._created = set()
+
+        session = sessionmaker()
+        self._postgres = session.get_bind().dialect.name == 'postgresql'
+        if self._postgres and self.insert_method == 'auto' and \
+                session.connection().dialect.server_version_info < (11,):
+            # COPY into partitioned tables needs PostgreSQL 11.
+            self.insert_method = 'executemany'
+        session.close()
+
+    @staticmethod
+    def _month(timestamp):
+        return timestamp.year, timestamp.month
+
+    @staticmethod
+    def _bounds(year, month):
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        return start, end
+
+    def _table(self, name, **kwargs):
+        table = self._metadata.tables.get(name)
+        if table is None:
+            # Partitions live outside of the declarative metadata, so there is
+            # no foreign key to the sensors table.
+            table = Table(name, self._metadata,
+                Column('sensor_id', Integer, primary_key=True),
+                Column('timestamp', EpochMillis if self.epoch else DateTime,
+                    primary_key=True),
+                Column('value', Float, nullable=False),
+                **kwargs)
+        return table
+
+    def _parent(self, type_name):
+        return self._table('{}_{}'.format(self._prefix, type_name),
+                postgresql_partition_by='RANGE (timestamp)')
+
+    def _partition(self, type_name, year, month):
+        return self._table('{}_{}_{:04d}_{:02d}'.format(
+            self._prefix, type_name, year, month))
+
+    def _partitions(self, session):
+        """Returns (type name, year, month) tuples of existing partitions."""
+        partitions = set()
+        for name in inspect(session.connection()).get_table_names():
+            m = self._name_re.match(name)
+            if m:
+                partitions.add((m.group(1), int(m.group(2)), int(m.group(3))))
+        return partitions
+
+    def _in_range(self, partitions, start, end):
+        for type_name, year, month in sorted(partitions):
+            p_start, p_end = self._bounds(year, month)
+            if (start is None or p_end > start) and \
+                    (end is None or p_start < end):
+                yield type_name, year, month
+
+    def _create(self, connection, type_name, year, month):
+        if self._postgres:
+            self._parent(type_name).create(connection, checkfirst=True)
+            bounds = self._bounds(year, month)
+            if self.epoch:
+                bounds = [EpochMillis().process_bind_param(b, None)
+                        for b in bounds]
+            else:
+                bounds = ["'{}'".format(b.isoformat(' ')) for b in bounds]
+            connection.execute(text(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                "FOR VALUES FROM ({}) TO ({})".format(
+                    self._partition(type_name, year, month).name,
+                    self._parent(type_name).name, *bounds)))
+        else:
+            self._partition(type_name, year, month).create(connection,
+                    checkfirst=True)
+
+    def _sensor_type(self, session, sensor_id):
+        if sensor_id not in self._sensor_types:
+            self._sensor_types = {s.id: s.type.name for s in
+                    session.query(Sensor.id, Sensor.type)}
+        return self._sensor_types[sensor_id]
+
+    def insert(self, session, rows, on_conflict=None):
+        groups = {}
+        for row in rows:
+            key = (self._sensor_type(session, row['sensor_id']),) + \
+                    self._month(row['timestamp'])
+            groups.setdefault(key, []).append(row)
+
+        # Partitions are created in the transaction of the batch. Since that
+        # may be rolled back, they are only remembered once it is committed.
+        new = set(groups) - self._created
+        if new:
+            for partition in new:
+                self._create(session.connection(), *partition)
+            session.info.setdefault('new_partitions', set()).update(new)
+            if not event.contains(session, 'after_commit', self._committed):
+                event.listen(session, 'after_commit', self._committed)
+                event.listen(session, 'after_rollback', self._rolled_back)
+
+        inserted = 0
+        for (type_name, year, month), group in groups.items():
+            if self._postgres:
+                table = self._parent(type_name)
+            else:
+                table = self._partition(type_name, year, month)
+            rowcount = insert_rows(session, table, group, on_conflict,
+                    self.insert_method)
+            if rowcount < 0 or inserted < 0:
+                inserted = -1
+            else:
+                inserted += rowcount
+        return inserted
+
+    def _committed(self, session):
+        self._created |= session.info.pop('new_partitions', set())
+
+    def _rolled_back(self, session):
+        session.info.pop('new_partitions', None)
+
+    def tables(self, session, start=None, end=None):
+        return [self._partition(*p) for p in
+                self._in_range(self._partitions(session), start, end)]
+
+    def select(self, session, start=None, end=None):
+        if self._postgres:
+            names = sorted(set(p[0] for p in self._partitions(session)))
+            tables = [self._parent(n) for n in names]
+        else:
+            tables = self.tables(session, start, end)
+        if not tables:
+            # The measurements table is empty in partitioned mode (or holds
+            # rows not migrated yet), so it stands in for missing partitions.
+            return self.table
+        if len(tables) == 1:
+            return tables[0]
+        return union_all(*[select(t.c.timestamp, t.c.sensor_id, t.c.value)
+            for t in tables]).subquery('measurements')
+
+    def apply_retention(self, now=None):
+        """
+        Drops the partitions that only hold expired measurements.
+
+        :param now: The current time (UTC)
+        :return: The names of the dropped partitions
+        """
+        now = now or datetime.utcnow()
+        dropped = []
+        session = self._sessionmaker()
+        try:
+            for type_name, year, month in sorted(self._partitions(session)):
+                days = self._retention.get(type_name)
+                if days is None:
+                    continue
+                _, end = self._bounds(year, month)
+                if end <= now - timedelta(days=days):
+                    table = self._partition(type_name, year, month)
+                    table.drop(session.connection())
+                    self._metadata.remove(table)
+                    self._created.discard((type_name, year, month))
+                    dropped.append(table.name)
+            session.commit()
+        finally:
+            session.close()
+        for name in dropped:
+            logging.info("Dropped expired partition {}.".format(name))
+        return dropped
+
+    def migrate(self, chunk_size=50000):
+        """
+        Moves measurements from the measurements table into partitions.
+
+        :param chunk_size: Number of rows moved per transaction
+        :return: The number of rows moved
+        """
+        moved = 0
+        session = self._sessionmaker()
+        table = self.table
+        try:
+            while True:
+                rows = session.execute(select(table.c.timestamp,
+                    table.c.sensor_id, table.c.value).order_by(
+                    table.c.timestamp, table.c.sensor_id).limit(
+                    chunk_size)).fetchall()
+                if not rows:
+                    break
+                self.insert(session, [dict(r._mapping) for r in rows])
+                last = rows[-1]
+                session.execute(table.delete().where(or_(
+                    table.c.timestamp < last.timestamp,
+                    and_(table.c.timestamp==last.timestamp,
+                        table.c.sensor_id <= last.sensor_id))))
+                session.commit()
+                moved += len(rows)
+                logging.info("Moved {} measurements to partitions.".format(
+                    moved))
+        finally:
+            session.close()
+        return moved
+
+
+def create_storage(sessionmaker, config=None):
+    """
+    Creates the storage object described by the storage section of the
+    configuration.
+
+    :param sessionmaker: The session factory
+    :param config: The storage section of the configuration
+    """
+    config = config or {}
+    if config.get('partitioned'):
+        return PartitionedStorage(sessionmaker, config)
+    return TableStorage(sessionmaker, config)
+
+
+def main():
+    config = load_config()
+    if config.get('logging'):
+        dictConfig(config['logging'])
+
+    sessionmaker = create_sessionmaker(get_connection_string(config),
+            config.get('sqlite'), pool_config=config.get('pool'))
+    storage = create_storage(sessionmaker, config.get('storage'))
+    if not storage.partitioned:
+        logging.error("Partitioned storage is not enabled! Exiting...")
+        sys.exit(1)
+    moved = storage.migrate()
+    logging.info("{} measurements moved to partitions.".format(moved))
+    storage.apply_retention()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,81 @@
 #!/usr/bin/env python3
 
 import logging
-import pkg_resources
-import sys
-import yaml
 from logging.config import dictConfig
-from os.path import expanduser, isfile
 
+from datetime import datetime
+
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+
+from .config import get_connection_string, load_config
+from .db import create_sessionmaker
+from .devices.device import Device, SensorDevice, setup_sensors
+from .engine import PollingEngine
+from .events import EventBus
+from .live import LiveServer
+from .metrics import REGISTRY, Counter, MetricsServer
+from .replication import Replicator
+from .storage import create_storage
+from .writer import MeasurementWriter
 
-from .db import Measurement, create_sessionmaker
-from .devices.device import Device, SensorDevice
+
+SCHEDULER_MISFIRES = Counter('terrapi_scheduler_misfires_total',
+        'Scheduled jobs that did not run within their misfire grace time',
+        ['job'])
+SCHEDULER_OVERRUNS = Counter('terrapi_scheduler_overruns_total',
+        'Scheduled runs skipped because the previous run was still running',
+        ['job'])
 
 
 class TerrapiApp():
     def __init__(self, config):
-        connection_string = config.get('connection_string')
-        if not connection_string:
-            logging.info("Database configuration not found, using SQLite.")
-            database = pkg_resources.resource_filename('TerraPi',
-                    'data/terrapi.db')
-            connection_string = 'sqlite:///{}'.format(database)
-        self.sessionmaker = create_sessionmaker(connection_string)
-
-        self.scheduler = BlockingScheduler(
+        connection_string = get_connection_string(config)
+        self.sessionmaker = create_sessionmaker(connection_string,
+                config.get('sqlite'), pool_config=config.get('pool'))
+        self.storage = create_storage(self.sessionmaker, config.get('storage'))
+        self.writer = MeasurementWriter(self.sessionmaker, self.storage,
+                config.get('write_buffer'))
+        self.events = EventBus(config.get('events'))
+        self.replicator = None
+        if config.get('replication'):
+            # The replicator reads with its own connections, so it does not
+            # wait for the writer.
+            self.replicator = Replicator(create_sessionmaker(
+                connection_string, config.get('sqlite'), readonly=True,
+                pool_config=config.get('pool')),
+                self.storage, config['replication'])
+
+        # With the asyncio engine sensor devices are polled by the event loop
+        # in the main thread, and the scheduler only runs the other jobs.
+        polling = config.get('polling', {})
+        if polling.get('engine', 'scheduler') == 'asyncio':
+            self.engine = PollingEngine(polling)
+            scheduler_class = BackgroundScheduler
+        else:
+            self.engine = None
+            scheduler_class = BlockingScheduler
+        self.scheduler = scheduler_class(
                 daemon=False,
                 job_defaults={'misfire_grace_time':10})
-
+        self.scheduler.add_listener(self._scheduler_event,
+                EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+        if self.storage.partitioned:
+            self.scheduler.add_job(self.storage.apply_retention,
+                    trigger=IntervalTrigger(hours=1),
+                    next_run_time=datetime.now())
+
+        # Sensors of all sensor devices are registered in the database in
+        # bulk, after the devices have been created.
+        self.pending_sensor_devices = []
         confs = config.get('sensor_devices', [])
         self.sensor_devices = [
                 Device.create_from_config(self, c) for c in confs]
         self.sensor_devices = list(filter(None, self.sensor_devices))
+        setup_sensors(self.sessionmaker, self.pending_sensor_devices)
+        self.pending_sensor_devices = None
 
         confs = config.get('controller_devices', [])
         self.controller_devices = [
@@ -44,33 +89,127 @@ class TerrapiApp():
 
         if not self.sensor_devices and not self.controlled_devices:
             logging.warn("There are no devices in the configuration file!")
-    
+
+        self._metrics_config = config.get('metrics')
+        self._live_config = config.get('live')
+        self.live = None
+
+    def _scheduler_event(self, event):
+        job = self.scheduler.get_job(event.job_id)
+        name = job.name if job is not None else event.job_id
+        if event.code == EVENT_JOB_MISSED:
+            SCHEDULER_MISFIRES.labels(job=name).inc()
+        else:
+            SCHEDULER_OVERRUNS.labels(job=name).inc()
+
+    def collect_metrics(self):
+        """
+        Returns the counters kept by the writer, the event bus, the polling
+        engine and the controllers as metric families. They are read only
+        when metrics are scraped.
+        """
+        writer = self.writer.stats()
+        events = self.events.stats()
+        families = [
+            ('terrapi_rows_inserted_total', 'counter',
+                'Measurements stored in the database',
+                [({}, writer['rows_written'])]),
+            ('terrapi_rows_dropped_total', 'counter',
+                'Measurements lost because the write buffer was full or a '
+                'commit failed', [({}, writer['rows_dropped'])]),
+            ('terrapi_commit_errors_total', 'counter',
+                'Failed commits of measurement batches',
+                [({}, writer['flush_errors'])]),
+            ('terrapi_write_queue_depth', 'gauge',
+                'Measurements waiting in the write buffer',
+                [({}, writer['queue_depth'] + writer['pending'])]),
+            ('terrapi_events_published_total', 'counter',
+                'Measurements published to sensor callbacks',
+                [({}, events['published'])]),
+            ('terrapi_events_dropped_total', 'counter',
+                'Measurements dropped from full callback queues',
+                [({}, events['dropped'])]),
+            ('terrapi_events_queue_depth', 'gauge',
+                'Measurements waiting for sensor callbacks',
+                [({}, sum(events['queue_depths']))]),
+            ('terrapi_controller_commands_total', 'counter',
+                'Controller commands by outcome',
+                [({'controller': c.name, 'result': result}, value)
+                    for c in self.controller_devices
+                    for result, value in c.stats().items()
+                    if result in ('issued', 'suppressed', 'coalesced',
+                        'errors')]),
+            ('terrapi_controller_reconnects_total', 'counter',
+                'Reconnects of controllers after errors',
+                [({'controller': c.name}, c.stats()['reconnects'])
+                    for c in self.controller_devices]),
+        ]
+        if self.live is not None:
+            live = self.live.stats()
+            families.append(('terrapi_live_clients', 'gauge',
+                'Dashboards connected to the push stream',
+                [({}, live['clients'])]))
+            families.append(('terrapi_live_dropped_total', 'counter',
+                'Batches dropped for dashboards that could not keep up',
+                [({}, live['dropped'])]))
+        if self.replicator is not None:
+            replication = self.replicator.stats()
+            families.append(('terrapi_replicated_rows_total', 'counter',
+                'Measurements shipped to the central database',
+                [({}, replication['rows_shipped'])]))
+            families.append(('terrapi_replication_failures_total', 'counter',
+                'Failed shipments to the central database',
+                [({}, replication['failures'])]))
+            families.append(('terrapi_replication_last_success_seconds',
+                'gauge', 'Unix time of the last successful shipment',
+                [({}, replication['last_success'])]))
+        if self.engine is not None:
+            stats = self.engine.stats()
+            for key, doc in (('timeouts', 'Measurements that timed out'),
+                    ('errors', 'Measurements that raised an error'),
+                    ('skipped', 'Measurements skipped because of backoff or '
+                        'a running measurement')):
+                families.append(('terrapi_measure_{}_total'.format(key),
+                    'counter', doc, [({'device': name}, s[key])
+                        for name, s in stats.items()]))
+        return families
+
     def main(self):
-        self.scheduler.start()
+        metrics_server = None
+        if self._metrics_config:
+            REGISTRY.register_collector(self.collect_metrics)
+            metrics_server = MetricsServer(self._metrics_config)
+        if self._live_config:
+            self.live = LiveServer(self._live_config)
+            self.writer.subscribe(self.live.publish)
+        if self.replicator is not None:
+            self.replicator.start()
+        try:
+            self.scheduler.start()
+            if self.engine is not None:
+                self.engine.run()
+        except (KeyboardInterrupt, SystemExit):
+            logging.info("Shutting down.")
+        finally:
+            if self.scheduler.running:
+                self.scheduler.shutdown()
+            self.events.close()
+            for controller in self.controller_devices:
+                controller.close()
+            self.writer.close()
+            if self.replicator is not None:
+                self.replicator.close()
+            if self.live is not None:
+                self.live.close()
+            if metrics_server is not None:
+                metrics_server.close()
+                REGISTRY.unregister_collector(self.collect_metrics)
 
 
 def main():
-    config_paths = []
-    if len(sys.argv) > 1:
-        config_paths.append(sys.argv[1])
-    config_paths.append(expanduser('~') + '/.terrapi.yaml')
-    config_paths.append(expanduser('~') + '/.config/terrapi/config.yaml')
-    config_paths.append(pkg_resources.resource_filename('TerraPi',
-        'conf/config-sample.yaml'))
-    for path in config_paths:
-        if isfile(path):
-            configfile = path
-            break
-    if not configfile:
-        logging.error("No config file found! Exiting..")
-        sys.exit(1)
-    with open(configfile, 'r') as stream:
-        config = yaml.load(stream)
-    if not config:
-        logging.error("Empty configuration! Exiting...")
-        sys.exit(1)
-
-    if config['logging']:
+    config = load_config()
+
+    if config.get('logging'):
         dictConfig(config['logging'])
 
     app = TerrapiApp(config)
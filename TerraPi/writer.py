@@ -0,0 +1,244 @@
+# write-behind buffer for measurements
+
+import logging
+import queue
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from .metrics import Histogram
+from .rollup import rebuild, update_rollups
+
+
+COMMIT_DURATION = Histogram('terrapi_commit_duration_seconds',
+        'Time to insert and commit a batch of measurements')
+
+
+class MeasurementWriter():
+    """
+    App-wide write-behind buffer for measurements. Sensor devices put their
+    readings into a bounded queue, and a background thread stores them in the
+    database with one bulk insert per batch, and merges the batch into the
+    rollup tables in the same transaction. A batch is flushed when it reaches
+    `batch_size` rows, or when its oldest row is `max_age` seconds old.
+
+    :config batch_size: Number of rows that triggers a flush
+    :config max_age: Maximum age of a buffered row in seconds
+    :config queue_size: Maximum number of rows waiting in the queue
+    :config put_timeout: Seconds to wait for room in a full queue before
+        dropping a row
+    """
+    _stop = object()
+
+    def __init__(self, sessionmaker, storage, config=None):
+        """
+        Constructs a new 'MeasurementWriter' object, and starts its thread.
+
+        :param sessionmaker: The session factory used for flushing
+        :param storage: The storage object rows are inserted with
+        :param config: The write_buffer section of the configuration
+        """
+        config = config or {}
+        self._sessionmaker = sessionmaker
+        self._storage = storage
+        self._batch_size = config.get('batch_size', 500)
+        self._max_age = config.get('max_age', 10)
+        self._put_timeout = config.get('put_timeout', 1)
+        self._queue = queue.Queue(maxsize=config.get('queue_size', 10000))
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._counters = {
+            'rows_written': 0,
+            'rows_dropped': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'last_flush_latency': 0.0,
+            'max_flush_latency': 0.0,
+            'total_flush_latency': 0.0,
+        }
+        self._closed = False
+        self._subscribers = []
+
+        self._thread = threading.Thread(target=self._run,
+                name='MeasurementWriter', daemon=True)
+        self._thread.start()
+
+    def put(self, sensor_id, value, timestamp):
+        """
+        Queues one measurement for insertion.
+
+        :param sensor_id: The id of the sensor in the database
+        :param value: The measured value
+        :param timestamp: When the measurement was taken (UTC)
+        :return: True if the row was queued, False if it was dropped
+        """
+        row = {'timestamp': timestamp, 'sensor_id': sensor_id, 'value': value}
+        try:
+            self._queue.put(row, timeout=self._put_timeout)
+        except queue.Full:
+            with self._lock:
+                self._counters['rows_dropped'] += 1
+            logging.warn('Write buffer is full, dropping measurement!')
+            return False
+        return True
+
+    def subscribe(self, callback):
+        """
+        Registers a function that is called with every committed batch, on the
+        writer thread, so it must not block.
+
+        :param callback: A function that takes a list of dicts with
+            timestamp, sensor_id and value keys
+        """
+        self._subscribers.append(callback)
+
+    def flush(self, timeout=None):
+        """
+        Flushes everything queued before this call, and waits for it.
+
+        :param timeout: Maximum number of seconds to wait
+        :return: True if the flush finished in time
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        """Flushes all remaining rows and stops the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._stop)
+        self._thread.join()
+
+    def stats(self):
+        """
+        Returns a snapshot of the writer's counters.
+
+        :return: A dict with queue depth, row, flush and latency counters
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['pending'] = self._pending
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            if batch:
+                timeout = max(0, deadline - time.monotonic())
+            else:
+                timeout = None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is self._stop:
+                self._write(batch)
+                return
+            elif isinstance(item, threading.Event):
+                self._write(batch)
+                batch = []
+                item.set()
+                continue
+            elif item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self._max_age
+                batch.append(item)
+                with self._lock:
+                    self._pending = len(batch)
+
+            if len(batch) >= self._batch_size or \
+                    (batch and time.monotonic() >= deadline):
+                self._write(batch)
+                batch = []
+
+    def _store(self, session, rows, on_conflict=None):
+        """
+        Inserts a batch and merges it into the rollups. Without a conflict
+        policy one duplicate fails the whole batch. With one the rows are
+        inserted one at a time, so the skipped rows are known, and only the
+        inserted ones are merged into the rollups. If the database does not
+        report what was inserted, the rollups of the days of the batch are
+        rebuilt instead.
+
+        :return: The rows that were inserted
+        """
+        if on_conflict is None:
+            self._storage.insert(session, rows)
+            update_rollups(session, rows)
+            session.commit()
+            return rows
+
+        counts = [self._storage.insert(session, [row], on_conflict)
+                for row in rows]
+        inserted = [row for row, count in zip(rows, counts) if count]
+        if min(counts) >= 0:
+            update_rollups(session, inserted)
+        else:
+            timestamps = [r['timestamp'] for r in rows]
+            rebuild(session, self._storage, set(r['sensor_id'] for r in rows),
+                    min(timestamps), max(timestamps))
+        session.commit()
+        return inserted
+
+    def _write(self, rows):
+        """
+        Stores a batch of rows with a single executemany insert. A batch
+        that contains rows already in the database is stored again without
+        them, so one duplicate does not cost the measurements of every other
+        device. Only the rows that were inserted are counted and published.
+        The writer thread survives any error, since it is the only way
+        measurements are stored.
+
+        :param rows: A list of dicts with timestamp, sensor_id and value keys
+        """
+        if not rows:
+            return
+        start = time.monotonic()
+        session = self._sessionmaker()
+        ok = False
+        try:
+            try:
+                inserted = self._store(session, rows)
+            except IntegrityError:
+                session.rollback()
+                logging.warning('Batch of {} measurements contains '
+                        'duplicates, storing it without them.'.format(
+                            len(rows)))
+                inserted = self._store(session, rows, 'skip')
+            ok = True
+        except Exception:
+            logging.exception('Could not store {} measurements in database!'.
+                    format(len(rows)))
+        finally:
+            # Closing also rolls back a failed transaction.
+            session.close()
+        latency = time.monotonic() - start
+        COMMIT_DURATION.observe(latency)
+
+        with self._lock:
+            self._pending = 0
+            self._counters['flushes'] += 1
+            if ok:
+                self._counters['rows_written'] += len(inserted)
+            else:
+                self._counters['flush_errors'] += 1
+                self._counters['rows_dropped'] += len(rows)
+            self._counters['last_flush_latency'] = latency
+            self._counters['total_flush_latency'] += latency
+            self._counters['max_flush_latency'] = max(latency,
+                    self._counters['max_flush_latency'])
+
+        if ok and inserted:
+            for callback in self._subscribers:
+                try:
+                    callback(inserted)
+                except Exception as e:
+                    logging.error("Subscriber of committed measurements "
+                            "failed: {}".format(e))
@@ -0,0 +1,14 @@
+# WSGI entry point of the dashboard, e.g. for gunicorn -w 4 TerraPi.wsgi
+
+import os
+
+from .config import load_config
+from .dashboard import create_app
+
+
+# The command line of the WSGI server is not ours, so the configuration file
+# can only be given in the environment.
+_argv = ['terrapi-dashboard', os.environ['TERRAPI_CONFIG']] \
+        if 'TERRAPI_CONFIG' in os.environ else []
+
+application = create_app(load_config(_argv)).server
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Compares the old per-sensor ORM data path of dashboard.update_measurements
+with the single-query columnar path, in time and peak memory.
+
+Usage: python benchmarks/dashboard_query.py [--rows N] [--sensors N] [--db PATH]
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pytz
+import tzlocal
+
+from TerraPi.db import Measurement, Sensor, SensorType, create_sessionmaker
+from TerraPi.query import encode_columns, fetch_columns, utc_to_local
+
+
+def populate(sessionmaker, rows, sensors, end):
+    session = sessionmaker()
+    sensor_objs = [Sensor(name='bench{}'.format(i),
+        type=SensorType.temperature) for i in range(sensors)]
+    session.add_all(sensor_objs)
+    session.commit()
+    ids = [s.id for s in sensor_objs]
+
+    per_sensor = rows // sensors
+    step = timedelta(days=30) / per_sensor
+    start = end - timedelta(days=30)
+    table = Measurement.__table__
+    batch = []
+    for sensor_id in ids:
+        for i in range(per_sensor):
+            batch.append({'timestamp': start + i * step, 'sensor_id': sensor_id,
+                'value': 20 + (i % 100) / 10.0})
+            if len(batch) == 100000:
+                session.execute(table.insert(), batch)
+                batch = []
+    if batch:
+        session.execute(table.insert(), batch)
+    session.commit()
+    session.close()
+
+
+def legacy(sessionmaker, start):
+    """The data path of update_measurements before the columnar rewrite."""
+    session = sessionmaker()
+    sensors = session.query(Sensor).all()
+    local_tz = tzlocal.get_localzone()
+    measurements = dict()
+    for sensor in sensors:
+        measurements[sensor.id] = dict()
+        _data = session.query(Measurement).filter(
+                Measurement.sensor==sensor).filter(
+                Measurement.timestamp>start).order_by(
+                Measurement.timestamp).all()
+        measurements[sensor.id]['timestamp'] = [
+                m.timestamp.replace(tzinfo=pytz.utc).astimezone(local_tz)
+                for m in _data]
+        measurements[sensor.id]['value'] = [m.value for m in _data]
+    session.close()
+    return json.dumps(measurements, default=str)
+
+
+def columnar(sessionmaker, start):
+    """The current data path of update_measurements (raw resolution)."""
+    session = sessionmaker()
+    sensor_ids = [s.id for s in session.query(Sensor).all()]
+    local_tz = tzlocal.get_localzone()
+    columns = fetch_columns(session, sensor_ids, start, datetime.utcnow(),
+            'raw')
+    session.close()
+    for sensor_id, (timestamps, values) in columns.items():
+        columns[sensor_id] = (utc_to_local(timestamps, local_tz), values)
+    return encode_columns(columns)
+
+
+def measure(func, *args):
+    t = time.perf_counter()
+    out = func(*args)
+    elapsed = time.perf_counter() - t
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': elapsed, 'peak_bytes': peak, 'payload_bytes': len(out)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--sensors', type=int, default=10)
+    parser.add_argument('--db', help='SQLite file (default: temporary file)')
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(path))
+    end = datetime.utcnow()
+    session = sessionmaker()
+    if not session.query(Measurement).first():
+        populate(sessionmaker, args.rows, args.sensors, end)
+    session.close()
+
+    start = end - timedelta(days=30)
+    results = {
+        'rows': args.rows,
+        'legacy': measure(legacy, sessionmaker, start),
+        'columnar': measure(columnar, sessionmaker, start),
+    }
+    print(json.dumps(results, indent=2))
+    print('speedup: {:.1f}x, peak memory ratio: {:.1f}x'.format(
+        results['legacy']['seconds'] / results['columnar']['seconds'],
+        results['legacy']['peak_bytes'] / results['columnar']['peak_bytes']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Stress test for SQLite: concurrent writer threads feed the measurement writer
+while a separate dashboard reader process queries the database in a loop.
+
+Usage: python benchmarks/sqlite_stress.py [--writers N] [--seconds N] [--no-wal]
+                                          [--direct]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from TerraPi.db import Sensor, SensorType, create_sessionmaker
+from TerraPi.query import fetch_columns
+from TerraPi.storage import create_storage
+from TerraPi.writer import MeasurementWriter
+
+
+def reader(url, sqlite_config, sensor_ids, stop, results):
+    """Queries the last day of raw measurements like the dashboard does."""
+    sessionmaker = create_sessionmaker(url, sqlite_config, readonly=True)
+    queries = errors = rows = 0
+    latencies = []
+    while not stop.is_set():
+        t = time.perf_counter()
+        session = sessionmaker()
+        try:
+            end = datetime.utcnow()
+            columns = fetch_columns(session, sensor_ids,
+                    end - timedelta(days=1), end, 'raw')
+            rows += sum(len(c[0]) for c in columns.values())
+            queries += 1
+        except SQLAlchemyError:
+            errors += 1
+        finally:
+            session.close()
+        latencies.append(time.perf_counter() - t)
+    results.put({'queries': queries, 'errors': errors, 'rows_read': rows,
+        'max_latency': max(latencies) if latencies else 0})
+
+
+def writer_thread(writer, sensor_ids, stop, interval):
+    while not stop.is_set():
+        now = datetime.utcnow()
+        for sensor_id in sensor_ids:
+            writer.put(sensor_id, random.uniform(18, 30), now)
+        time.sleep(interval)
+
+
+def direct_writer_thread(sessionmaker, storage, sensor_ids, stop, interval,
+        counters):
+    """Commits every reading in its own transaction, without the writer."""
+    while not stop.is_set():
+        now = datetime.utcnow()
+        session = sessionmaker()
+        try:
+            storage.insert(session, [{'timestamp': now, 'sensor_id': s,
+                'value': random.uniform(18, 30)} for s in sensor_ids])
+            session.commit()
+            counters['rows_written'] += len(sensor_ids)
+        except SQLAlchemyError:
+            session.rollback()
+            counters['flush_errors'] += 1
+            counters['rows_dropped'] += len(sensor_ids)
+        finally:
+            session.close()
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--sensors', type=int, default=50,
+            help='sensors per writer thread')
+    parser.add_argument('--interval', type=float, default=0.01,
+            help='seconds between readings of a writer thread')
+    parser.add_argument('--seconds', type=int, default=30)
+    parser.add_argument('--no-wal', action='store_true',
+            help='use the default SQLite journal instead of WAL')
+    parser.add_argument('--direct', action='store_true',
+            help='writer threads commit on their own instead of using the '
+            'measurement writer')
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'stress.db')
+    url = 'sqlite:///{}'.format(path)
+    sqlite_config = {'wal': not args.no_wal}
+    sessionmaker = create_sessionmaker(url, sqlite_config)
+
+    session = sessionmaker()
+    sensors = [Sensor(name='stress{}'.format(i), type=SensorType.temperature)
+            for i in range(args.writers * args.sensors)]
+    session.add_all(sensors)
+    session.commit()
+    sensor_ids = [s.id for s in sensors]
+    session.close()
+
+    storage = create_storage(sessionmaker)
+    writer = MeasurementWriter(sessionmaker, storage, {'max_age': 1})
+
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    reader_process = multiprocessing.Process(target=reader,
+            args=(url, sqlite_config, sensor_ids, stop, results))
+    reader_process.start()
+
+    thread_stop = threading.Event()
+    counters = {'rows_written': 0, 'rows_dropped': 0, 'flush_errors': 0}
+    threads = []
+    for i in range(args.writers):
+        ids = sensor_ids[i*args.sensors:(i+1)*args.sensors]
+        if args.direct:
+            threads.append(threading.Thread(target=direct_writer_thread,
+                args=(sessionmaker, storage, ids, thread_stop, args.interval,
+                    counters)))
+        else:
+            threads.append(threading.Thread(target=writer_thread,
+                args=(writer, ids, thread_stop, args.interval)))
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    thread_stop.set()
+    for t in threads:
+        t.join()
+    writer.close()
+    stop.set()
+    reader_stats = results.get()
+    reader_process.join()
+
+    stats = writer.stats()
+    if args.direct:
+        stats.update(counters)
+        stats['max_flush_latency'] = None
+    print(json.dumps({
+        'wal': not args.no_wal,
+        'direct': args.direct,
+        'seconds': args.seconds,
+        'writer': {
+            'rows_written': stats['rows_written'],
+            'rows_dropped': stats['rows_dropped'],
+            'flush_errors': stats['flush_errors'],
+            'max_flush_latency': stats['max_flush_latency'],
+        },
+        'reader': reader_stats,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
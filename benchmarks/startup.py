@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Measures the startup time of TerrapiApp with a large fleet of dummy devices,
+with bulk sensor registration and with the old per-device registration.
+
+Usage: python benchmarks/startup.py [--devices N] [--db PATH]
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+from sqlalchemy.orm.exc import NoResultFound
+
+from TerraPi.db import Sensor
+from TerraPi.devices import device
+from TerraPi.terrapi import TerrapiApp
+
+
+def legacy_setup_sensors(self, sensor_types):
+    """The per-device registration TerrapiApp used before bulk setup."""
+    self._sensor_types = list(sensor_types)
+    session = self._app.sessionmaker()
+    for sensor_type in sensor_types:
+        try:
+            sensor = session.query(Sensor).filter(
+                    Sensor.name==self.name).filter(
+                    Sensor.type==sensor_type).one()
+        except NoResultFound:
+            sensor = Sensor(name=self.name, type=sensor_type,
+                    description=self.description)
+            session.add(sensor)
+            session.commit()
+        self._sensors[sensor_type] = sensor.id
+    session.close()
+
+
+def make_config(url, devices):
+    return {
+        'connection_string': url,
+        'sensor_devices': [{'type': 'dummy.RandomTemperatureHumidity',
+            'name': 'dummy{}'.format(i)} for i in range(devices)],
+        'controller_devices': [{'type': 'dummy.DummySwitch',
+            'name': 'switch'}],
+        'controlled_devices': [{'type': 'thermostat.Thermostat',
+            'name': 'thermostat{}'.format(i), 'sensor': 'dummy{}'.format(i),
+            'controller': {'name': 'switch', 'channel': i},
+            'temperatures': [{'time': '-', 'temperature': '20-30'}]}
+            for i in range(devices)],
+    }
+
+
+def start(config):
+    t = time.perf_counter()
+    app = TerrapiApp(config)
+    elapsed = time.perf_counter() - t
+    app.events.close()
+    for controller in app.controller_devices:
+        controller.close()
+    app.writer.close()
+    app.sessionmaker.get_bind().dispose()
+    return elapsed
+
+
+def run(devices, directory, setup):
+    url = 'sqlite:///{}'.format(os.path.join(directory,
+        '{}.db'.format(setup.__name__)))
+    config = make_config(url, devices)
+    device.SensorDevice._setup_sensors = setup
+    # The first start creates the sensors, the second one only looks them up.
+    return {'first_start': start(config), 'second_start': start(config)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--db', help='directory of the database files '
+            '(a temporary directory by default)')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    directory = args.db or tempfile.mkdtemp()
+    bulk_setup = device.SensorDevice._setup_sensors
+    print(json.dumps({
+        'devices': args.devices,
+        'legacy': run(args.devices, directory, legacy_setup_sensors),
+        'bulk': run(args.devices, directory, bulk_setup),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
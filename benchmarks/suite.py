@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite of the hot paths of TerraPi, on synthetic data in in-memory
+and on-disk SQLite databases. Uses dummy devices only, so no hardware is
+needed.
+
+Usage: python benchmarks/suite.py [--rows 1e5,1e6] [--storage memory,disk]
+                                  [--output FILE] [--compare FILE]
+
+Every case reports its throughput (operations per second), latency
+percentiles in seconds, and peak Python memory in bytes. The results are
+written as JSON, and --compare prints the ratios to a previous run.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import sqlalchemy
+
+from TerraPi.db import DayRollup, HourRollup, Measurement, MinuteRollup, \
+        SensorType, get_or_create_sensors
+from TerraPi.devices.device import setup_sensors
+from TerraPi.terrapi import TerrapiApp
+
+
+WINDOW = timedelta(days=30)
+CHUNK = 1000000
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+    return {
+        'p50': pick(0.5),
+        'p95': pick(0.95),
+        'max': latencies[-1],
+        'mean': statistics.mean(latencies),
+    }
+
+
+def measure(func, repeat, ops=1):
+    """
+    Times repeat calls of func, then makes one more call with tracemalloc on
+    to find its peak memory use, so tracing does not skew the timings.
+
+    :param ops: The number of operations done by one call
+    """
+    latencies = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'throughput': ops * repeat / sum(latencies),
+        'latency': percentiles(latencies),
+        'peak_memory': peak,
+    }
+
+
+def _timestamps_sql(ms):
+    # SQLAlchemy stores DateTime columns as ISO strings in SQLite.
+    return np.char.replace(np.datetime_as_string(
+        ms.astype('datetime64[ms]').astype('datetime64[us]'), unit='us'),
+        'T', ' ')
+
+
+def populate(sessionmaker, sensor_ids, rows, end):
+    """
+    Inserts rows evenly spaced synthetic measurements of the last 30 days,
+    and their minute, hour and day rollups, bypassing the ORM.
+    """
+    session = sessionmaker()
+    end_ms = int(np.datetime64(end, 'ms').astype(np.int64))
+    start_ms = end_ms - int(WINDOW.total_seconds() * 1000)
+    per_sensor = rows // len(sensor_ids)
+    step = (end_ms - start_ms) / per_sensor
+    rollups = [(MinuteRollup, 60000), (HourRollup, 3600000),
+            (DayRollup, 86400000)]
+    rng = np.random.default_rng(0)
+
+    for sensor_id in sensor_ids:
+        connection = session.connection()
+        for first in range(0, per_sensor, CHUNK):
+            i = np.arange(first, min(first + CHUNK, per_sensor))
+            t = (start_ms + i * step).astype(np.int64)
+            v = 24 + 4 * np.sin(i / 500.0) + rng.normal(0, 0.2, len(i))
+            connection.exec_driver_sql(
+                'INSERT INTO {} (timestamp, sensor_id, value) '
+                'VALUES (?, ?, ?)'.format(Measurement.__tablename__),
+                list(zip(_timestamps_sql(t).tolist(),
+                    [sensor_id] * len(i), v.tolist())))
+            for table, width in rollups:
+                # Chunks are not aligned to buckets, so partial buckets are
+                # merged by the upsert.
+                buckets = t // width * width
+                starts = np.flatnonzero(np.r_[True, buckets[1:] !=
+                    buckets[:-1]])
+                connection.exec_driver_sql(
+                    'INSERT INTO {0} (sensor_id, bucket, minimum, maximum, '
+                    'total, count) VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (sensor_id, bucket) DO UPDATE SET '
+                    'minimum=min(minimum, excluded.minimum), '
+                    'maximum=max(maximum, excluded.maximum), '
+                    'total=total+excluded.total, '
+                    'count=count+excluded.count'.format(table.__tablename__),
+                    list(zip([sensor_id] * len(starts),
+                        _timestamps_sql(buckets[starts]).tolist(),
+                        np.minimum.reduceat(v, starts).tolist(),
+                        np.maximum.reduceat(v, starts).tolist(),
+                        np.add.reduceat(v, starts).tolist(),
+                        np.diff(np.r_[starts, len(v)]).tolist())))
+        session.commit()
+    session.close()
+
+
+def make_config(url, devices):
+    return {
+        'connection_string': url,
+        'write_buffer': {'queue_size': 1000000},
+        'sensor_devices': [{'type': 'dummy.RandomTemperatureHumidity',
+            'name': 'dummy{}'.format(i)} for i in range(devices)],
+        'controller_devices': [{'type': 'dummy.DummySwitch',
+            'name': 'switch'}],
+        'controlled_devices': [{'type': 'thermostat.Thermostat',
+            'name': 'thermostat{}'.format(i), 'sensor': 'dummy{}'.format(i),
+            'controller': {'name': 'switch', 'channel': i},
+            'temperatures': [{'time': '-', 'temperature': '20-30'}]}
+            for i in range(devices)],
+    }
+
+
+def bench_setup_sensors(app, repeat):
+    devices = app.sensor_devices
+    return measure(lambda: setup_sensors(app.sessionmaker, devices), repeat,
+            len(devices))
+
+
+def bench_refresh(app, repeat):
+    devices = app.sensor_devices
+
+    def refresh():
+        for device in devices:
+            device._refresh()
+        app.writer.flush()
+    result = measure(refresh, repeat, len(devices))
+    app.events.close()
+    return result
+
+
+def bench_dashboard(sessionmaker, sensor_ids, repeat):
+    """
+    Cold and warm dashboard measurement queries, and figure generation for
+    the whole window and for a zoomed range.
+    """
+    try:
+        from TerraPi import dashboard
+    except Exception as e:
+        return {'dashboard': {'error': 'dashboard could not be imported: '
+            '{}'.format(e)}}
+
+    data = dashboard.DashboardData({}, sessionmaker)
+    data.sensors = [s for s in data.sensors if s.id in sensor_ids]
+
+    def cold():
+        data.cache.clear()
+        return data.measurements()
+    results = {
+        'update_measurements_cold': measure(cold, repeat),
+        'update_measurements_warm': measure(data.measurements, repeat),
+    }
+    measurements = cold()
+    update_graph = dashboard.generate_update_func(SensorType.temperature,
+            data)
+    results['figure'] = measure(lambda: update_graph(measurements, {}),
+            repeat)
+    # Zooming into the last day of the window
+    end = datetime.now()
+    results['zoom_day'] = measure(lambda: update_graph(measurements,
+        {'xaxis.range[0]': str(end - timedelta(days=1)),
+            'xaxis.range[1]': str(end)}), repeat)
+    return results
+
+
+def run(storage, rows, args, directory):
+    if storage == 'memory':
+        url = 'sqlite://'
+    else:
+        url = 'sqlite:///{}'.format(os.path.join(directory,
+            'suite_{}.db'.format(rows)))
+    results = {}
+
+    t = time.perf_counter()
+    app = TerrapiApp(make_config(url, args.devices))
+    results['startup'] = {'latency': {'max': time.perf_counter() - t}}
+    results['setup_sensors'] = bench_setup_sensors(app, args.repeat)
+    results['refresh'] = bench_refresh(app, args.repeat)
+    for controller in app.controller_devices:
+        controller.close()
+
+    session = app.sessionmaker()
+    ids = get_or_create_sensors(session, [('bench{}'.format(i),
+        SensorType.temperature, None) for i in range(args.sensors)])
+    session.commit()
+    session.close()
+    t = time.perf_counter()
+    populate(app.sessionmaker, list(ids.values()), rows, datetime.utcnow())
+    elapsed = time.perf_counter() - t
+    results['populate'] = {'throughput': rows / elapsed,
+            'latency': {'max': elapsed}}
+    results.update(bench_dashboard(app.sessionmaker, list(ids.values()),
+        args.repeat))
+
+    app.writer.close()
+    app.sessionmaker.get_bind().dispose()
+    return [dict(case=case, storage=storage, rows=rows, **result)
+            for case, result in results.items()]
+
+
+def compare(results, path):
+    with open(path) as f:
+        previous = {(r['case'], r['storage'], r['rows']): r
+                for r in json.load(f)['results']}
+    for r in results:
+        old = previous.get((r['case'], r['storage'], r['rows']))
+        if not old or 'throughput' not in r or 'throughput' not in old:
+            continue
+        p95 = [x['latency'].get('p95') for x in (r, old)]
+        print('{:28} {:6} {:>11,} throughput x{:.2f}  p95 {}'.format(
+            r['case'], r['storage'], r['rows'],
+            r['throughput'] / old['throughput'],
+            'x{:.2f}'.format(p95[0] / p95[1]) if all(p95) else '-'),
+            file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', default='1e5,1e6',
+            help='comma separated numbers of synthetic measurements')
+    parser.add_argument('--storage', default='memory,disk',
+            help='comma separated list of memory and disk')
+    parser.add_argument('--devices', type=int, default=100,
+            help='number of dummy sensor devices')
+    parser.add_argument('--sensors', type=int, default=10,
+            help='number of sensors the synthetic measurements belong to')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--db', help='directory of the on-disk databases '
+            '(a temporary directory by default)')
+    parser.add_argument('--output', help='write the results to this file '
+            'instead of stdout')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    directory = args.db or tempfile.mkdtemp()
+    results = []
+    for rows in [int(float(r)) for r in args.rows.split(',')]:
+        for storage in args.storage.split(','):
+            results.extend(run(storage, rows, args, directory))
+
+    output = json.dumps({
+        'timestamp': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
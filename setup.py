@@ -87,7 +87,15 @@ def read_file(filename):
 
 
 def console_scripts():
-    s = ['terrapi = TerraPi.terrapi:main']
+    s = [
+        'terrapi = TerraPi.terrapi:main',
+        'terrapi-backfill-rollups = TerraPi.rollup:main',
+        'terrapi-partition = TerraPi.storage:main',
+        'terrapi-archive = TerraPi.archive:main',
+        'terrapi-migrate-timestamps = TerraPi.migrate:main',
+        'terrapi-export = TerraPi.export:main',
+        'terrapi-import = TerraPi.importer:main',
+    ]
     if '--without-dashboard' not in sys.argv:
         # see the XXX in install_requires()!
         #s.append('terrapi-dashboard = TerraPi.dashboard:main [dashboard]')
@@ -110,6 +118,7 @@ def install_requires():
         'RPi.bme280',
         'RPi.GPIO;(platform_machine=="armv6l" or platform_machine=="armv7l") and platform_system=="Linux"',
         'SQLAlchemy',
+        'numpy',
         'pysispm',
         'pyusb'
     ]
@@ -152,7 +161,9 @@ setup(
         'Operating System :: POSIX :: Linux',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Topic :: Home Automation',
     ],
     keywords='terrarium automation thermostat sensor',
@@ -171,10 +182,11 @@ setup(
     ],
     install_requires=install_requires(),
     package_data={
-        '': ['conf/config-sample.yaml', 'data/.db_placeholder'],
+        '': ['conf/config-sample.yaml', 'data/.db_placeholder',
+            'static/live.js'],
     },
     entry_points={
         'console_scripts': console_scripts(),
     },
-    python_requires='>=3.5',
+    python_requires='>=3.9',
 )
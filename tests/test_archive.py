@@ -0,0 +1,60 @@
+import numpy as np
+
+from TerraPi import archive
+from TerraPi.archive import Segment, SegmentWriter, write_segment
+
+
+def series(n):
+    timestamps = 1500000000000 + np.arange(n, dtype=np.int64) * 1000
+    values = np.round(20 + np.sin(np.arange(n) / 50.0) * 5, 1)
+    values[::97] = np.nan
+    return timestamps, values
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'a_temperature.seg')
+    timestamps, values = series(10000)
+    # Writes of any size end up in blocks of block_size points.
+    with SegmentWriter(path, block_size=1000) as writer:
+        for i in range(0, len(timestamps), 333):
+            writer.write(timestamps[i:i+333], values[i:i+333])
+
+    with Segment(path) as segment:
+        t, v = segment.read()
+        blocks = list(segment.blocks())
+    np.testing.assert_array_equal(t, timestamps)
+    np.testing.assert_array_equal(v, values)
+    assert [len(b[0]) for b in blocks] == [1000] * 10
+    np.testing.assert_array_equal(np.concatenate([b[0] for b in blocks]),
+            timestamps)
+
+
+def test_range_reads_only_overlapping_blocks(tmp_path, monkeypatch):
+    path = str(tmp_path / 'a_temperature.seg')
+    timestamps, values = series(10000)
+    write_segment(path, timestamps, values, block_size=1000)
+
+    decoded = []
+    decode = archive._decode_block
+
+    def counting_decode(data, count):
+        decoded.append(count)
+        return decode(data, count)
+    monkeypatch.setattr(archive, '_decode_block', counting_decode)
+
+    start, end = timestamps[1500], timestamps[3200]
+    with Segment(path) as segment:
+        t, v = segment.read(start, end)
+        assert len(decoded) == 3
+        np.testing.assert_array_equal(t, timestamps[1500:3200])
+        np.testing.assert_array_equal(v, values[1500:3200])
+
+        # The end is exclusive, so a range ending at a block's first point
+        # does not touch that block.
+        del decoded[:]
+        t, _ = segment.read(timestamps[0], timestamps[1000])
+        assert len(decoded) == 1
+        assert len(t) == 1000
+
+        t, _ = segment.read(timestamps[-1] + 1)
+        assert len(t) == 0
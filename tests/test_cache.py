@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+from TerraPi.cache import SeriesCache
+from TerraPi.db import SensorType, create_sessionmaker, get_or_create_sensors
+from TerraPi.rollup import rebuild, update_rollups
+from TerraPi.storage import create_storage
+
+
+T0 = datetime(2026, 1, 1)
+
+
+def test_rows_stored_behind_the_high_water_mark_are_read(tmp_path):
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(
+        tmp_path / 'terrapi.db'))
+    storage = create_storage(sessionmaker)
+    session = sessionmaker()
+    sensor_id = list(get_or_create_sensors(session,
+        [('a', SensorType.temperature, None)]).values())[0]
+    live = [{'timestamp': T0 + timedelta(hours=h), 'sensor_id': sensor_id,
+        'value': 1.0} for h in range(10, 20)]
+    storage.insert(session, live)
+    update_rollups(session, live)
+    session.commit()
+
+    cache = SeriesCache(storage)
+    end = T0 + timedelta(days=1)
+    for resolution in ('raw', 'hour'):
+        t, _ = cache.get(session, [sensor_id], T0, end, resolution)[sensor_id]
+        assert len(t) == 10
+
+    # An import of older measurements
+    imported = [{'timestamp': T0 + timedelta(hours=h), 'sensor_id': sensor_id,
+        'value': 2.0} for h in range(0, 5)]
+    storage.insert(session, imported)
+    rebuild(session, storage, [sensor_id], T0, T0 + timedelta(hours=5))
+    session.commit()
+
+    for resolution in ('raw', 'hour'):
+        t, v = cache.get(session, [sensor_id], T0, end, resolution)[sensor_id]
+        assert len(t) == 15
+        assert list(v[:5]) == [2.0] * 5
+    session.close()
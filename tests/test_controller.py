@@ -0,0 +1,152 @@
+import threading
+import time
+
+import pytest
+
+from TerraPi.devices.device import ControllerDevice
+
+
+class FakeController(ControllerDevice):
+    """A controller whose hardware is a dict."""
+    def __init__(self, config=None, readable=True):
+        self.hardware = {}
+        self.controls = []
+        self.readable = readable
+        self.fail = 0
+        super().__init__(None, dict({'name': 'fake'}, **(config or {})))
+
+    def control(self, channel, value):
+        if self.fail:
+            self.fail -= 1
+            raise IOError('USB error')
+        self.controls.append((channel, value))
+        self.hardware[channel] = value
+
+    def read_state(self, channel):
+        return self.hardware.get(channel) if self.readable else None
+
+
+def test_unchanged_state_skips_control():
+    controller = FakeController()
+    assert controller.set_state(1, 'on')
+    assert not controller.set_state(1, 'on')
+    assert controller.set_state(2, 'on')
+    assert controller.set_state(1, 'off')
+    assert controller.controls == [(1, 'on'), (2, 'on'), (1, 'off')]
+    stats = controller.stats()
+    assert (stats['issued'], stats['suppressed'], stats['rechecks']) == \
+            (3, 1, 0)
+    controller.close()
+
+
+def test_recheck_detects_drift():
+    controller = FakeController({'recheck_interval': 0})
+    controller.set_state(1, 'on')
+    # Switched by other means
+    controller.hardware[1] = 'off'
+    assert controller.set_state(1, 'on')
+    # The hardware matches the cache again, so there is nothing to do.
+    assert not controller.set_state(1, 'on')
+    assert controller.controls == [(1, 'on'), (1, 'on')]
+    stats = controller.stats()
+    assert (stats['rechecks'], stats['mismatches']) == (2, 1)
+    controller.close()
+
+
+def test_unreadable_state_is_not_trusted_after_recheck_interval():
+    controller = FakeController({'recheck_interval': 0}, readable=False)
+    controller.set_state(1, 'on')
+    assert controller.set_state(1, 'on')
+    assert controller.controls == [(1, 'on'), (1, 'on')]
+    controller.close()
+
+
+def test_failed_control_forgets_state():
+    controller = FakeController()
+    controller.set_state(1, 'on')
+    controller.fail = 1
+    with pytest.raises(IOError):
+        controller.set_state(1, 'off')
+    # The channel may be on or off now, so the command is not suppressed.
+    assert controller.set_state(1, 'on')
+    assert controller.controls == [(1, 'on'), (1, 'on')]
+    controller.close()
+
+
+class SlowController(FakeController):
+    """A controller whose commands wait until they are released."""
+    def __init__(self, config=None):
+        super().__init__(config)
+        self.release = threading.Event()
+
+    def control(self, channel, value):
+        self.release.wait()
+        super().control(channel, value)
+
+
+def test_submit_does_not_wait_for_the_hardware():
+    controller = SlowController()
+    # Releases the hardware in any case, so a blocking submit fails the test
+    # instead of hanging it.
+    timer = threading.Timer(1, controller.release.set)
+    timer.start()
+    try:
+        first = controller.submit(1, 'on')
+        deadline = time.monotonic() + 5
+        while not first.running() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        start = time.monotonic()
+        second = controller.submit(2, 'on')
+        assert controller.stats()['submitted'] == 2
+        assert time.monotonic() - start < 0.1
+    finally:
+        controller.release.set()
+        timer.cancel()
+    assert first.result(5) and second.result(5)
+    controller.close()
+
+
+def test_queued_commands_are_coalesced():
+    controller = SlowController()
+    running = controller.submit(1, 'on')
+    deadline = time.monotonic() + 5
+    while not running.running() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    replaced = controller.submit(1, 'off')
+    latest = controller.submit(1, 'dim')
+    controller.release.set()
+    assert replaced.result(5) is None
+    assert running.result(5) and latest.result(5)
+    assert controller.controls == [(1, 'on'), (1, 'dim')]
+    assert controller.stats()['coalesced'] == 1
+    controller.close()
+
+
+def test_failed_commands_are_retried_with_backoff():
+    controller = FakeController({'max_retries': 2, 'max_backoff': 0.01})
+    controller.fail = 2
+    assert controller.submit(1, 'on').result(5)
+    assert controller.controls == [(1, 'on')]
+    stats = controller.stats()
+    assert (stats['errors'], stats['reconnects']) == (2, 2)
+
+    controller.fail = 5
+    with pytest.raises(IOError):
+        controller.submit(1, 'off').result(5)
+    # The first attempt and two retries
+    assert controller.stats()['errors'] == 2 + 3
+    controller.close()
+
+
+def test_newer_command_replaces_a_retry():
+    controller = FakeController({'max_backoff': 0.2})
+    controller.fail = 1
+    failed = controller.submit(1, 'on')
+    deadline = time.monotonic() + 5
+    while not controller.stats()['errors'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    newer = controller.submit(1, 'off')
+    assert failed.result(5) is None
+    assert newer.result(5)
+    assert controller.controls == [(1, 'off')]
+    controller.close()
@@ -0,0 +1,55 @@
+import numpy as np
+
+from TerraPi.downsample import budgets, downsample, lttb
+
+
+def series(n):
+    rng = np.random.default_rng(0)
+    timestamps = 1500000000000 + np.arange(n, dtype=np.int64) * 60000
+    values = 20 + np.cumsum(rng.normal(0, 0.1, n))
+    return timestamps, values
+
+
+def test_lttb_keeps_endpoints_and_one_point_per_bucket():
+    timestamps, values = series(10000)
+    indices = lttb(timestamps, values, 100)
+    assert len(indices) == 100
+    assert indices[0] == 0 and indices[-1] == 9999
+    # Every bucket between the endpoints contributes exactly one point.
+    edges = np.linspace(1, 9999, 99).astype(np.int64)
+    buckets = np.searchsorted(edges, indices[1:-1], side='right') - 1
+    assert list(buckets) == list(range(98))
+
+
+def test_lttb_keeps_spikes():
+    timestamps, values = series(10000)
+    values[4321] = 100
+    assert 4321 in lttb(timestamps, values, 100)
+
+
+def test_lttb_returns_short_series_unchanged():
+    timestamps, values = series(50)
+    assert list(lttb(timestamps, values, 100)) == list(range(50))
+    assert list(lttb(timestamps, values, 2)) == list(range(50))
+
+
+def test_downsample_keeps_extremes():
+    timestamps, values = series(10000)
+    t, v = downsample(timestamps, values, 50)
+    assert v.min() == values.min() and v.max() == values.max()
+    assert len(t) <= 52
+    assert (np.diff(t) > 0).all()
+
+    t, v = downsample(timestamps, values, 50, keep_extremes=False)
+    assert len(t) == 50
+
+    t, v = downsample(timestamps[:10], values[:10], 50)
+    assert len(t) == 10
+
+
+def test_budgets():
+    budget = budgets({'width': 1000, 'points_per_pixel': {'default': 2,
+        'humidity': 0.5}})
+    assert budget('temperature') == 2000
+    assert budget('humidity') == 500
+    assert budgets({'width': 1, 'points_per_pixel': 0})('temperature') == 3
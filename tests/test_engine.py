@@ -0,0 +1,89 @@
+import threading
+import time
+
+from apscheduler.triggers.interval import IntervalTrigger
+
+from TerraPi.devices.device import MEASURE_DURATION
+from TerraPi.engine import PollingEngine
+
+
+class FakeSensor():
+    def __init__(self, name, measure):
+        self.name = name
+        self.measure = measure
+        self.calls = 0
+        self.processed = 0
+        self._measure_duration = MEASURE_DURATION.labels(device=name)
+
+    def _measure(self):
+        self.calls += 1
+        return self.measure()
+
+    def _process(self, measurements, timestamp):
+        self.processed += 1
+
+
+def run(engine, seconds):
+    thread = threading.Thread(target=engine.run)
+    thread.start()
+    while engine._loop is None:
+        time.sleep(0.01)
+    time.sleep(seconds)
+    t = time.monotonic()
+    engine.stop()
+    thread.join(5)
+    assert not thread.is_alive()
+    return time.monotonic() - t
+
+
+def test_slow_reads_time_out_without_delaying_others():
+    engine = PollingEngine({'timeout': 0.05, 'max_failures': 100})
+    slow = FakeSensor('engine-slow', lambda: time.sleep(0.3) or [])
+    fast = FakeSensor('engine-fast', lambda: [])
+    engine.add(slow, IntervalTrigger(seconds=0.05))
+    engine.add(fast, IntervalTrigger(seconds=0.05))
+    run(engine, 0.6)
+
+    stats = engine.stats()
+    assert stats['engine-slow']['timeouts'] >= 1
+    # The slow sensor is not called again while its read is running.
+    assert stats['engine-slow']['skipped'] >= 1
+    assert slow.calls <= 3
+    assert slow.processed == 0
+    assert stats['engine-fast']['timeouts'] == 0
+    assert fast.processed >= 5
+
+
+def test_failing_sensor_is_backed_off():
+    def fail():
+        raise IOError('no sensor')
+    engine = PollingEngine({'max_failures': 2, 'backoff': 10})
+    failing = FakeSensor('engine-failing', fail)
+    engine.add(failing, IntervalTrigger(seconds=0.05))
+    run(engine, 0.5)
+
+    stats = engine.stats()['engine-failing']
+    assert failing.calls == 2
+    assert stats['errors'] == 2
+    assert stats['skipped'] >= 3
+    assert 9 < stats['backoff'] <= 10
+
+
+def test_stop_cancels_queued_reads():
+    release = threading.Event()
+    engine = PollingEngine({'workers': 1, 'timeout': 0.05,
+        'max_failures': 100})
+    # The blocked sensor keeps the only worker thread busy, so the read of
+    # the other one waits in the queue of the executor.
+    blocked = FakeSensor('engine-blocked', lambda: release.wait() and [])
+    queued = FakeSensor('engine-queued', lambda: [])
+    engine.add(blocked, IntervalTrigger(seconds=0.05))
+    engine.add(queued, IntervalTrigger(seconds=0.05))
+    try:
+        # Stopping does not wait for the blocked read.
+        assert run(engine, 0.3) < 1
+    finally:
+        release.set()
+    time.sleep(0.1)
+    assert blocked.calls == 1
+    assert queued.calls == 0
@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pytest
+
+from TerraPi.events import EventBus
+
+
+def blocked_bus(overflow, **config):
+    """
+    Returns a bus with one dispatcher and room for two events, which is
+    blocked by the first event until the returned event is set.
+    """
+    bus = EventBus(dict(config, workers=1, queue_size=2, overflow=overflow))
+    release = threading.Event()
+    received = []
+
+    def callback(value):
+        received.append(value)
+        if value == 1:
+            release.wait()
+    bus.publish('a', [callback], 1)
+    deadline = time.monotonic() + 5
+    while bus.stats()['queue_depths'][0] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return bus, release, callback, received
+
+
+@pytest.mark.parametrize('overflow, delivered', [
+    ('drop_oldest', [1, 3, 4]),
+    ('drop_newest', [1, 2, 3]),
+    ('block', [1, 2, 3]),
+])
+def test_overflow(overflow, delivered):
+    bus, release, callback, received = blocked_bus(overflow, put_timeout=0.05)
+    for value in (2, 3):
+        bus.publish('a', [callback], value)
+    start = time.monotonic()
+    bus.publish('a', [callback], 4)
+    if overflow == 'block':
+        assert time.monotonic() - start >= 0.05
+    release.set()
+    bus.close(5)
+    assert received == delivered
+    stats = bus.stats()
+    assert stats['published'] == 4
+    assert stats['dropped'] == 1
+
+
+def test_events_of_a_source_are_delivered_in_order():
+    bus = EventBus({'workers': 4})
+    received = {}
+
+    def callback(source):
+        return lambda value: received.setdefault(source, []).append(value)
+    callbacks = {source: callback(source) for source in 'abcdef'}
+    for i in range(200):
+        for source in 'abcdef':
+            bus.publish(source, [callbacks[source]], i)
+    bus.close(5)
+    assert received == {source: list(range(200)) for source in 'abcdef'}
+
+
+def test_slow_and_failing_callbacks_do_not_stop_others():
+    bus = EventBus({'workers': 2})
+    release = threading.Event()
+    received = []
+
+    def fail(value):
+        raise ValueError(value)
+    # The sources are assigned to different dispatchers by their names.
+    bus.publish('slow', [lambda value: release.wait()], 1)
+    bus.publish('fast', [fail, received.append], 2)
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert received == [2]
+    release.set()
+    bus.close(5)
+    stats = {name.split('.')[-1]: (c['calls'], c['errors'])
+            for name, c in bus.stats()['callbacks'].items()}
+    assert stats == {'<lambda>': (1, 0), 'fail': (1, 1),
+            'append': (1, 0)}
+
+
+def test_removed_callbacks_only_get_queued_events():
+    bus, release, callback, received = blocked_bus('drop_newest')
+    removed = []
+    callbacks = [callback, removed.append]
+    bus.publish('a', callbacks, 2)
+    # Callbacks are taken when an event is published, so removing one only
+    # affects later events.
+    callbacks.remove(removed.append)
+    bus.publish('a', callbacks, 3)
+    release.set()
+    bus.close(5)
+    assert received == [1, 2, 3]
+    assert removed == [2]
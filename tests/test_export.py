@@ -0,0 +1,24 @@
+import io
+import json
+
+import numpy as np
+
+from TerraPi.export import JsonLinesWriter
+
+
+def test_json_lines_are_valid_json():
+    f = io.StringIO()
+    JsonLinesWriter(f).write('a "b" 100%', 'temperature',
+            np.array([0, 1000, 2000, 3000]),
+            np.array([1.5, np.nan, np.inf, 1e-7]))
+
+    def reject(constant):
+        raise ValueError(constant)
+    rows = [json.loads(line, parse_constant=reject)
+            for line in f.getvalue().splitlines()]
+    assert rows == [
+        {'timestamp': '1970-01-01T00:00:00.000', 'sensor': 'a "b" 100%',
+            'type': 'temperature', 'value': 1.5},
+        {'timestamp': '1970-01-01T00:00:03.000', 'sensor': 'a "b" 100%',
+            'type': 'temperature', 'value': 1e-7},
+    ]
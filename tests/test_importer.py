@@ -0,0 +1,84 @@
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from TerraPi.db import DayRollup, MinuteRollup, SensorType, \
+        create_sessionmaker
+from TerraPi.importer import import_file, read_rows
+from TerraPi.storage import create_storage
+
+
+T0 = datetime(2026, 1, 1, 12)
+
+
+def write_rows(path, count):
+    with open(path, 'w') as f:
+        for i in range(count):
+            f.write(json.dumps({'timestamp': (T0 + timedelta(hours=i))
+                .isoformat(), 'sensor': 'a', 'type': 'temperature',
+                'value': i}) + '\n')
+
+
+def test_import_rebuilds_rollups_per_day(tmp_path):
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(
+        tmp_path / 'terrapi.db'))
+    storage = create_storage(sessionmaker)
+    path = str(tmp_path / 'export.jsonl')
+    # 72 hours from noon span four days.
+    write_rows(path, 72)
+    commits = []
+    event.listen(sessionmaker, 'after_commit',
+            lambda session: commits.append(session))
+
+    assert import_file(sessionmaker, storage, path, chunk_size=50) == 72
+    # Two chunks, and one rebuild per day
+    assert len(commits) == 2 + 4
+
+    session = sessionmaker()
+    assert sum(r.count for r in session.query(MinuteRollup)) == 72
+    days = session.query(DayRollup).order_by(DayRollup.bucket).all()
+    assert [(r.bucket.day, r.count) for r in days] == [
+            (1, 12), (2, 24), (3, 24), (4, 12)]
+    session.close()
+
+
+def test_import_continues_an_interrupted_rebuild(tmp_path):
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(
+        tmp_path / 'terrapi.db'))
+    storage = create_storage(sessionmaker)
+    path = str(tmp_path / 'export.jsonl')
+    write_rows(path, 72)
+    assert import_file(sessionmaker, storage, path) == 72
+
+    # Pretend the rebuild stopped after the second day, with the rollups of
+    # the days after it lost.
+    session = sessionmaker()
+    session.query(DayRollup).filter(
+            DayRollup.bucket >= datetime(2026, 1, 3)).delete()
+    session.commit()
+    session.close()
+    with open(path + '.progress', 'w') as f:
+        json.dump({'rows': 72, 'start': T0.isoformat(),
+            'end': (T0 + timedelta(hours=71)).isoformat(), 'sensors': [1],
+            'rebuilt': datetime(2026, 1, 2).isoformat()}, f)
+
+    assert import_file(sessionmaker, storage, path) == 0
+    session = sessionmaker()
+    assert [r.count for r in session.query(DayRollup).order_by(
+        DayRollup.bucket)] == [12, 24, 24, 12]
+    session.close()
+
+
+def test_read_rows_reads_csv_and_json_lines(tmp_path):
+    write_rows(str(tmp_path / 'export.jsonl'), 3)
+    with open(str(tmp_path / 'export.csv'), 'w') as f:
+        f.write('timestamp,sensor,type,value\n')
+        for i in range(3):
+            f.write('{},a,temperature,{}\n'.format(
+                (T0 + timedelta(hours=i)).isoformat(), i))
+
+    rows = list(read_rows(str(tmp_path / 'export.jsonl')))
+    assert rows == list(read_rows(str(tmp_path / 'export.csv')))
+    assert rows[1] == (T0 + timedelta(hours=1), 'a', SensorType.temperature,
+            1.0)
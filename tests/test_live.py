@@ -0,0 +1,110 @@
+# Runs live.js in node, with fakes of the browser APIs it uses.
+
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+
+NODE = shutil.which('node')
+pytestmark = pytest.mark.skipif(not NODE, reason='node is not installed')
+LIVE_JS = os.path.join(os.path.dirname(__file__), '..', 'TerraPi', 'static',
+        'live.js')
+MINUTE = 60 * 1000
+# 2026-10-18T12:00:00, UTC and local time are the same in the tests.
+NOON = 1792324800 * 1000
+
+FAKES = """
+var window = globalThis;
+var figures = %s;
+var sources = [];
+var document = {getElementById: function(id) { return figures[id]; }};
+function fetch() { return new Promise(function() {}); }
+function EventSource(url) { sources.push(this); }
+var Plotly = {
+    extendTraces: function(element, update, indices) {
+        indices.forEach(function(index, i) {
+            var trace = element.data[index];
+            trace.x = trace.x.concat(update.x[i]);
+            trace.y = trace.y.concat(update.y[i]);
+        });
+    },
+    react: function(element, data, layout) {
+        element.data = data;
+        element.layout = layout;
+    }
+};
+"""
+
+PUSH = """
+sources[0].onmessage({data: JSON.stringify({columns: %s})});
+console.log(JSON.stringify(figures));
+"""
+
+
+def push(figures, columns):
+    """
+    Loads live.js with the figures, pushes new measurements to it, and
+    returns the figures after them.
+    """
+    config = {'url': '/stream', 'poll_interval': 10, 'debounce': 0,
+        'utc_offset': 0, 'traces': {'1': ['temperature', 0, 1]}}
+    with open(LIVE_JS) as f:
+        script = '{}var TERRAPI_LIVE = {};\n{}{}'.format(
+                FAKES % json.dumps(figures), json.dumps(config), f.read(),
+                PUSH % json.dumps(columns))
+    result = subprocess.run([NODE], input=script, capture_output=True,
+            text=True, timeout=30, check=True)
+    return json.loads(result.stdout)
+
+
+def minutes(count):
+    """Returns epoch milliseconds of count minutes from NOON."""
+    return [NOON + i * MINUTE for i in range(count)]
+
+
+def test_pushed_rows_reach_the_default_view():
+    # With the default window, the figure shows hourly summaries.
+    figures = {'temperature': {
+        'data': [
+            {'uid': '1:summary', 'x': ['2026-10-18T10:00:00',
+                '2026-10-18T11:00:00'], 'y': [20, 21]},
+            {'uid': '1:live', 'x': ['2026-10-18T11:00:00'], 'y': [21]}],
+        'layout': {'xaxis': {'autorange': True}}}}
+    data = push(figures, {'1': [minutes(3), minutes(3), [22, 23, 24]]})
+    summary, tail = data['temperature']['data']
+    assert summary['x'] == ['2026-10-18T10:00:00', '2026-10-18T11:00:00']
+    assert tail['x'] == ['2026-10-18T11:00:00', '2026-10-18T12:00:00.000',
+            '2026-10-18T12:01:00.000', '2026-10-18T12:02:00.000']
+    assert tail['y'] == [21, 22, 23, 24]
+
+
+def test_zoomed_view_follows_pushed_rows():
+    figures = {'temperature': {
+        'data': [
+            {'uid': '1:raw', 'x': ['2026-10-18T11:58:00',
+                '2026-10-18T11:59:00'], 'y': [20, 21]},
+            {'uid': '1:live', 'x': [], 'y': []}],
+        'layout': {'xaxis': {'range': ['2026-10-18 11:00:00',
+            '2026-10-18 11:59:00']}}}}
+    data = push(figures, {'1': [minutes(3), minutes(3), [22, 23, 24]]})
+    raw, tail = data['temperature']['data']
+    assert raw['y'] == [20, 21, 22, 23, 24]
+    assert tail['x'] == []
+    # The range keeps its width, and ends at the last point.
+    assert data['temperature']['layout']['xaxis']['range'] == [
+            '2026-10-18T11:03:00.000', '2026-10-18T12:02:00.000']
+
+
+def test_zoomed_view_of_the_past_stays():
+    range_ = ['2026-10-18 10:00:00', '2026-10-18 11:00:00']
+    figures = {'temperature': {
+        'data': [
+            {'uid': '1:raw', 'x': ['2026-10-18T11:58:00'], 'y': [20]},
+            {'uid': '1:live', 'x': [], 'y': []}],
+        'layout': {'xaxis': {'range': range_}}}}
+    data = push(figures, {'1': [minutes(3), minutes(3), [22, 23, 24]]})
+    assert data['temperature']['data'][0]['y'] == [20, 22, 23, 24]
+    assert data['temperature']['layout']['xaxis']['range'] == range_
@@ -0,0 +1,57 @@
+import json
+from datetime import datetime, timedelta
+
+from TerraPi.db import SensorType
+from TerraPi.devices import loadgen
+from TerraPi.devices.loadgen import Replay
+
+
+T0 = datetime(2026, 1, 1, 12)
+
+
+class FakeScheduler():
+    def add_job(self, func, **kwargs):
+        pass
+
+
+class FakeApp():
+    def __init__(self):
+        self.engine = None
+        self.scheduler = FakeScheduler()
+        # Sensor ids are not needed, so they are never set up.
+        self.pending_sensor_devices = []
+
+
+class FakeTime():
+    """A clock that only advances when the replay sleeps."""
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_replay_interleaves_sensors(tmp_path, monkeypatch):
+    # Exports are ordered by sensor, then by timestamp.
+    path = str(tmp_path / 'export.jsonl')
+    with open(path, 'w') as f:
+        for sensor in 'ab':
+            for i in range(3):
+                f.write(json.dumps({'timestamp': (T0 + timedelta(minutes=i))
+                    .isoformat(), 'sensor': sensor, 'type': 'temperature',
+                    'value': i}) + '\n')
+    clock = FakeTime()
+    monkeypatch.setattr(loadgen, 'time', clock)
+    replay = Replay(FakeApp(), {'name': 'replay', 'file': path, 'speed': 60})
+    replayed = []
+    for sensor, device in replay.sensors.items():
+        device._process = lambda measurements, timestamp, sensor=sensor: \
+                replayed.append((clock.now, sensor, measurements))
+
+    replay._run()
+    # A minute of the recording takes a second.
+    assert replayed == [(t, sensor, [(SensorType.temperature, float(t))])
+            for t in range(3) for sensor in 'ab']
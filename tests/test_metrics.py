@@ -0,0 +1,39 @@
+import pytest
+
+from TerraPi.metrics import Counter, Histogram, Registry
+
+
+def test_render():
+    registry = Registry()
+    counter = Counter('test_misfires_total', 'Misfired jobs', ['job'],
+            registry=registry)
+    counter.labels(job='a "b"').inc()
+    counter.labels(job='c').inc(2)
+    histogram = Histogram('test_duration_seconds', 'Durations',
+            registry=registry, buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    registry.register_collector(lambda: [('test_rows_total', 'counter',
+        'Rows', [({}, 3)])])
+
+    assert registry.render().splitlines() == [
+        '# HELP test_misfires_total Misfired jobs',
+        '# TYPE test_misfires_total counter',
+        'test_misfires_total{job="a \\"b\\""} 1.0',
+        'test_misfires_total{job="c"} 2.0',
+        '# HELP test_duration_seconds Durations',
+        '# TYPE test_duration_seconds histogram',
+        'test_duration_seconds_bucket{le="0.1"} 1.0',
+        'test_duration_seconds_bucket{le="1.0"} 2.0',
+        'test_duration_seconds_bucket{le="+Inf"} 2.0',
+        'test_duration_seconds_count 2.0',
+        'test_duration_seconds_sum 0.55',
+        '# HELP test_rows_total Rows',
+        '# TYPE test_rows_total counter',
+        'test_rows_total 3.0',
+    ]
+
+
+def test_counter_names_end_in_total():
+    with pytest.raises(ValueError):
+        Counter('test_misfires', 'Misfired jobs', registry=Registry())
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from TerraPi.db import SensorType, create_sessionmaker, get_or_create_sensors
+from TerraPi.migrate import migrate_timestamps
+from TerraPi.storage import create_storage
+
+
+def test_migrate_timestamps_merges_milliseconds(tmp_path):
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(
+        tmp_path / 'terrapi.db'))
+    source = create_storage(sessionmaker)
+    target = create_storage(sessionmaker, {'timestamps': 'epoch_ms'})
+    session = sessionmaker()
+    sensor_id = get_or_create_sensors(session,
+            [('a', SensorType.temperature, None)])[
+                ('a', SensorType.temperature)]
+    # Both rows fall into the same millisecond, but into different chunks.
+    source.insert(session, [{'timestamp': datetime(2026, 1, 1, 0, 0, 0, us),
+        'sensor_id': sensor_id, 'value': value}
+        for us, value in ((1100, 1.0), (1900, 2.0), (5000, 3.0))])
+    session.commit()
+
+    assert migrate_timestamps(sessionmaker, source, target, chunk_size=1) \
+            == 3
+    rows = session.execute(target.table.select().order_by(
+        target.table.c.timestamp)).fetchall()
+    assert [(r.timestamp, r.value) for r in rows] == [
+            (datetime(2026, 1, 1, 0, 0, 0, 1000), 2.0),
+            (datetime(2026, 1, 1, 0, 0, 0, 5000), 3.0)]
+    assert session.execute(source.table.select()).fetchall() == []
+    session.close()
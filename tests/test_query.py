@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from TerraPi.db import SensorType, create_sessionmaker, get_or_create_sensors
+from TerraPi.query import aggregate_query, to_epoch_ms
+from TerraPi.storage import create_storage
+
+
+T0 = datetime(2026, 1, 1)
+HOUR = 60 * 60 * 1000
+
+
+@pytest.fixture(params=['datetime', 'epoch_ms'])
+def measurements(request, tmp_path):
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(
+        tmp_path / 'terrapi.db'))
+    storage = create_storage(sessionmaker, {'timestamps': request.param})
+    session = sessionmaker()
+    ids = list(get_or_create_sensors(session, [
+        ('a', SensorType.temperature, None),
+        ('b', SensorType.humidity, None)]).values())
+    # Every 10 minutes for three hours, with a different pattern per sensor.
+    rows = [{'timestamp': T0 + timedelta(minutes=10 * i), 'sensor_id': s,
+        'value': float((i * 7 + n * 3) % 11)}
+        for n, s in enumerate(ids) for i in range(18)]
+    storage.insert(session, rows)
+    session.commit()
+    yield session, storage, ids, rows
+    session.close()
+
+
+def expected(rows, bucket):
+    buckets = {}
+    for r in sorted(rows, key=lambda r: r['timestamp']):
+        key = (r['sensor_id'], to_epoch_ms(r['timestamp']) // bucket * bucket)
+        buckets.setdefault(key, []).append(r['value'])
+    return [(s, b, min(v), max(v), sum(v) / len(v), v[-1])
+            for (s, b), v in sorted(buckets.items())]
+
+
+def run(session, storage, ids, bucket, after=None, limit=None,
+        end=T0 + timedelta(days=1)):
+    raw = storage.select(session, T0, end)
+    query = aggregate_query(raw, ids, T0, end, bucket,
+            session.get_bind().dialect.name, after, limit)
+    return [(r.sensor_id, int(r.bucket), r.min, r.max,
+        pytest.approx(float(r.avg)), r.last)
+        for r in session.execute(query)]
+
+
+def test_buckets_and_aggregates(measurements):
+    session, storage, ids, rows = measurements
+    result = run(session, storage, ids, HOUR)
+    assert len(result) == 6
+    assert result == expected(rows, HOUR)
+
+    result = run(session, storage, ids, HOUR // 2)
+    assert len(result) == 12
+    assert result == expected(rows, HOUR // 2)
+
+
+def test_end_is_exclusive(measurements):
+    session, storage, ids, rows = measurements
+    end = T0 + timedelta(hours=1)
+    assert run(session, storage, ids, HOUR, end=end) == expected(
+            [r for r in rows if r['timestamp'] < end], HOUR)
+
+
+def test_cursor_paging(measurements):
+    session, storage, ids, rows = measurements
+    pages = []
+    after = None
+    while True:
+        page = run(session, storage, ids, HOUR // 2, after, 5)
+        pages.append(page)
+        if len(page) < 5:
+            break
+        # Like the next cursor of the API: the end of the last bucket
+        sensor_id, bucket = page[-1][:2]
+        after = (sensor_id, datetime(1970, 1, 1) + timedelta(
+            milliseconds=bucket + HOUR // 2))
+    assert [len(p) for p in pages] == [5, 5, 2]
+    assert sum(pages, []) == expected(rows, HOUR // 2)
@@ -0,0 +1,127 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+
+from TerraPi.db import DayRollup, MinuteRollup, ReplicationMark, Sensor, \
+        SensorType, create_sessionmaker, get_or_create_sensors
+from TerraPi.replication import Replicator
+from TerraPi.storage import create_storage
+
+
+T0 = datetime(2026, 1, 1)
+
+
+def store(sessionmaker, storage, sensor_id, start, count):
+    session = sessionmaker()
+    storage.insert(session, [{'timestamp': T0 + timedelta(minutes=i),
+        'sensor_id': sensor_id, 'value': float(i % 7)}
+        for i in range(start, start + count)])
+    session.commit()
+    session.close()
+
+
+def total(count):
+    return sum(float(i % 7) for i in range(count))
+
+
+def ship_all(replicator):
+    shipped = 0
+    while True:
+        rows = replicator.ship()
+        if not rows:
+            return shipped
+        shipped += rows
+
+
+def central_state(sessionmaker, storage):
+    session = sessionmaker()
+    raw = storage.select(session)
+    rows = session.query(func.count()).select_from(raw).scalar()
+    minutes = session.query(func.sum(MinuteRollup.count)).scalar()
+    days = [(r.count, r.minimum, r.maximum, r.total)
+            for r in session.query(DayRollup)]
+    names = sorted(s.name for s in session.query(Sensor))
+    session.close()
+    return rows, minutes, days, names
+
+
+@pytest.fixture
+def node(tmp_path):
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(
+        tmp_path / 'node.db'))
+    storage = create_storage(sessionmaker)
+    session = sessionmaker()
+    sensor_id = get_or_create_sensors(session,
+            [('a', SensorType.temperature, None)])[
+                ('a', SensorType.temperature)]
+    session.commit()
+    session.close()
+    config = {'node': 'n1', 'batch_size': 10,
+        'connection_string': 'sqlite:///{}'.format(
+            tmp_path / 'central' / 'central.db')}
+    return sessionmaker, storage, sensor_id, config, tmp_path / 'central'
+
+
+def test_ship_resume_and_lost_marks(node):
+    sessionmaker, storage, sensor_id, config, central_dir = node
+    store(sessionmaker, storage, sensor_id, 0, 25)
+
+    # The directory of the central database is missing, so it can not be
+    # opened.
+    replicator = Replicator(sessionmaker, storage, config)
+    with pytest.raises(SQLAlchemyError):
+        replicator.ship()
+
+    central_dir.mkdir()
+    assert ship_all(replicator) == 25
+    central = create_sessionmaker(config['connection_string'])
+    central_storage = create_storage(central)
+    assert central_state(central, central_storage) == (25, 25,
+            [(25, 0.0, 6.0, total(25))], ['n1/a'])
+
+    # A restarted node continues after the last shipped row.
+    store(sessionmaker, storage, sensor_id, 25, 5)
+    replicator = Replicator(sessionmaker, storage, config)
+    assert ship_all(replicator) == 5
+    assert central_state(central, central_storage) == (30, 30,
+            [(30, 0.0, 6.0, total(30))], ['n1/a'])
+
+    # Rows shipped again after the marks were lost are not counted twice.
+    session = central()
+    session.query(ReplicationMark).delete()
+    session.commit()
+    session.close()
+    replicator = Replicator(sessionmaker, storage, config)
+    assert ship_all(replicator) == 30
+    assert central_state(central, central_storage) == (30, 30,
+            [(30, 0.0, 6.0, total(30))], ['n1/a'])
+
+
+def test_replicator_survives_errors(node, monkeypatch):
+    sessionmaker, storage, sensor_id, config, central_dir = node
+    central_dir.mkdir()
+    store(sessionmaker, storage, sensor_id, 0, 5)
+    replicator = Replicator(sessionmaker, storage, dict(config, backoff=0.01,
+        interval=0.01))
+    ship = replicator.ship
+    calls = []
+
+    def failing_ship():
+        calls.append(None)
+        if len(calls) == 1:
+            raise KeyError('boom')
+        return ship()
+    monkeypatch.setattr(replicator, 'ship', failing_ship)
+
+    replicator.start()
+    deadline = time.monotonic() + 5
+    while replicator.stats()['rows_shipped'] < 5 and \
+            time.monotonic() < deadline:
+        time.sleep(0.01)
+    replicator.close()
+    stats = replicator.stats()
+    assert stats['failures'] == 1
+    assert stats['rows_shipped'] == 5
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from sqlalchemy import event
+
+from TerraPi.db import SensorType, create_sessionmaker, get_or_create_sensors
+from TerraPi.storage import create_storage
+
+
+def test_partitions_are_created_once(tmp_path):
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(
+        tmp_path / 'terrapi.db'))
+    storage = create_storage(sessionmaker, {'partitioned': True})
+    session = sessionmaker()
+    sensor_id = get_or_create_sensors(session,
+            [('a', SensorType.temperature, None)])[
+                ('a', SensorType.temperature)]
+    session.commit()
+
+    statements = []
+    event.listen(sessionmaker.get_bind(), 'before_cursor_execute',
+            lambda conn, cursor, statement, *args: statements.append(
+                statement))
+
+    def insert(timestamp):
+        del statements[:]
+        storage.insert(session, [{'timestamp': timestamp,
+            'sensor_id': sensor_id, 'value': 1.0}])
+        return [s for s in statements if not s.startswith('INSERT')]
+
+    assert insert(datetime(2026, 1, 1))
+    session.rollback()
+    # The partition is checked again after a rollback.
+    assert insert(datetime(2026, 1, 2))
+    session.commit()
+    assert insert(datetime(2026, 1, 3)) == []
+    session.commit()
+    assert insert(datetime(2026, 2, 1))
+    session.commit()
+    session.close()
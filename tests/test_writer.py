@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+from TerraPi.db import MinuteRollup, SensorType, create_sessionmaker, \
+        get_or_create_sensors
+from TerraPi.storage import create_storage
+from TerraPi.writer import MeasurementWriter
+
+
+T0 = datetime(2026, 1, 1)
+
+
+def setup(tmp_path, storage_config=None):
+    sessionmaker = create_sessionmaker('sqlite:///{}'.format(
+        tmp_path / 'terrapi.db'))
+    storage = create_storage(sessionmaker, storage_config)
+    session = sessionmaker()
+    ids = get_or_create_sensors(session, [('a', SensorType.temperature, None),
+        ('b', SensorType.humidity, None)])
+    session.commit()
+    session.close()
+    return sessionmaker, storage, list(ids.values())
+
+
+def stored(sessionmaker, storage):
+    session = sessionmaker()
+    raw = storage.select(session)
+    rows = session.execute(raw.select()).fetchall()
+    count = sum(r.count for r in session.query(MinuteRollup))
+    session.close()
+    return len(rows), count
+
+
+def test_writer_survives_errors(tmp_path):
+    sessionmaker, storage, ids = setup(tmp_path, {'partitioned': True})
+    writer = MeasurementWriter(sessionmaker, storage, {'put_timeout': 0.1})
+    writer.put(12345, 1.0, T0)
+    assert writer.flush(5)
+    writer.put(ids[0], 1.0, T0)
+    assert writer.flush(5)
+    writer.close()
+    assert stored(sessionmaker, storage) == (1, 1)
+    stats = writer.stats()
+    assert stats['flush_errors'] == 1
+    assert stats['rows_written'] == 1
+
+
+def test_duplicates_do_not_drop_the_batch(tmp_path):
+    sessionmaker, storage, ids = setup(tmp_path)
+    writer = MeasurementWriter(sessionmaker, storage)
+    published = []
+    writer.subscribe(published.append)
+    writer.put(ids[0], 1.0, T0)
+    assert writer.flush(5)
+    writer.put(ids[0], 2.0, T0)
+    for i in range(1, 4):
+        writer.put(ids[i % 2], float(i), T0 + timedelta(seconds=i))
+    assert writer.flush(5)
+    writer.close()
+    # The duplicate is skipped, and rollups count every stored row once.
+    assert stored(sessionmaker, storage) == (4, 4)
+    stats = writer.stats()
+    assert (stats['rows_written'], stats['rows_dropped']) == (4, 0)
+    # Subscribers only get the rows that were inserted.
+    assert [[r['value'] for r in batch] for batch in published] == [
+            [1.0], [1.0, 2.0, 3.0]]